@@ -0,0 +1,118 @@
+# archive.py - append-only compressed segment files for retired chat rows
+#
+# Retention (db.archive_expired) moves old rows out of `messages` and
+# `private_messages` into files under ARCHIVE_DIR:
+#
+#   <kind>-000001.ndjson.gz, <kind>-000002.ndjson.gz, ...
+#
+# Each archive batch appends one gzip member per scope (a basecamp, or a DM
+# session key) holding that scope's rows as NDJSON, oldest first. A file is
+# only ever appended to and rolls over at SEGMENT_BYTES. Concatenated gzip
+# members are still a valid .gz file (`zcat` prints every row), and each
+# member can be read on its own from its (offset, length).
+#
+# This module only does the file side. The index (which member holds which
+# id range of which scope) is the archive_segments table in db.py. Its rows
+# are written in the same transaction that deletes the hot rows, so a member
+# that was written but never indexed (a crash in between) is just dead bytes.
+import os
+import gzip
+import json
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows: in-process lock only
+    fcntl = None
+
+SEGMENT_BYTES = 64 * 1024 * 1024  # start a new file past this size
+CACHE_MEMBERS = 32                # decompressed members kept for scroll-back
+
+_lock = threading.Lock()  # held for a whole archive pass (see exclusive)
+_cache = OrderedDict()  # (directory, file, offset) -> [row dicts]
+_cache_lock = threading.Lock()
+
+
+@contextmanager
+def exclusive(directory):
+    """Yields True if this process may archive now (one archiver per ARCHIVE_DIR).
+
+    Non-blocking: a second process (debug reloader, extra worker) gets False
+    and skips its pass instead of appending to the same segments.
+    """
+    os.makedirs(directory, exist_ok=True)
+    if not _lock.acquire(blocking=False):
+        yield False
+        return
+    try:
+        if fcntl is None:
+            yield True
+            return
+        with open(os.path.join(directory, '.archiver.lock'), 'a') as lf:
+            try:
+                fcntl.flock(lf.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lf.fileno(), fcntl.LOCK_UN)
+    finally:
+        _lock.release()
+
+
+def _segment_path(directory, kind):
+    """Current segment file for `kind`, rolling over to a new one when full."""
+    prefix = kind + '-'
+    numbers = [int(name[len(prefix):-len('.ndjson.gz')]) for name in os.listdir(directory)
+               if name.startswith(prefix) and name.endswith('.ndjson.gz')
+               and name[len(prefix):-len('.ndjson.gz')].isdigit()]
+    n = max(numbers, default=1)
+    path = os.path.join(directory, f'{kind}-{n:06d}.ndjson.gz')
+    if os.path.exists(path) and os.path.getsize(path) >= SEGMENT_BYTES:
+        path = os.path.join(directory, f'{kind}-{n + 1:06d}.ndjson.gz')
+    return path
+
+
+def append(directory, kind, rows_by_scope):
+    """Append one member per scope and fsync; returns [(scope, file, offset, length)].
+
+    `rows_by_scope` maps scope -> list of row dicts in id order. `file` is
+    relative to `directory`. Call inside exclusive().
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = _segment_path(directory, kind)
+    out = []
+    with open(path, 'ab') as f:
+        offset = f.seek(0, os.SEEK_END)
+        for scope, rows in rows_by_scope.items():
+            body = ''.join(json.dumps(r, ensure_ascii=False, separators=(',', ':')) + '\n' for r in rows)
+            member = gzip.compress(body.encode('utf-8'), compresslevel=6, mtime=0)
+            f.write(member)
+            out.append((scope, os.path.basename(path), offset, len(member)))
+            offset += len(member)
+        f.flush()
+        os.fsync(f.fileno())
+    return out
+
+
+def read(directory, file, offset, length):
+    """Rows of one member, oldest first."""
+    key = (directory, file, offset)
+    with _cache_lock:
+        rows = _cache.get(key)
+        if rows is not None:
+            _cache.move_to_end(key)
+            return rows
+    with open(os.path.join(directory, file), 'rb') as f:
+        f.seek(offset)
+        data = gzip.decompress(f.read(length))
+    rows = [json.loads(line) for line in data.decode('utf-8').splitlines() if line]
+    with _cache_lock:
+        _cache[key] = rows
+        while len(_cache) > CACHE_MEMBERS:
+            _cache.popitem(last=False)
+    return rows
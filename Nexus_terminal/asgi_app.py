@@ -0,0 +1,368 @@
+# asgi_app.py - asyncio serving mode (python-socketio AsyncServer under ASGI)
+#
+#   python asgi_app.py                       # uvicorn on NEXUS_HOST:NEXUS_PORT
+#   uvicorn asgi_app:asgi --port 5000        # or any other ASGI server
+#
+# Same HTTP routes (web.py's Flask app, mounted through a2wsgi) and the same
+# Socket.IO events (chat.py does their work) as app.py, but sockets live on
+# one event loop instead of holding an OS thread each. SQLite and Argon2 work
+# runs in bounded executors; presence and the other in-memory structures are
+# used inline. This mode is a single process: run_workers.py is the
+# multi-process deployment.
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import socketio
+from werkzeug.http import parse_cookie
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:
+    WSGIMiddleware = None
+
+if os.environ.get('NEXUS_MESSAGE_QUEUE'):
+    raise RuntimeError('asgi_app runs as one process; unset NEXUS_MESSAGE_QUEUE '
+                       '(use run_workers.py for several workers)')
+if WSGIMiddleware is None:
+    raise RuntimeError('a2wsgi is not installed (pip install a2wsgi); it serves the HTTP routes')
+
+# HTTP routes, credential checks and startup (web), the events' logic (chat)
+import web
+import chat
+import db
+import auth_pool
+import presence
+import unread
+import metrics
+import broadcast
+import ratelimit
+import throttle
+
+# SQLite calls get a thread each from a pool a bit larger than the reader
+# pool; Argon2 waits get one thread per verify the auth pool will accept.
+DB_THREADS = int(os.environ.get('NEXUS_ASYNC_DB_THREADS') or db.READER_POOL_SIZE + 2)
+HTTP_THREADS = int(os.environ.get('NEXUS_ASYNC_HTTP_THREADS') or 16)
+
+_db_executor = ThreadPoolExecutor(DB_THREADS, thread_name_prefix='nexus-db')
+_auth_executor = ThreadPoolExecutor(auth_pool.AUTH_MAX_PENDING, thread_name_prefix='nexus-auth')
+
+_loop = None  # the server's event loop, known once it has started
+
+
+async def _startup():
+    global _loop
+    _loop = asyncio.get_running_loop()
+    asyncio.ensure_future(_retention_loop())
+
+
+async def _retention_loop():
+    # A thread of its own (the default executor): a pass can take a while
+    while True:
+        await _loop.run_in_executor(None, web.archive_expired)
+        await asyncio.sleep(web.RETENTION_INTERVAL)
+
+
+sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*')
+metrics.instrument_socketio(sio)  # /metrics comes with the Flask routes
+asgi = socketio.ASGIApp(sio, other_asgi_app=WSGIMiddleware(web.app, workers=HTTP_THREADS), on_startup=_startup)
+
+PRESENCE = presence.PresenceRegistry(persist=os.environ.get('NEXUS_PRESENCE_PERSIST') == '1')
+metrics.gauge('nexus_presence', 'Sockets, rooms and users known to this worker.', PRESENCE.stats)
+
+
+def _emit_presence_delta(basecamp, delta):
+    asyncio.ensure_future(sio.emit('presence_delta', delta, room=basecamp))
+
+
+def _call_later(delay, fn, *args):
+    asyncio.get_running_loop().call_later(delay, fn, *args)
+
+
+PRESENCE_DELTAS = presence.DeltaCoalescer(PRESENCE, chat.PRESENCE_DELTA_WINDOW, _emit_presence_delta, _call_later)
+
+
+_room_sends = {}  # basecamp -> its latest room broadcast task
+
+
+def _emit_room_messages(basecamp, messages):
+    # Sends are tasks; each waits for the room's previous one so frames stay in order
+    event, data = ('new_message', messages[0]) if len(messages) == 1 else ('new_messages', {'messages': messages})
+    previous = _room_sends.get(basecamp)
+
+    async def send():
+        if previous is not None:
+            await asyncio.wait([previous])
+        await sio.emit(event, data, room=basecamp)
+
+    task = _room_sends[basecamp] = asyncio.ensure_future(send())
+    task.add_done_callback(lambda t: _room_sends.pop(basecamp) if _room_sends.get(basecamp) is t else None)
+
+
+ROOM_BROADCASTS = broadcast.MessageCoalescer(chat.broadcast_window, _emit_room_messages, _call_later)
+
+# One room write at a time: concurrent executor calls could commit ids in one
+# order and reach room_history and the broadcasts in another
+_room_writes = {}  # basecamp -> asyncio.Lock
+
+web.init()
+# One process: presence persisted by an earlier run is stale
+if PRESENCE.persist:
+    db.clear_user_sessions()
+
+
+def _close_user_sockets(username):
+    # /logout runs on an a2wsgi thread; the sockets belong to the event loop
+    for sid in PRESENCE.local_sids(username):
+        asyncio.run_coroutine_threadsafe(sio.disconnect(sid), _loop)
+
+
+web.close_user_sockets = _close_user_sockets
+
+
+async def _db(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_db_executor, fn, *args)
+
+
+async def _auth(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_auth_executor, fn, *args)
+
+
+def _flask_session(environ):
+    """The Flask session carried by the handshake's cookie, or {}."""
+    cookie = parse_cookie(environ.get('HTTP_COOKIE', '')).get(web.app.config.get('SESSION_COOKIE_NAME', 'session'))
+    if not cookie:
+        return {}
+    serializer = web.app.session_interface.get_signing_serializer(web.app)
+    try:
+        return dict(serializer.loads(cookie, max_age=int(web.app.permanent_session_lifetime.total_seconds())))
+    except Exception:
+        return {}
+
+
+def _client_ip(environ):
+    # engineio's ASGI environ has REMOTE_ADDR 127.0.0.1 for everyone; the peer is in the scope
+    client = (environ.get('asgi.scope') or {}).get('client')
+    return throttle.client_ip({**environ, 'REMOTE_ADDR': client[0] if client else None})
+
+
+def rate_limited(event):
+    """Async twin of app.rate_limited (same limiter, same 'rate_limited' reply)."""
+    def deco(fn):
+        if not ratelimit.ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        async def handler(sid, *args):
+            session = await sio.get_session(sid)
+            denied = chat.RATE_LIMITER.check(event, sid, session.get('username'))
+            if denied:
+                await sio.emit('rate_limited', ratelimit.reply(event, *denied), to=sid)
+                return
+            return await fn(sid, *args)
+        return handler
+    return deco
+
+
+# Socket.IO events; handlers match app.py one for one. Like Flask-SocketIO,
+# `session` is the cookie's contents as of the connect.
+@sio.event
+async def connect(sid, environ, auth=None):
+    session = _flask_session(environ)
+    session['remote_addr'] = _client_ip(environ)  # for the guess throttle
+    await sio.save_session(sid, session)
+    if session.get('authenticated') and session.get('basecamp'):
+        username = session.get('username')
+        basecamp = session.get('basecamp')
+
+        first = PRESENCE.connect(sid, username, basecamp)
+
+        await sio.enter_room(sid, basecamp)
+        await sio.enter_room(sid, f"user:{username}")
+
+        if first:
+            PRESENCE_DELTAS.touch(basecamp, username, was_present=False)
+        await sio.emit('online_users_update', {'users': PRESENCE.online(basecamp)}, to=sid)
+        for event, payload in await _db(chat.welcome, username, basecamp, session.get('basecamp_name')):
+            await sio.emit(event, payload, to=sid)
+
+
+@sio.event
+async def disconnect(sid, *args):
+    chat.RATE_LIMITER.forget_sid(sid)
+    info = PRESENCE.disconnect(sid)
+    if not info:
+        return
+    username, basecamp, last_in_room, last_overall = info
+    if last_overall:
+        unread.forget(username)
+    if basecamp and last_in_room:
+        PRESENCE_DELTAS.touch(basecamp, username, was_present=True)
+
+
+@sio.event
+async def leave_basecamp(sid, *args):
+    info = PRESENCE.leave_room(sid)
+    if not info:
+        return
+    username, basecamp, last_in_room = info
+
+    await sio.leave_room(sid, basecamp)
+    if last_in_room:
+        PRESENCE_DELTAS.touch(basecamp, username, was_present=True)
+
+
+@sio.event
+@rate_limited('request_trust_status')
+async def request_trust_status(sid, data=None):
+    session = await sio.get_session(sid)
+    if not session.get('authenticated'):
+        return
+    status = await _db(chat.trust_status, session.get('username'), data)
+    if status:
+        await sio.emit('trust_status', status, to=sid)
+
+
+@sio.event
+@rate_limited('request_roster_state')
+async def request_roster_state(sid, data=None):
+    session = await sio.get_session(sid)
+    if not session.get('authenticated'):
+        return
+    await sio.emit('roster_state', await _db(chat.roster_state, session.get('username'), data), to=sid)
+
+
+@sio.event
+@rate_limited('submit_partner_code')
+async def submit_partner_code(sid, data=None):
+    session = await sio.get_session(sid)
+    if not session.get('authenticated'):
+        return
+    me = session.get('username')
+    result = await _auth(chat.submit_partner_code, me, data, session.get('remote_addr'))
+    if not result:
+        return
+    status, partner_view = result
+    await sio.emit('trust_status', status, to=sid)
+    if partner_view:
+        await sio.emit('trust_status', partner_view, room=f"user:{status['with']}")
+
+
+@sio.event
+@rate_limited('send_message')
+async def send_message(sid, data=None):
+    session = await sio.get_session(sid)
+    if session.get('authenticated') and session.get('basecamp'):
+        basecamp = session.get('basecamp')
+        async with _room_writes.setdefault(basecamp, asyncio.Lock()):
+            payload = await _db(chat.room_message, session.get('username'), basecamp, data)
+            if payload:
+                ROOM_BROADCASTS.publish(basecamp, payload)
+
+
+@sio.event
+@rate_limited('send_private_message')
+async def send_private_message(sid, data=None):
+    session = await sio.get_session(sid)
+    if not session.get('authenticated') or not session.get('basecamp'):
+        return
+    sender = session.get('username')
+    result = await _db(chat.private_message, sender, data)
+    if not result:
+        return
+    event, payload = result
+    if event != 'private_message':
+        await sio.emit(event, payload, to=sid)
+        return
+
+    recipient = payload['to']
+    await sio.emit('private_message', payload, room=f"user:{recipient}")
+    await sio.emit('private_message', payload, room=f"user:{sender}")
+    count = unread.on_message(recipient, sender, payload['id'])
+    if count is not None:
+        await sio.emit('unread_delta', {'partner': sender, 'count': count}, room=f"user:{recipient}")
+
+
+@sio.event
+@rate_limited('fetch_private_history')
+async def fetch_private_history(sid, data=None):
+    session = await sio.get_session(sid)
+    if not session.get('authenticated'):
+        return
+    page = await _db(chat.private_history, session.get('username'), data)
+    if page:
+        await sio.emit('private_history', page, to=sid)
+
+
+@sio.event
+@rate_limited('mark_private_read')
+async def mark_private_read(sid, data=None):
+    session = await sio.get_session(sid)
+    if not session.get('authenticated'):
+        return
+    user = session.get('username')
+    result = await _db(chat.mark_private_read, user, data)
+    if result:
+        await sio.emit('unread_delta', result[1], room=f"user:{user}")
+
+
+@sio.event
+@rate_limited('search_messages')
+async def search_messages(sid, data=None):
+    session = await sio.get_session(sid)
+    if not session.get('authenticated') or not session.get('basecamp'):
+        return
+    results = await _db(chat.search_messages, session.get('basecamp'), data)
+    if results:
+        await sio.emit('search_results', results, to=sid)
+
+
+@sio.event
+@rate_limited('search_private')
+async def search_private(sid, data=None):
+    session = await sio.get_session(sid)
+    if not session.get('authenticated'):
+        return
+    results = await _db(chat.search_private, session.get('username'), data)
+    if results:
+        await sio.emit('search_results', results, to=sid)
+
+
+@sio.event
+@rate_limited('get_unread_counts')
+async def get_unread_counts(sid, *args):
+    session = await sio.get_session(sid)
+    if not session.get('authenticated'):
+        return
+    await sio.emit('unread_counts', await _db(unread.counts, session.get('username')), to=sid)
+
+
+@sio.event
+@rate_limited('get_online_users')
+async def get_online_users(sid, *args):
+    session = await sio.get_session(sid)
+    if session.get('authenticated') and session.get('basecamp'):
+        await sio.emit('online_users_update', {'users': PRESENCE.online(session.get('basecamp'))}, to=sid)
+
+
+def _raise_fd_limit():
+    # Every idle websocket is a file descriptor; the default soft limit (often 1024) is the first wall
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit('uvicorn is not installed (pip install uvicorn); '
+                         'or serve asgi_app:asgi with another ASGI server')
+    _raise_fd_limit()
+    uvicorn.run(asgi, host=os.environ.get('NEXUS_HOST', '0.0.0.0'), port=int(os.environ.get('NEXUS_PORT') or 5000),
+                backlog=4096, timeout_graceful_shutdown=5, log_level='warning')
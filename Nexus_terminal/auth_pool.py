@@ -0,0 +1,169 @@
+# auth_pool.py - bounded process pool for Argon2 verification
+#
+# PasswordHasher.verify with the default parameters (m=64MiB, t=3, p=4) pins a
+# core and 64 MiB for the duration of the call. Running that inline on the
+# request/socket thread lets a burst of logins stall chat delivery for
+# everyone, so all verifies are shipped to a dedicated process pool instead.
+# The number of in-flight verifies is capped; once the cap is reached callers
+# get AuthBusy immediately instead of queueing up behind the storm. A pool
+# that can't answer (crashed worker, timeout) raises AuthUnavailable, never a
+# mismatch: an infrastructure fault must not read as "invalid credentials".
+import os
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from argon2 import PasswordHasher
+
+import metrics
+
+# Pool size defaults to one worker per core; pending limit counts both the
+# verifies that are running and the ones waiting for a free worker.
+AUTH_WORKERS = int(os.environ.get('NEXUS_AUTH_WORKERS') or os.cpu_count() or 1)
+AUTH_MAX_PENDING = int(os.environ.get('NEXUS_AUTH_MAX_PENDING') or AUTH_WORKERS * 4)
+AUTH_TIMEOUT = 30.0  # seconds a caller waits for a result before giving up
+
+# A slot is held until the verify has actually finished in its worker, not
+# just until the caller stops waiting, so at most AUTH_MAX_PENDING run at once.
+
+_ph = None  # per-worker PasswordHasher, created on first use in the child
+_pool = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(AUTH_MAX_PENDING)
+
+_stats_lock = threading.Lock()
+_stats = {
+    'verified': 0,        # verifies that ran to completion (match or mismatch)
+    'rejected_busy': 0,   # calls turned away because the queue was full
+    'errors': 0,          # worker crashed / timed out
+    'queue_wait_total': 0.0,
+    'queue_wait_max': 0.0,
+    'verify_time_total': 0.0,
+    'verify_time_max': 0.0,
+}
+
+
+class AuthBusy(Exception):
+    """Raised when the auth pool is saturated; callers should answer 'busy'."""
+
+
+class AuthUnavailable(AuthBusy):
+    """Raised when the pool failed to answer (worker crash, timeout); also 'busy' to callers."""
+
+
+def _worker_verify(stored_hash, secret, submitted_at):
+    """Runs in a pool process. Returns (ok, queue_wait, verify_time)."""
+    global _ph
+    started = time.time()
+    if _ph is None:
+        _ph = PasswordHasher()
+    try:
+        ok = _ph.verify(stored_hash, secret)
+    except Exception:
+        ok = False
+    return bool(ok), started - submitted_at, time.time() - started
+
+
+def _watch_parent(parent_pid):
+    """Pool initializer: exit when the server process is gone.
+
+    Workers are forked, so they hold the server's listening socket. If the
+    server dies without shutting the pool down (SIGKILL, or a server that
+    re-raises SIGTERM after its own cleanup) they'd otherwise linger on.
+    """
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(1.0)
+        os._exit(0)
+    threading.Thread(target=watch, name='auth-parent-watch', daemon=True).start()
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=AUTH_WORKERS, initializer=_watch_parent,
+                                            initargs=(os.getpid(),))
+    return _pool
+
+
+def _reset_pool(broken):
+    """Drop a broken pool so the next verify starts a fresh one."""
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    try:
+        broken.shutdown(wait=False, cancel_futures=True)
+    except Exception:
+        pass
+
+
+def _record(queue_wait, verify_time):
+    metrics.ARGON2_VERIFY_SECONDS.observe(verify_time)
+    metrics.ARGON2_QUEUE_WAIT_SECONDS.observe(queue_wait)
+    with _stats_lock:
+        _stats['verified'] += 1
+        _stats['queue_wait_total'] += queue_wait
+        _stats['verify_time_total'] += verify_time
+        _stats['queue_wait_max'] = max(_stats['queue_wait_max'], queue_wait)
+        _stats['verify_time_max'] = max(_stats['verify_time_max'], verify_time)
+
+
+def _bump(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def verify(stored_hash: str, secret: str) -> bool:
+    """Verify `secret` against an Argon2 `stored_hash` in the auth pool.
+
+    Returns True/False like a successful/failed PasswordHasher.verify.
+    Raises AuthBusy without doing any work if AUTH_MAX_PENDING verifies are
+    already in flight, and AuthUnavailable if the pool broke or timed out.
+    """
+    if not _slots.acquire(blocking=False):
+        _bump('rejected_busy')
+        metrics.AUTH_REJECTED_BUSY.inc()
+        raise AuthBusy()
+    pool = _get_pool()
+    try:
+        future = pool.submit(_worker_verify, stored_hash, secret, time.time())
+    except Exception as e:
+        _slots.release()
+        _bump('errors')
+        if isinstance(e, (BrokenProcessPool, RuntimeError)):  # broken, or shut down under us
+            _reset_pool(pool)
+        raise AuthUnavailable() from e
+    future.add_done_callback(lambda _: _slots.release())
+    try:
+        ok, queue_wait, verify_time = future.result(timeout=AUTH_TIMEOUT)
+    except Exception as e:
+        _bump('errors')
+        if isinstance(e, BrokenProcessPool):
+            _reset_pool(pool)
+        raise AuthUnavailable() from e
+    _record(queue_wait, verify_time)
+    return ok
+
+
+def get_stats() -> dict:
+    """Snapshot of pool counters, including average queue wait / verify time."""
+    with _stats_lock:
+        out = dict(_stats)
+    n = out['verified']
+    out['queue_wait_avg'] = out['queue_wait_total'] / n if n else 0.0
+    out['verify_time_avg'] = out['verify_time_total'] / n if n else 0.0
+    out['workers'] = AUTH_WORKERS
+    out['max_pending'] = AUTH_MAX_PENDING
+    return out
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
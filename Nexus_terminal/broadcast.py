@@ -0,0 +1,81 @@
+# broadcast.py - per-room batching of chat broadcasts
+#
+# Every room message is normally its own 'new_message' emit: one JSON encode
+# and one websocket frame per recipient per message. When a camp bursts, the
+# coalescer holds messages for up to the room's window and sends them as one
+# 'new_messages' {'messages': [...]} frame, in order, so recipients see one
+# frame per window instead of one per message.
+#
+# A quiet room pays nothing: a message arriving more than one window after
+# the room's last send goes out at once as a plain 'new_message'. Only
+# messages that follow it inside the window are held, and none of them waits
+# longer than the window (or until MAX_BATCH messages have piled up).
+import time
+import threading
+
+import metrics
+
+MAX_BATCH = 50  # messages per frame; a full batch is sent without waiting
+
+BATCH_SIZE = metrics.Histogram('nexus_broadcast_batch_messages', 'Room messages per broadcast frame.',
+                               buckets=metrics.SIZE_BUCKETS)
+
+
+class _Room:
+    __slots__ = ('lock', 'pending', 'last_sent')
+
+    def __init__(self):
+        self.lock = threading.Lock()  # also held while emitting, which keeps frames in order
+        self.pending = None           # held messages, oldest first
+        self.last_sent = float('-inf')
+
+
+class MessageCoalescer:
+    def __init__(self, window_fn, emit_fn, defer_fn, max_batch=MAX_BATCH, clock=time.monotonic):
+        self._window = window_fn  # window_fn(room) -> seconds; 0 sends everything at once
+        self._emit = emit_fn      # emit_fn(room, [payload, ...])
+        self._defer = defer_fn    # defer_fn(delay, fn, *args), as for presence.DeltaCoalescer
+        self.max_batch = max_batch
+        self._clock = clock
+        self._rooms = {}
+        self._rooms_lock = threading.Lock()
+
+    def _room(self, name):
+        room = self._rooms.get(name)
+        if room is None:
+            with self._rooms_lock:
+                room = self._rooms.setdefault(name, _Room())
+        return room
+
+    def publish(self, name, payload):
+        window = self._window(name)
+        room = self._room(name)
+        with room.lock:
+            now = self._clock()
+            if room.pending is None and (window <= 0 or now - room.last_sent >= window):
+                room.last_sent = now
+                self._send(name, [payload])
+                return
+            start = room.pending is None
+            if start:
+                room.pending = []
+            room.pending.append(payload)
+            if len(room.pending) >= self.max_batch:
+                batch, room.pending = room.pending, None
+                room.last_sent = now
+                self._send(name, batch)
+                return
+        if start:
+            self._defer(window, self.flush, name)
+
+    def flush(self, name):
+        room = self._room(name)
+        with room.lock:
+            batch, room.pending = room.pending, None
+            if batch:
+                room.last_sent = self._clock()
+                self._send(name, batch)
+
+    def _send(self, name, batch):
+        BATCH_SIZE.observe(len(batch))
+        self._emit(name, batch)
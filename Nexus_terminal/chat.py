@@ -0,0 +1,229 @@
+# chat.py - Socket.IO event logic shared by app.py and asgi_app.py
+#
+# One function per event: it validates the client's data, makes the db calls
+# and shapes the payloads, and returns what to emit. The servers own the rest:
+# sessions, rooms, presence, the coalescers, the cluster mirror and the emits
+# themselves. Everything here may block on SQLite or Argon2, so asgi_app.py
+# calls it from its executors; app.py calls it inline.
+import os
+from datetime import datetime
+
+import db
+import unread
+import room_history
+import ratelimit
+import throttle
+import web
+from auth_pool import AuthBusy
+
+# Joins/leaves are pushed to each room as one coalesced 'presence_delta' per
+# window; clients get the full roster only when they connect.
+PRESENCE_DELTA_WINDOW = 0.25  # seconds
+
+# Room messages: with a window (NEXUS_BROADCAST_WINDOW_MS, or a camp's own
+# "broadcast_window_ms" in basecamps.json) a burst in a room goes out as one
+# 'new_messages' frame per window instead of a 'new_message' per message
+# (broadcast.py). 0, the default, emits every message on its own.
+BROADCAST_WINDOW_MS = float(os.environ.get('NEXUS_BROADCAST_WINDOW_MS') or 0)
+
+# Private history is paged newest-first; clients ask for older pages on scroll
+PM_PAGE_SIZE = 30
+PM_PAGE_MAX = 100
+
+# Max partners answered per request_roster_state (keeps the IN list bounded)
+ROSTER_STATE_MAX = 400
+
+# Search (search_messages / search_private): page size; relevance paging
+# ends where db ranks no further (db.SEARCH_RANK_WINDOW)
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 50
+SEARCH_MAX_OFFSET = db.SEARCH_RANK_WINDOW
+SEARCH_QUERY_MAX = 200  # characters
+
+# Per-socket and per-user token buckets for the events clients can flood
+# (ratelimit.py; NEXUS_RATE_LIMIT=0 turns them off)
+RATE_LIMITER = ratelimit.Limiter()
+
+
+def broadcast_window(basecamp):
+    """Seconds a room's messages are held for one 'new_messages' frame (0: none)."""
+    info = web.load_basecamps().get(basecamp) or {}
+    return float(info.get('broadcast_window_ms', BROADCAST_WINDOW_MS) or 0) / 1000.0
+
+
+def _now():
+    return datetime.now().strftime('%H:%M:%S')
+
+
+def _int_or_none(value):
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _partner(data, field='with'):
+    return ((data or {}).get(field) or '').strip()
+
+
+def _dm_rows(rows):
+    return [{'id': h['id'], 'from': h['sender'], 'to': h['recipient'], 'message': h['message'],
+             'timestamp': h['timestamp']} for h in rows]
+
+
+def welcome(username, basecamp, basecamp_name):
+    """(event, payload) pairs a socket gets after joining its camp, after the roster."""
+    return [
+        ('system_message', {'message': f'Connected to {basecamp_name}. Communication channel open.',
+                            'timestamp': _now()}),
+        ('history', {'basecamp': basecamp, 'messages': room_history.recent(basecamp)}),
+        ('unread_counts', unread.counts(username)),
+    ]
+
+
+def trust_status(me, data):
+    """'trust_status' payload for the partner asked about, or None."""
+    partner = _partner(data)
+    if not partner:
+        return None
+    return {'with': partner, **db.get_trust_status(me, partner)}
+
+
+def roster_state(me, data):
+    """Trust flags + unread counts for every listed partner in one 'roster_state' payload."""
+    partners = []
+    for p in (data or {}).get('partners') or []:
+        if isinstance(p, str) and p.strip() and p.strip() != me:
+            partners.append(p.strip())
+    partners = list(dict.fromkeys(partners))[:ROSTER_STATE_MAX]
+    trust = db.get_trust_statuses(me, partners)
+    counts = unread.counts(me)
+    return {'states': {p: {**trust[p], 'unread': counts.get(p, 0)} for p in partners}}
+
+
+def submit_partner_code(me, data, remote_addr):
+    """Check a partner code behind the guess throttle.
+
+    Returns ('trust_status' payload for the caller, one for the partner or
+    None), or None for an incomplete request. Argon2 runs here.
+    """
+    partner = _partner(data)
+    code = ((data or {}).get('code') or '').strip()
+    if not partner or not code:
+        return None
+
+    keys = ('ip', remote_addr), ('pair', me), ('partner', partner)
+    with web.GUESS_THROTTLE.attempt('submit_partner_code', *keys) as attempt:
+        if attempt.retry:
+            return {'with': partner, **db.get_trust_status(me, partner), 'ok': False,
+                    'error': 'throttled', **throttle.reply(attempt.retry)}, None
+        try:
+            status = db.record_trust_if_code_matches(me, partner, code)  # -> ok / invalid_code + status flags
+        except AuthBusy:
+            return {'with': partner, **db.get_trust_status(me, partner), 'ok': False, 'error': 'busy'}, None
+        if status['ok']:
+            attempt.succeeded(*keys[1:])
+        else:
+            attempt.failed()
+    partner_view = status.pop('partner_view')
+    return {'with': partner, **status}, {'with': me, **partner_view}
+
+
+def room_message(username, basecamp, data):
+    """Store a camp message and add it to the room's history; its payload, or None if empty."""
+    message = ((data or {}).get('message') or '').strip()
+    if not message:
+        return None
+    payload = {
+        'id': db.add_message(username, basecamp, message),
+        'username': username,
+        'message': message,
+        'timestamp': _now()
+    }
+    room_history.append(basecamp, payload)  # in memory; rooms are warmed at startup
+    return payload
+
+
+def private_message(sender, data):
+    """('private_message', payload) once stored, ('trust_required', payload) without mutual trust, or None."""
+    recipient = _partner(data, 'to')
+    message = ((data or {}).get('message') or '').strip()
+    if not recipient or not message:
+        return None
+
+    # Enforce: cannot DM until mutual trust established
+    if not db.is_trusted(sender, recipient):
+        return 'trust_required', {'with': recipient, **db.get_trust_status(sender, recipient)}
+
+    pm_id = db.add_private_message(sender, recipient, message)
+    return 'private_message', {'id': pm_id, 'from': sender, 'to': recipient, 'message': message,
+                               'timestamp': _now()}
+
+
+def private_history(me, data):
+    """One page of DMs with a partner as a 'private_history' payload, or None."""
+    partner = _partner(data)
+    if not partner:
+        return None
+
+    status = db.get_trust_status(me, partner)
+    if not status['mutual']:
+        return {'with': partner, 'messages': [], 'trust': status}
+
+    before_id = _int_or_none(data.get('before_id'))
+    after_id = _int_or_none(data.get('after_id'))
+    limit = _int_or_none(data.get('limit')) or PM_PAGE_SIZE
+    limit = max(1, min(limit, PM_PAGE_MAX))
+
+    # Ask for one extra row to learn whether there is more in that direction
+    history = db.get_private_history(me, partner, limit=limit + 1, before_id=before_id, after_id=after_id)
+    has_more = len(history) > limit
+    if has_more:
+        history = history[:limit] if after_id is not None else history[1:]
+    return {'with': partner, 'messages': _dm_rows(history), 'trust': status,
+            'before_id': before_id, 'after_id': after_id, 'has_more': has_more}
+
+
+def mark_private_read(user, data):
+    """Mark a partner's DMs read; (up_to_id, 'unread_delta' payload), or None."""
+    partner = _partner(data)
+    if not partner:
+        return None
+    up_to_id = _int_or_none(data.get('up_to_id'))
+    db.mark_private_read(user, partner, up_to_id)
+    # send the caller just the count that changed
+    count = unread.on_read(user, partner, up_to_id)
+    return up_to_id, {'partner': partner, 'count': count or 0}
+
+
+def _search_paging(data):
+    """(query, limit, offset, before_id, order) from a search request, clamped."""
+    q = (data.get('q') or '').strip()[:SEARCH_QUERY_MAX]
+    limit = max(1, min(_int_or_none(data.get('limit')) or SEARCH_PAGE_SIZE, SEARCH_PAGE_MAX))
+    offset = max(0, min(_int_or_none(data.get('offset')) or 0, SEARCH_MAX_OFFSET))
+    order = 'recent' if data.get('order') == 'recent' else 'rank'
+    return q, limit, offset, _int_or_none(data.get('before_id')), order
+
+
+def search_messages(basecamp, data):
+    """'search_results' payload for a search of the camp's messages, or None."""
+    q, limit, offset, before_id, order = _search_paging(data or {})
+    if not q:
+        return None
+    # One extra row tells whether another page exists
+    hits = db.search_messages(basecamp, q, limit=limit + 1, offset=offset, before_id=before_id, order=order)
+    return {'scope': 'basecamp', 'q': q, 'order': order, 'offset': offset,
+            'before_id': before_id, 'has_more': len(hits) > limit, 'results': hits[:limit]}
+
+
+def search_private(me, data):
+    """'search_results' payload for a search of the caller's DMs, or None."""
+    data = data or {}
+    q, limit, offset, before_id, order = _search_paging(data)
+    if not q:
+        return None
+    partner = _partner(data) or None
+    hits = db.search_private(me, q, partner=partner, limit=limit + 1, offset=offset,
+                             before_id=before_id, order=order)
+    return {'scope': 'private', 'with': partner, 'q': q, 'order': order, 'offset': offset,
+            'before_id': before_id, 'has_more': len(hits) > limit, 'results': _dm_rows(hits[:limit])}
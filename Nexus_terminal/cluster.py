@@ -0,0 +1,146 @@
+# cluster.py - keeps each worker's in-memory state in step (multi-worker mode)
+#
+# Presence, the trust cache, unread counters and the room history rings all
+# live in process memory. With several workers behind one message bus
+# (message_bus.py), each worker publishes what it changed and applies what the
+# others publish:
+#
+#   presence     a local socket connected / left its room / disconnected
+#   hello        a worker started; everyone answers with a 'snapshot' of
+#                their own sockets so the newcomer's presence is complete
+#   hb           heartbeat; a worker not heard from for HOST_TIMEOUT is
+#                presumed dead and its sockets are dropped
+#   trust        a trust pair changed; others drop it from their cache
+#   unread       a DM was counted / read
+#   history      a room message was broadcast (for the history rings)
+#
+# Without a bus (single process) every call here is a no-op.
+import os
+import time
+import threading
+
+import db
+import room_history
+import unread
+
+# seconds between heartbeats, and silence after which a worker's sockets are dropped
+HEARTBEAT = float(os.environ.get('NEXUS_CLUSTER_HEARTBEAT') or 2.0)
+HOST_TIMEOUT = float(os.environ.get('NEXUS_CLUSTER_HOST_TIMEOUT') or 10.0)
+
+
+class Cluster:
+    def __init__(self, bus, registry, deltas, spawn_fn, sleep_fn):
+        self.bus = bus            # message_bus ClusterMixin manager, or None
+        self.registry = registry  # presence.PresenceRegistry
+        self.deltas = deltas      # presence.DeltaCoalescer
+        self._spawn = spawn_fn
+        self._sleep = sleep_fn
+        self._lock = threading.Lock()
+        self._seen = {}           # host_id -> monotonic time of its last message
+
+    @property
+    def enabled(self):
+        return self.bus is not None
+
+    def start(self):
+        if not self.enabled:
+            return
+        for kind in ('presence', 'hello', 'snapshot', 'hb', 'trust', 'unread', 'history'):
+            self.bus.subscribe(kind, getattr(self, '_on_' + kind))
+        self.bus.publish('hello', {})
+        self._spawn(self._heartbeat)
+
+    def publish(self, kind, payload):
+        if self.enabled:
+            self.bus.publish(kind, payload)
+
+    # -- what this worker tells the others -------------------------------------
+
+    def connected(self, sid, username, basecamp):
+        self.publish('presence', {'op': 'connect', 'sid': sid, 'username': username, 'basecamp': basecamp})
+
+    def left_room(self, sid):
+        self.publish('presence', {'op': 'leave', 'sid': sid})
+
+    def disconnected(self, sid):
+        self.publish('presence', {'op': 'disconnect', 'sid': sid})
+
+    def trust_changed(self, u1, u2):
+        self.publish('trust', {'users': [u1, u2]})
+
+    def dm_sent(self, recipient, sender, msg_id):
+        self.publish('unread', {'op': 'message', 'user': recipient, 'partner': sender, 'id': msg_id})
+
+    def dm_read(self, user, partner, up_to_id):
+        self.publish('unread', {'op': 'read', 'user': user, 'partner': partner, 'id': up_to_id})
+
+    def room_message(self, basecamp, entry):
+        self.publish('history', {'basecamp': basecamp, 'entry': entry})
+
+    # -- what the others tell us ----------------------------------------------
+
+    def _touch_host(self, host):
+        with self._lock:
+            self._seen[host] = time.monotonic()
+
+    def _on_presence(self, host, data):
+        self._touch_host(host)
+        sid = f"{host}:{data['sid']}"
+        if data['op'] == 'connect':
+            self.registry.connect(sid, data['username'], data['basecamp'], host=host)
+        elif data['op'] == 'leave':
+            self.registry.leave_room(sid)
+        elif data['op'] == 'disconnect':
+            info = self.registry.disconnect(sid)
+            if info and info[3]:
+                unread.forget(info[0])
+
+    def _on_hello(self, host, data):
+        self._touch_host(host)
+        conns = self.registry.local_conns()
+        if conns:
+            self.publish('snapshot', {'conns': conns})
+
+    def _on_snapshot(self, host, data):
+        self._touch_host(host)
+        for sid, username, basecamp in data['conns']:
+            self.registry.connect(f"{host}:{sid}", username, basecamp, host=host)
+
+    def _on_hb(self, host, data):
+        self._touch_host(host)
+
+    def _on_trust(self, host, data):
+        db.forget_trust(*data['users'])
+
+    def _on_unread(self, host, data):
+        if data['op'] == 'message':
+            unread.on_message(data['user'], data['partner'], data['id'])
+        else:
+            unread.on_read(data['user'], data['partner'], data['id'])
+
+    def _on_history(self, host, data):
+        room_history.append(data['basecamp'], data['entry'])
+
+    # -- liveness ---------------------------------------------------------------
+
+    def _heartbeat(self):
+        while True:
+            self.publish('hb', {})
+            self._sleep(HEARTBEAT)
+            now = time.monotonic()
+            with self._lock:
+                dead = [h for h, seen in self._seen.items() if now - seen > HOST_TIMEOUT]
+                for h in dead:
+                    del self._seen[h]
+                alive = set(self._seen)
+            leader = min(alive | {self.bus.host_id})
+            for host in dead:
+                self._drop(host, announce=leader == self.bus.host_id)
+
+    def _drop(self, host, announce):
+        # Every survivor drops the dead worker's sockets; one of them tells the rooms
+        for username, basecamp, last_in_room, last_overall in self.registry.drop_host(host):
+            if last_overall:
+                unread.forget(username)
+            if announce and basecamp and last_in_room:
+                self.deltas.touch(basecamp, username, was_present=True)
@@ -1,34 +1,127 @@
 # create_basecamp.py - admin helper to add basecamp codes
-import json
+import os
+import hmac
+import hashlib
+import secrets
+import tempfile
+import threading
 from pathlib import Path
 from getpass import getpass
 from argon2 import PasswordHasher
+from cred_store import basecamps_store
 
-USERS_FILE = Path("basecamps.json")
+# Secret key for the HMAC lookup tag stored next to each Argon2 hash. The tag
+# lets the server find the one camp a code can belong to, so a login attempt
+# costs at most one Argon2 verify no matter how many camps exist.
+# NEXUS_BASECAMP_LOOKUP_KEY (hex) overrides the key file. Each tag is stored
+# with the key's fingerprint ("lookup_key"), so tags made under a lost or
+# replaced key are known to be stale and the server still verifies those camps.
+LOOKUP_KEY_FILE = Path("basecamp_lookup.key")
 ph = PasswordHasher()
 
-def load():
-    if not USERS_FILE.exists():
-        return {}
-    return json.loads(USERS_FILE.read_text(encoding="utf-8"))
+_lookup_key = None
+_lookup_key_lock = threading.Lock()
+
+def _create_key_file() -> bytes:
+    """Write a new key, or return the one another thread/process got in first."""
+    key = secrets.token_bytes(32)
+    fd, tmp = tempfile.mkstemp(dir=LOOKUP_KEY_FILE.parent or ".", prefix=".lookup-key-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(key.hex())
+        # link() publishes the complete file or fails if one exists, so a
+        # concurrent reader never sees it half written
+        os.link(tmp, LOOKUP_KEY_FILE)
+        return key
+    except FileExistsError:
+        return bytes.fromhex(LOOKUP_KEY_FILE.read_text(encoding="utf-8").strip())
+    finally:
+        os.unlink(tmp)
+
+def lookup_key() -> bytes:
+    global _lookup_key
+    if _lookup_key is None:
+        with _lookup_key_lock:
+            if _lookup_key is None:
+                env = os.environ.get("NEXUS_BASECAMP_LOOKUP_KEY")
+                if env:
+                    _lookup_key = bytes.fromhex(env)
+                elif LOOKUP_KEY_FILE.exists():
+                    _lookup_key = bytes.fromhex(LOOKUP_KEY_FILE.read_text(encoding="utf-8").strip())
+                else:
+                    _lookup_key = _create_key_file()
+    return _lookup_key
+
+def lookup_key_id() -> str:
+    """Fingerprint of the current lookup key, stored next to every tag."""
+    return hmac.new(lookup_key(), b"nexus-lookup-key-id", hashlib.sha256).hexdigest()[:16]
+
+def has_current_tag(info) -> bool:
+    """True if the camp's tag was made with the current key (a tag miss is then definitive)."""
+    return bool(info.get("lookup")) and info.get("lookup_key") == lookup_key_id()
+
+def lookup_tag(code: str) -> str:
+    return hmac.new(lookup_key(), code.encode("utf-8"), hashlib.sha256).hexdigest()
 
-def save(data):
-    USERS_FILE.write_text(json.dumps(data, indent=2), encoding="utf-8")
+def load():
+    return basecamps_store.get()
 
 def create(id, name, code):
-    data = load()
-    if id in data:
-        raise SystemExit("id already exists")
-    data[id] = {"name": name, "scheme": "argon2", "hash": ph.hash(code)}
-    save(data)
+    entry = {"name": name, "scheme": "argon2", "hash": ph.hash(code),
+             "lookup": lookup_tag(code), "lookup_key": lookup_key_id()}
+
+    def apply(data):
+        if id in data:
+            raise SystemExit("id already exists")
+        data[id] = entry
+    basecamps_store.update(apply)
     print("Created basecamp", id)
 
+def add_lookup_tag(id, code) -> bool:
+    """Attach a lookup tag to an existing camp after checking `code` against its hash."""
+    info = load().get(id)
+    if not info or info.get("scheme") != "argon2":
+        return False
+    try:
+        ph.verify(info["hash"], code)
+    except Exception:
+        return False
+    tag, key_id = lookup_tag(code), lookup_key_id()
+
+    def apply(data):
+        if id in data:
+            data[id]["lookup"] = tag
+            data[id]["lookup_key"] = key_id
+    basecamps_store.update(apply)
+    return True
+
+def migrate():
+    """Add lookup tags to camps created before tags existed (or tagged under another key).
+
+    The tag needs the plaintext code, so this prompts for each untagged camp.
+    Camps left untagged still work: the server falls back to checking them one
+    by one and tags a camp the first time its code is entered successfully.
+    """
+    for id, info in load().items():
+        if has_current_tag(info) or info.get("scheme") != "argon2":
+            continue
+        code = getpass(f"code for '{id}' ({info.get('name')}), blank to skip: ")
+        if not code:
+            continue
+        if add_lookup_tag(id, code):
+            print("Tagged", id)
+        else:
+            print("Code does not match", id)
+
 if __name__ == "__main__":
     import sys
+    if len(sys.argv) >= 2 and sys.argv[1] == "--migrate":
+        migrate()
+        raise SystemExit(0)
+    code = None
     if len(sys.argv) >= 3:
         id = sys.argv[1]
         name = sys.argv[2]
-        code = None
         if len(sys.argv) >= 4:
             code = sys.argv[3]
     else:
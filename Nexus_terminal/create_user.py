@@ -1,5 +1,3 @@
-import json
-from pathlib import Path
 from getpass import getpass
 from argon2 import PasswordHasher
 from argon2.exceptions import VerifyMismatchError
@@ -8,28 +6,15 @@ import db  # <-- uses nexus_terminal.db to store the hashed pairing code
 ph = PasswordHasher()
 
 db.init_db()
-USERS_FILE = Path("users.json")
-
-def load_users():
-    if not USERS_FILE.exists():
-        return {}
-    return json.loads(USERS_FILE.read_text(encoding="utf-8"))
-
-def save_users(users):
-    USERS_FILE.write_text(json.dumps(users, indent=2), encoding="utf-8")
+db.import_users_json_if_empty()
 
 def create_user(username: str, password: str, role: str = "survivor"):
-    users = load_users()
-    if username in users:
+    if db.get_user(username):
         raise SystemExit(f"User '{username}' already exists.")
 
-    # Hash the login password with Argon2 and store in users.json
-    users[username] = {
-        "scheme": "argon2",
-        "hash": ph.hash(password),
-        "role": role,
-    }
-    save_users(users)
+    # Hash the login password with Argon2 and store it in the users table
+    if not db.add_user(username, "argon2", ph.hash(password), role):
+        raise SystemExit(f"User '{username}' already exists.")
 
     # Generate a unique pairing code and store ONLY its Argon2 hash in SQLite
     plain_code = db.generate_user_code()       # e.g., JF8L-ONSF-B54A
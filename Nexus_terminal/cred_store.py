@@ -0,0 +1,126 @@
+# cred_store.py - cached JSON credential files (basecamps.json)
+#
+# The file is parsed once and kept in memory. It is re-read only when its
+# inode, mtime or size changes (checked at most every STAT_INTERVAL seconds),
+# so logins do no file I/O. Writes go through update(): they are serialized by
+# a lock (plus an advisory file lock where the OS has one, for the admin
+# scripts), and land via temp file + rename so readers never see a torn file.
+import os
+import json
+import time
+import threading
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: in-process lock only
+    fcntl = None
+
+STAT_INTERVAL = 1.0  # seconds between freshness checks
+
+
+def write_json_atomic(path, data):
+    """Write `data` as JSON to `path` via a temp file in the same directory + rename."""
+    path = os.path.abspath(path)
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp',
+                               dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class JsonFileStore:
+    """In-memory view of a JSON object file with change detection and atomic writes."""
+
+    def __init__(self, path, stat_interval=STAT_INTERVAL):
+        self.path = path
+        self.stat_interval = stat_interval
+        self._lock = threading.RLock()
+        self._data = None
+        self._sig = None          # (inode, mtime_ns, size) of the loaded file
+        self._checked = 0.0
+        self._version = 0
+        self._derived = {}        # name -> (version, value)
+
+    def _stat_sig(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _load_locked(self, sig):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        self._data = data
+        self._sig = sig
+        self._version += 1
+
+    def _refresh(self, force=False):
+        now = time.monotonic()
+        if not force and self._data is not None and now - self._checked < self.stat_interval:
+            return
+        with self._lock:
+            self._checked = now
+            sig = self._stat_sig()
+            if self._data is None or sig != self._sig:
+                self._load_locked(sig)
+
+    def get(self) -> dict:
+        """Current contents. Treat as read-only; use update() to change it."""
+        self._refresh()
+        return self._data
+
+    def derive(self, name, builder):
+        """Return builder(data), recomputed only when the file contents change."""
+        data = self.get()
+        with self._lock:
+            cached = self._derived.get(name)
+            if cached and cached[0] == self._version:
+                return cached[1]
+            value = builder(data)
+            self._derived[name] = (self._version, value)
+            return value
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.path + '.lock', 'a') as lf:
+            fcntl.flock(lf.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lf.fileno(), fcntl.LOCK_UN)
+
+    def update(self, fn):
+        """Apply fn(data) to a fresh copy of the file and write it back atomically.
+
+        fn mutates the dict in place; its return value is passed back to the caller.
+        """
+        with self._lock, self._file_lock():
+            self._refresh(force=True)
+            data = json.loads(json.dumps(self._data))  # don't mutate what readers hold
+            result = fn(data)
+            write_json_atomic(self.path, data)
+            self._data = data
+            self._sig = self._stat_sig()
+            self._version += 1
+            return result
+
+
+basecamps_store = JsonFileStore('basecamps.json')
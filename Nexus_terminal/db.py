@@ -1,13 +1,98 @@
+import os
+import re
+import json
+import time
+import queue
+import atexit
+import logging
 import sqlite3
 import threading
 import secrets
+import unicodedata
+from contextlib import contextmanager
+from concurrent.futures import Future
 from argon2 import PasswordHasher
-from datetime import datetime
+from datetime import datetime, timezone
+import archive
+import auth_pool
+import metrics
+import trust_cache
+
+log = logging.getLogger(__name__)
 
 ph = PasswordHasher()
 
-# Thread-local storage for database connections
-local = threading.local()
+# Database file, resolved next to this module so it doesn't depend on the CWD
+DB_PATH = os.environ.get('NEXUS_DB_PATH') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nexus_terminal.db')
+
+# Pragma profiles applied to every connection. WAL lets readers run alongside
+# the writer; 'durable' trades write latency for fsync on every commit.
+PRAGMA_PROFILES = {
+    'default': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'cache_size': -16000,      # KiB, i.e. ~16 MiB per connection
+        'temp_store': 'MEMORY',
+        'wal_autocheckpoint': 1000,
+    },
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'busy_timeout': 5000,
+        'cache_size': -16000,
+        'temp_store': 'MEMORY',
+        'wal_autocheckpoint': 1000,
+    },
+}
+PRAGMA_PROFILE = os.environ.get('NEXUS_DB_PROFILE') or 'default'
+READER_POOL_SIZE = int(os.environ.get('NEXUS_DB_READERS') or 8)
+
+# One writer connection (serialized by a lock) plus a bounded pool of
+# read-only connections shared by all threads.
+_write_conn = None
+_write_conn_lock = threading.RLock()
+_readers = queue.LifoQueue()
+_readers_open = 0
+_readers_lock = threading.Lock()
+_readers_sem = threading.BoundedSemaphore(READER_POOL_SIZE)
+
+# Group commit for chat/DM inserts. One writer thread takes everything already
+# queued (up to WRITE_BATCH_ROWS) and commits it in a single transaction right
+# away: a lone row is never held back, and rows that queue up while a commit
+# is running share the next one. Only when it finds a burst (more than one row
+# waiting) does it wait up to WRITE_BATCH_MS for the rest of it. Every queued row carries a Future that resolves to its id (SQLite's
+# lastrowid) once the transaction has committed, or to the sqlite3.Error that
+# kept it out, which is also logged and counted. add_message and
+# add_private_message wait on it, so an id handed out is always on disk and
+# any number of processes can insert into the same tables. Set WRITE_BATCH_MS
+# to 0 to insert on the caller's thread instead.
+WRITE_BATCH_ROWS = int(os.environ.get('NEXUS_WRITE_BATCH_ROWS') or 256)
+WRITE_BATCH_MS = float(os.environ.get('NEXUS_WRITE_BATCH_MS') or 5)
+
+_write_q = queue.Queue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+
+# Retention: rows past their window move to compressed segment files here
+# (archive.py), indexed by the archive_segments table. Retired in batches of
+# ARCHIVE_BATCH_ROWS so the writer is never held for long.
+ARCHIVE_DIR = os.environ.get('NEXUS_ARCHIVE_DIR') or os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), 'archive')
+ARCHIVE_BATCH_ROWS = int(os.environ.get('NEXUS_ARCHIVE_BATCH_ROWS') or 2000)
+
+# Full-text search: FTS5 indexes over messages.message and
+# private_messages.message, kept current by triggers (so the write-behind
+# batches, deletes and the archiver need no extra code). FTS_ENABLED is False
+# when this SQLite was built without FTS5; searches then return nothing.
+FTS_ENABLED = True
+SEARCH_MAX_TERMS = 8
+# Relevance order ranks the newest SEARCH_RANK_WINDOW hits (see _rank), so a
+# common word costs a bounded walk instead of its whole doclist.
+SEARCH_RANK_WINDOW = int(os.environ.get('NEXUS_SEARCH_RANK_WINDOW') or 200)
+
+# Trust edges change rarely and are checked on every DM; keep them in memory.
+# Only this module writes trust_pairs, so updating the cache on write keeps it exact.
+_trust = trust_cache.TrustCache()
 
 ALPH = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"  # no I/O/0/1 to reduce confusion
 
@@ -35,17 +120,86 @@ def _dm_session_key(u1: str, u2: str) -> str:
     return f"{a}||{b}"
 
 
-def get_db():
-    """Get database connection for current thread"""
-    if not hasattr(local, 'connection'):
-        local.connection = sqlite3.connect('nexus_terminal.db', check_same_thread=False)
-        local.connection.row_factory = sqlite3.Row
-    return local.connection
+def _open_connection(read_only=False):
+    pragmas = PRAGMA_PROFILES[PRAGMA_PROFILE]
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False,
+                           timeout=pragmas.get('busy_timeout', 5000) / 1000.0)
+    conn.row_factory = sqlite3.Row
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name}={value}")
+    if read_only:
+        conn.execute("PRAGMA query_only=ON")
+    return conn
+
+
+@contextmanager
+def _writer():
+    """The single writer connection; commits on success, rolls back on error."""
+    global _write_conn
+    with _write_conn_lock:
+        if _write_conn is None:
+            _write_conn = _open_connection()
+        try:
+            yield _write_conn
+            if _write_conn.in_transaction:
+                _write_conn.commit()
+        except BaseException:
+            if _write_conn.in_transaction:
+                _write_conn.rollback()
+            raise
+
+
+@contextmanager
+def _reader():
+    """Borrow a read-only connection; blocks while READER_POOL_SIZE are in use."""
+    global _readers_open
+    _readers_sem.acquire()
+    conn = None
+    try:
+        try:
+            conn = _readers.get_nowait()
+        except queue.Empty:
+            conn = _open_connection(read_only=True)
+            with _readers_lock:
+                _readers_open += 1
+        yield conn
+    finally:
+        if conn is not None:
+            if conn.in_transaction:
+                conn.rollback()
+            _readers.put(conn)
+        _readers_sem.release()
+
+
+def close_all():
+    """Close the writer and every pooled reader (shutdown / tests)."""
+    global _write_conn, _readers_open
+    flush(5.0)
+    with _write_conn_lock:
+        if _write_conn is not None:
+            _write_conn.close()
+            _write_conn = None
+    while True:
+        try:
+            _readers.get_nowait().close()
+        except queue.Empty:
+            break
+    with _readers_lock:
+        _readers_open = 0
+
+
+def pool_stats() -> dict:
+    return {'readers_open': _readers_open, 'readers_idle': _readers.qsize(),
+            'reader_pool_size': READER_POOL_SIZE, 'profile': PRAGMA_PROFILE}
 
 
 def init_db():
     """Initialize database with required tables"""
-    conn = get_db()
+    with _writer() as conn:
+        _create_schema(conn)
+
+
+def _create_schema(conn):
     cursor = conn.cursor()
 
     cursor.execute("""
@@ -172,180 +326,810 @@ def init_db():
     """)
 
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_pm_session ON private_messages(session_key, id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pm_unread  ON private_messages(recipient, read_by_recipient)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_camp ON messages(basecamp, id)")
+    # Unread state is a per-conversation read cursor instead of a per-row flag:
+    # marking read is one upsert, and unread = ids above the cursor.
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='read_cursors'")
+    had_cursors = cursor.fetchone() is not None
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS read_cursors (
+            user         TEXT NOT NULL,
+            partner      TEXT NOT NULL,
+            last_read_id INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user, partner)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pm_inbox ON private_messages(recipient, sender, id)")
+    if not had_cursors:
+        # One-time migration from read_by_recipient flags
+        cursor.execute("""
+            INSERT OR IGNORE INTO read_cursors (user, partner, last_read_id)
+            SELECT recipient, sender, MAX(id)
+            FROM private_messages
+            WHERE read_by_recipient = 1
+            GROUP BY recipient, sender
+        """)
+    cursor.execute("DROP INDEX IF EXISTS idx_pm_unread")
+
+    # Login accounts (formerly users.json). scheme is 'argon2' for normal rows;
+    # 'sha256' / 'plain' only for legacy imports, upgraded on first login.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            username   TEXT PRIMARY KEY,
+            scheme     TEXT NOT NULL DEFAULT 'argon2',
+            hash       TEXT NOT NULL,
+            role       TEXT NOT NULL DEFAULT 'survivor',
+            joined     TEXT
+        )
+    """)
 
+    # Where archived rows went: one row per gzip member, i.e. per scope
+    # (basecamp or DM session key) per archive batch.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS archive_segments (
+            kind       TEXT NOT NULL,      -- 'messages' | 'private_messages'
+            scope      TEXT NOT NULL,      -- basecamp id | session_key
+            first_id   INTEGER NOT NULL,
+            last_id    INTEGER NOT NULL,
+            first_ts   TEXT,
+            last_ts    TEXT,
+            rows       INTEGER NOT NULL,
+            file       TEXT NOT NULL,      -- relative to ARCHIVE_DIR
+            offset     INTEGER NOT NULL,
+            length     INTEGER NOT NULL,
+            PRIMARY KEY (kind, scope, first_id)
+        ) WITHOUT ROWID
+    """)
+
+    _create_fts(cursor)
 
     conn.commit()
 
 
+def _create_fts(cursor):
+    """External-content FTS5 tables over the chat tables (index only, no copy of the text).
+
+    The scope column (basecamp / session_key) is indexed too so a search is
+    narrowed to one camp or one user's conversations inside the index.
+    """
+    global FTS_ENABLED
+    for table, scope in (('messages', 'basecamp'), ('private_messages', 'session_key')):
+        fts = table + '_fts'
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (fts,))
+        existed = cursor.fetchone() is not None
+        try:
+            cursor.execute(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+                    message, {scope}, content='{table}', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2'
+                )
+            """)
+        except sqlite3.OperationalError:
+            FTS_ENABLED = False  # no FTS5 in this SQLite build
+            return
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN
+                INSERT INTO {fts}(rowid, message, {scope}) VALUES (new.id, new.message, new.{scope});
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN
+                INSERT INTO {fts}({fts}, rowid, message, {scope}) VALUES ('delete', old.id, old.message, old.{scope});
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF message, {scope} ON {table} BEGIN
+                INSERT INTO {fts}({fts}, rowid, message, {scope}) VALUES ('delete', old.id, old.message, old.{scope});
+                INSERT INTO {fts}(rowid, message, {scope}) VALUES (new.id, new.message, new.{scope});
+            END
+        """)
+        if not existed:
+            # One-time index of the rows written before search existed
+            cursor.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+
+def _start_writer():
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is None:
+            _writer_thread = threading.Thread(target=_writer_loop, name='db-writer', daemon=True)
+            _writer_thread.start()
+
+
+def _write_failed(table, params, error):
+    metrics.DB_WRITE_FAILURES.inc(table)
+    log.error('queued write to %s failed and was not stored: %s; params=%r', table, error, params)
+
+
+def _write_batch(conn, rows):
+    """Commit rows [(table, sql, params, future)] in one transaction and resolve each future."""
+    try:
+        with conn:
+            ids = [conn.execute(sql, params).lastrowid for _, sql, params, _ in rows]
+    except sqlite3.Error:
+        # One bad row must not take the rest of the batch with it
+        for table, sql, params, future in rows:
+            try:
+                with conn:
+                    rowid = conn.execute(sql, params).lastrowid
+            except sqlite3.Error as e:
+                _write_failed(table, params, e)
+                future.set_exception(e)
+            else:
+                future.set_result(rowid)
+        return
+    for (_, _, _, future), rowid in zip(rows, ids):
+        future.set_result(rowid)
+
+
+def _writer_loop():
+    while True:
+        items = [_write_q.get()]
+        while len(items) < WRITE_BATCH_ROWS:
+            try:
+                items.append(_write_q.get_nowait())
+            except queue.Empty:
+                break
+        if len(items) > 1:
+            # A burst is arriving: give the rest of it WRITE_BATCH_MS to join this commit
+            deadline = time.monotonic() + WRITE_BATCH_MS / 1000.0
+            while len(items) < WRITE_BATCH_ROWS:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(_write_q.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        rows = [it for it in items if not isinstance(it, threading.Event)]
+        if rows:
+            try:
+                with _writer() as conn:
+                    _write_batch(conn, rows)
+            except Exception as e:  # couldn't even get the connection
+                for table, _, params, future in rows:
+                    if not future.done():
+                        _write_failed(table, params, e)
+                        future.set_exception(e)
+        for it in items:
+            if isinstance(it, threading.Event):
+                it.set()
+            _write_q.task_done()
+
+
+def _enqueue_write(table, sql, params) -> Future:
+    """Queue one row for the writer; the Future resolves to its id once committed."""
+    _start_writer()
+    future = Future()
+    _write_q.put((table, sql, params, future))
+    return future
+
+
+def flush(timeout=None) -> bool:
+    """Block until every write queued so far is committed. Returns False on timeout."""
+    if _writer_thread is None or _write_q.unfinished_tasks == 0:
+        return True
+    done = threading.Event()
+    _write_q.put(done)
+    return done.wait(timeout)
+
+
+atexit.register(close_all)
+
+
 def add_message(username, basecamp, message):
-    """Add a new message to the database"""
-    conn = get_db()
-    cursor = conn.cursor()
+    """Add a new message; returns its id once committed. Group-committed unless WRITE_BATCH_MS is 0."""
+    if WRITE_BATCH_MS <= 0:
+        with _writer() as conn:
+            cursor = conn.cursor()
 
-    cursor.execute('''
-                   INSERT INTO messages (username, basecamp, message)
-                   VALUES (?, ?, ?)
-                   ''', (username, basecamp, message))
+            cursor.execute('''
+                           INSERT INTO messages (username, basecamp, message)
+                           VALUES (?, ?, ?)
+                           ''', (username, basecamp, message))
 
-    conn.commit()
+            conn.commit()
+            return cursor.lastrowid
 
+    return _enqueue_write('messages', '''
+                          INSERT INTO messages (username, basecamp, message)
+                          VALUES (?, ?, ?)
+                          ''', (username, basecamp, message)).result()
 
-def get_recent_messages(basecamp, limit=50):
-    """Get recent messages for a basecamp"""
-    conn = get_db()
-    cursor = conn.cursor()
 
-    cursor.execute('''
-                   SELECT username, message, timestamp
-                   FROM messages
-                   WHERE basecamp = ?
-                   ORDER BY timestamp DESC
-                       LIMIT ?
-                   ''', (basecamp, limit))
+def get_recent_messages(basecamp, limit=50, before_id=None):
+    """Get the last `limit` messages for a basecamp (older than before_id if given), oldest first.
+
+    Walks idx_messages_camp; pages reaching past the hot table continue in the archive.
+    """
+    flush()
+    with _reader() as conn:
+        cursor = conn.cursor()
 
-    messages = cursor.fetchall()
-    return [dict(row) for row in reversed(messages)]
+        cursor.execute('''
+                       SELECT id, username, message, timestamp
+                       FROM messages
+                       WHERE basecamp = ? AND id < COALESCE(?, 9223372036854775807)
+                       ORDER BY id DESC
+                           LIMIT ?
+                       ''', (basecamp, before_id, limit))
+
+        messages = [dict(row) for row in reversed(cursor.fetchall())]
+        if len(messages) < limit:
+            bound = messages[0]['id'] if messages else before_id
+            messages = _archived_before(conn, 'messages', basecamp, bound, limit - len(messages)) + messages
+        return messages
 
 def add_private_message(sender: str, recipient: str, message: str):
-    conn = get_db()
-    cur = conn.cursor()
+    """Add a DM; returns its id once committed. Group-committed unless WRITE_BATCH_MS is 0."""
     key = _dm_session_key(sender, recipient)
-    cur.execute(
+    if WRITE_BATCH_MS <= 0:
+        with _writer() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "INSERT INTO private_messages (session_key, sender, recipient, message) VALUES (?,?,?,?)",
+                (key, sender, recipient, message)
+            )
+            conn.commit()
+            return cur.lastrowid
+
+    return _enqueue_write(
+        'private_messages',
         "INSERT INTO private_messages (session_key, sender, recipient, message) VALUES (?,?,?,?)",
         (key, sender, recipient, message)
-    )
-    conn.commit()
+    ).result()
 
-def get_private_history(user: str, partner: str, limit: int = 200):
-    """Return ordered history for the pair (oldest → newest)."""
-    conn = get_db()
-    cur = conn.cursor()
-    key = _dm_session_key(user, partner)
-    cur.execute("""
-        SELECT sender, recipient, message, timestamp
-        FROM private_messages
-        WHERE session_key = ?
-        ORDER BY id ASC
-        LIMIT ?
-    """, (key, limit))
-    return [dict(row) for row in cur.fetchall()]
-
-def mark_private_read(user: str, partner: str):
-    """Mark all messages to 'user' from 'partner' as read."""
-    conn = get_db()
-    cur = conn.cursor()
-    key = _dm_session_key(user, partner)
-    cur.execute("""
-        UPDATE private_messages
-        SET read_by_recipient = 1
-        WHERE session_key = ? AND recipient = ? AND read_by_recipient = 0
-    """, (key, user))
-    conn.commit()
+def get_private_history(user: str, partner: str, limit: int = 50, before_id: int = None, after_id: int = None):
+    """Return one page of history for the pair, ordered oldest → newest.
+
+    Keyset pagination over idx_pm_session(session_key, id):
+      - no cursor: the newest `limit` messages
+      - before_id: the `limit` messages just older than before_id (scrolling back)
+      - after_id:  the `limit` messages just newer than after_id (catching up)
+    Archived rows are always older than the hot ones, so a page that runs
+    off the old end of the table is completed from the archive.
+    """
+    flush()
+    with _reader() as conn:
+        cur = conn.cursor()
+        key = _dm_session_key(user, partner)
+        if after_id is not None:
+            older = _archived_after(conn, 'private_messages', key, after_id, limit)
+            cur.execute("""
+                SELECT id, sender, recipient, message, timestamp
+                FROM private_messages
+                WHERE session_key = ? AND id > ?
+                ORDER BY id ASC
+                LIMIT ?
+            """, (key, after_id, limit - len(older)))
+            return older + [dict(row) for row in cur.fetchall()]
+        if before_id is not None:
+            cur.execute("""
+                SELECT id, sender, recipient, message, timestamp
+                FROM private_messages
+                WHERE session_key = ? AND id < ?
+                ORDER BY id DESC
+                LIMIT ?
+            """, (key, before_id, limit))
+        else:
+            cur.execute("""
+                SELECT id, sender, recipient, message, timestamp
+                FROM private_messages
+                WHERE session_key = ?
+                ORDER BY id DESC
+                LIMIT ?
+            """, (key, limit))
+        rows = [dict(row) for row in reversed(cur.fetchall())]
+        if len(rows) < limit:
+            bound = rows[0]['id'] if rows else before_id
+            rows = _archived_before(conn, 'private_messages', key, bound, limit - len(rows)) + rows
+        return rows
+
+def mark_private_read(user: str, partner: str, up_to_id: int = None):
+    """Mark messages to 'user' from 'partner' as read, up to up_to_id (default: all).
+
+    A single upsert of the (user, partner) read cursor; the cursor never moves back.
+    up_to_id is clamped to the newest message from 'partner', so a cursor sent
+    from the future can't hide the DMs still to come.
+    """
+    if up_to_id is None:
+        flush()
+    with _writer() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO read_cursors (user, partner, last_read_id)
+            SELECT ?, ?, COALESCE(MIN(?, newest), newest, 0)
+            FROM (SELECT MAX(id) AS newest FROM private_messages WHERE recipient = ? AND sender = ?)
+            WHERE true
+            ON CONFLICT(user, partner) DO UPDATE SET last_read_id = MAX(last_read_id, excluded.last_read_id)
+        """, (user, partner, up_to_id, user, partner))
+        conn.commit()
+
+def get_unread_summary(user: str):
+    """Map partner → (unread count, newest unread id) for 'user' (messages above each read cursor).
+
+    Skip-scans idx_pm_inbox(recipient, sender, id) for the distinct senders,
+    then counts each one's range above its cursor: the cost follows the
+    number of partners and unread messages, not the whole inbox.
+    """
+    flush()
+    with _reader() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            WITH RECURSIVE senders(partner) AS (
+                SELECT MIN(sender) FROM private_messages WHERE recipient = :user
+                UNION ALL
+                SELECT (SELECT MIN(sender) FROM private_messages WHERE recipient = :user AND sender > partner)
+                FROM senders WHERE partner IS NOT NULL
+            )
+            SELECT partner,
+                   (SELECT COUNT(*) FROM private_messages
+                    WHERE recipient = :user AND sender = senders.partner
+                      AND id > COALESCE((SELECT last_read_id FROM read_cursors
+                                         WHERE user = :user AND read_cursors.partner = senders.partner), 0)) AS cnt,
+                   (SELECT MAX(id) FROM private_messages
+                    WHERE recipient = :user AND sender = senders.partner) AS last_id
+            FROM senders
+            WHERE partner IS NOT NULL
+        """, {'user': user})
+        rows = [row for row in cur.fetchall() if row["cnt"]]
+        return {row["partner"]: (row["cnt"], row["last_id"]) for row in rows}
 
 def get_unread_counts(user: str):
     """Map partner → unread count for 'user'."""
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT sender AS partner, COUNT(*) AS cnt
-        FROM private_messages
-        WHERE recipient = ? AND read_by_recipient = 0
-        GROUP BY sender
-    """, (user,))
-    rows = cur.fetchall()
-    return {row["partner"]: row["cnt"] for row in rows}
+    return {partner: cnt for partner, (cnt, _) in get_unread_summary(user).items()}
 
 def add_user_session(username, basecamp):
     """Add or update user session"""
-    conn = get_db()
-    cursor = conn.cursor()
+    with _writer() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute('''
-        INSERT OR REPLACE INTO user_sessions (username, basecamp, connected_at)
-        VALUES (?, ?, CURRENT_TIMESTAMP)
-    ''', (username, basecamp))
+        cursor.execute('''
+            INSERT OR REPLACE INTO user_sessions (username, basecamp, connected_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+        ''', (username, basecamp))
 
-    conn.commit()
+        conn.commit()
 
 
 def remove_user_session(username, basecamp):
     """Remove user session"""
-    conn = get_db()
-    cursor = conn.cursor()
+    with _writer() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute('''
-                   DELETE
-                   FROM user_sessions
-                   WHERE username = ?
-                     AND basecamp = ?
-                   ''', (username, basecamp))
+        cursor.execute('''
+                       DELETE
+                       FROM user_sessions
+                       WHERE username = ?
+                         AND basecamp = ?
+                       ''', (username, basecamp))
 
-    conn.commit()
+        conn.commit()
+
+
+def queue_user_session(username, basecamp, online: bool):
+    """Write-behind variant of add/remove_user_session (batched with chat inserts)."""
+    if online:
+        _enqueue_write('user_sessions', '''
+            INSERT OR REPLACE INTO user_sessions (username, basecamp, connected_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+        ''', (username, basecamp))
+    else:
+        _enqueue_write('user_sessions', 'DELETE FROM user_sessions WHERE username = ? AND basecamp = ?', (username, basecamp))
+
+
+def clear_user_sessions():
+    """Drop every persisted session (stale after a restart)."""
+    with _writer() as conn:
+        conn.execute('DELETE FROM user_sessions')
+        conn.commit()
 
 
 def get_online_users(basecamp):
     """Get list of online users in a basecamp"""
-    conn = get_db()
-    cursor = conn.cursor()
+    with _reader() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute('''
-                   SELECT username, connected_at
-                   FROM user_sessions
-                   WHERE basecamp = ?
-                   ORDER BY connected_at ASC
-                   ''', (basecamp,))
+        cursor.execute('''
+                       SELECT username, connected_at
+                       FROM user_sessions
+                       WHERE basecamp = ?
+                       ORDER BY connected_at ASC
+                       ''', (basecamp,))
 
-    users = cursor.fetchall()
-    return [dict(row) for row in users]
+        users = cursor.fetchall()
+        return [dict(row) for row in users]
 
 
 def cleanup_old_sessions():
     """Clean up old sessions (can be called periodically)"""
-    conn = get_db()
-    cursor = conn.cursor()
+    with _writer() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute('''
-                   DELETE
-                   FROM user_sessions
-                   WHERE connected_at < datetime('now', '-1 hour')
-                   ''')
+        cursor.execute('''
+                       DELETE
+                       FROM user_sessions
+                       WHERE connected_at < datetime('now', '-1 hour')
+                       ''')
 
-    conn.commit()
+        conn.commit()
 
 
 def get_message_count(basecamp):
     """Get total message count for a basecamp"""
-    conn = get_db()
-    cursor = conn.cursor()
+    flush()
+    with _reader() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute('''
-                   SELECT COUNT(*) as count
-                   FROM messages
-                   WHERE basecamp = ?
-                   ''', (basecamp,))
+        cursor.execute('''
+                       SELECT (SELECT COUNT(*) FROM messages WHERE basecamp = ?)
+                            + (SELECT COALESCE(SUM(rows), 0) FROM archive_segments
+                               WHERE kind = 'messages' AND scope = ?) as count
+                       ''', (basecamp, basecamp))
+
+        result = cursor.fetchone()
+        return result['count'] if result else 0
+
+# -- search -------------------------------------------------------------------
+
+_WORD = re.compile(r'\w+')
+
+
+def _query_words(text):
+    """[(word, is_prefix)] from user text; a trailing * marks a prefix (2+ chars)."""
+    words = []
+    for word in (text or '').split()[:SEARCH_MAX_TERMS]:
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if word:
+            words.append((word, prefix and len(word) >= 2))
+    return words
+
+
+def _fts_phrase(value):
+    # Quoted, so FTS5 operators typed by users are plain text
+    return '"' + value.replace('"', '""') + '"'
+
+
+def _fts_match(column, scope, words):
+    terms = ' AND '.join(_fts_phrase(w) + ('*' if prefix else '') for w, prefix in words)
+    return f"{column} : {_fts_phrase(scope)} AND message : ({terms})"
+
+
+def _tokens(text):
+    # Roughly what unicode61 remove_diacritics does: lowercase, strip accents
+    text = unicodedata.normalize('NFKD', text.lower())
+    return _WORD.findall(''.join(ch for ch in text if not unicodedata.combining(ch)))
+
+
+def _rank(rows, words, k1=1.2, b=0.75):
+    """Best match first: BM25 term-frequency weight with length normalisation.
+
+    Every row already contains every word (AND query), so only how often and
+    how densely they occur separates them; words are weighted equally instead
+    of by IDF, which would need a walk over each word's whole doclist.
+    """
+    if not rows:
+        return rows
+    query = []
+    for word, prefix in words:
+        toks = _tokens(word)
+        query += [(t, False) for t in toks[:-1]] + [(t, prefix) for t in toks[-1:]]
+    docs = [_tokens(r['message']) for r in rows]
+    avg = (sum(len(d) for d in docs) / len(docs)) or 1.0
+    scored = []
+    for row, doc in zip(rows, docs):
+        norm = k1 * (1 - b + b * len(doc) / avg)
+        score = 0.0
+        for tok, prefix in query:
+            tf = sum(1 for t in doc if t.startswith(tok)) if prefix else doc.count(tok)
+            score += tf * (k1 + 1) / (tf + norm)
+        scored.append((-score, -row['id'], row))
+    scored.sort(key=lambda s: s[:2])
+    return [row for _, _, row in scored]
+
+
+def search_messages(basecamp, text, limit=20, offset=0, before_id=None, order='rank'):
+    """Messages in one basecamp matching every word of `text`.
+
+    order='recent': newest first, paged with before_id (keyset).
+    order='rank': best match first among the newest SEARCH_RANK_WINDOW hits,
+    paged with offset.
+    Returns [{id, username, message, timestamp}]. Archived rows are not indexed.
+    """
+    words = _query_words(text)
+    if not FTS_ENABLED or not words:
+        return []
+    flush()
+    with _reader() as conn:
+        # The FTS walk is newest-first and stops at LIMIT; m.basecamp rechecks the
+        # scope exactly (the indexed scope column matches by token)
+        hits = [dict(row) for row in conn.execute("""
+            SELECT m.id, m.username, m.message, m.timestamp
+            FROM messages_fts f JOIN messages m ON m.id = f.rowid
+            WHERE messages_fts MATCH ? AND f.rowid < COALESCE(?, 9223372036854775807) AND m.basecamp = ?
+            ORDER BY f.rowid DESC
+            LIMIT ?
+        """, (_fts_match('basecamp', basecamp, words), before_id if order == 'recent' else None, basecamp,
+              limit if order == 'recent' else SEARCH_RANK_WINDOW))]
+    if order == 'recent':
+        return hits
+    return _rank(hits, words)[offset:offset + limit]
+
+
+def search_private(user, text, partner=None, limit=20, offset=0, before_id=None, order='rank'):
+    """DMs to or from `user` matching every word of `text`, only with mutually trusted partners.
+
+    `partner` narrows the search to one conversation. Paging as in search_messages.
+    Returns [{id, sender, recipient, message, timestamp}].
+    """
+    words = _query_words(text)
+    if not FTS_ENABLED or not words:
+        return []
+    key = _dm_session_key(user, partner) if partner else None
+    flush()
+    with _reader() as conn:
+        # trust_pairs.pair_key and session_key are the same "A||B" string
+        hits = [dict(row) for row in conn.execute("""
+            SELECT pm.id, pm.sender, pm.recipient, pm.message, pm.timestamp
+            FROM private_messages_fts f
+            JOIN private_messages pm ON pm.id = f.rowid
+            JOIN trust_pairs tp ON tp.pair_key = pm.session_key
+            WHERE private_messages_fts MATCH ? AND f.rowid < COALESCE(?, 9223372036854775807)
+              AND (pm.sender = ? OR pm.recipient = ?) AND pm.session_key = COALESCE(?, pm.session_key)
+              AND tp.a_trusts_b = 1 AND tp.b_trusts_a = 1
+            ORDER BY f.rowid DESC
+            LIMIT ?
+        """, (_fts_match('session_key', user, words), before_id if order == 'recent' else None, user, user, key,
+              limit if order == 'recent' else SEARCH_RANK_WINDOW))]
+    if order == 'recent':
+        return hits
+    return _rank(hits, words)[offset:offset + limit]
+
+
+# -- retention / archive ------------------------------------------------------
+
+def _archived_before(conn, kind, scope, before_id, limit):
+    """Up to `limit` archived rows of a scope older than before_id (None: newest), oldest first."""
+    if limit <= 0:
+        return []
+    cur = conn.execute("""
+        SELECT file, offset, length FROM archive_segments
+        WHERE kind = ? AND scope = ? AND first_id < COALESCE(?, 9223372036854775807)
+        ORDER BY first_id DESC
+    """, (kind, scope, before_id))
+    out = []
+    for seg in cur:
+        rows = [r for r in archive.read(ARCHIVE_DIR, seg['file'], seg['offset'], seg['length'])
+                if before_id is None or r['id'] < before_id]
+        out = rows[-(limit - len(out)):] + out
+        if len(out) >= limit:
+            break
+    return out
+
+
+def _archived_after(conn, kind, scope, after_id, limit):
+    """Up to `limit` archived rows of a scope newer than after_id, oldest first."""
+    cur = conn.execute("""
+        SELECT file, offset, length FROM archive_segments
+        WHERE kind = ? AND scope = ? AND last_id > ?
+        ORDER BY first_id ASC
+    """, (kind, scope, after_id))
+    out = []
+    for seg in cur:
+        out += [r for r in archive.read(ARCHIVE_DIR, seg['file'], seg['offset'], seg['length'])
+                if r['id'] > after_id][:limit - len(out)]
+        if len(out) >= limit:
+            break
+    return out
+
+
+def _retire(kind, rows_by_scope):
+    """Append rows to the archive, then index them and delete them in one transaction."""
+    members = archive.append(ARCHIVE_DIR, kind, rows_by_scope)
+    with _writer() as conn:
+        conn.executemany("""
+            INSERT OR REPLACE INTO archive_segments
+                (kind, scope, first_id, last_id, first_ts, last_ts, rows, file, offset, length)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [(kind, scope, rows_by_scope[scope][0]['id'], rows_by_scope[scope][-1]['id'],
+               rows_by_scope[scope][0]['timestamp'], rows_by_scope[scope][-1]['timestamp'],
+               len(rows_by_scope[scope]), file, offset, length)
+              for scope, file, offset, length in members])
+        conn.executemany(f"DELETE FROM {kind} WHERE id = ?",
+                         [(r['id'],) for rows in rows_by_scope.values() for r in rows])
+        conn.commit()
+
+
+def _expired_prefix(rows, cutoff):
+    """Leading rows (oldest first) whose timestamp is before cutoff."""
+    n = 0
+    while n < len(rows) and (rows[n]['timestamp'] or '') < cutoff:
+        n += 1
+    return rows[:n]
+
+
+def _cutoff(days):
+    # Same format as CURRENT_TIMESTAMP (UTC), so it compares as a string
+    return datetime.fromtimestamp(time.time() - days * 86400, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
 
-    result = cursor.fetchone()
-    return result['count'] if result else 0
+
+def archive_expired(camp_days=None, default_days=0, dm_days=0, pause=None) -> dict:
+    """Move rows past their retention window from the hot tables into the archive.
+
+    camp_days maps basecamp -> days for camps with their own policy; other
+    camps use default_days and DMs use dm_days (0 keeps rows forever).
+    Works oldest-first in batches of ARCHIVE_BATCH_ROWS, calling pause()
+    between batches. Returns the number of rows moved per table (zeros if
+    another process is archiving right now).
+    """
+    moved = {'messages': 0, 'private_messages': 0}
+    with archive.exclusive(ARCHIVE_DIR) as ok:
+        if ok:
+            _archive_pass(camp_days or {}, default_days, dm_days, pause, moved)
+    return moved
+
+
+def _archive_pass(camp_days, default_days, dm_days, pause, moved):
+    flush()
+    with _reader() as conn:
+        # Distinct camps by hopping idx_messages_camp instead of scanning it
+        camps = [r[0] for r in conn.execute("""
+            WITH RECURSIVE c(b) AS (
+                SELECT MIN(basecamp) FROM messages
+                UNION ALL
+                SELECT (SELECT MIN(basecamp) FROM messages WHERE basecamp > c.b) FROM c WHERE c.b IS NOT NULL
+            )
+            SELECT b FROM c WHERE b IS NOT NULL
+        """)]
+
+    for camp in camps:
+        days = camp_days.get(camp) or default_days
+        if not days:
+            continue
+        cutoff = _cutoff(days)
+        while True:
+            with _reader() as conn:
+                rows = [dict(r) for r in conn.execute("""
+                    SELECT id, username, message, timestamp FROM messages
+                    WHERE basecamp = ? ORDER BY id LIMIT ?
+                """, (camp, ARCHIVE_BATCH_ROWS))]
+            expired = _expired_prefix(rows, cutoff)
+            if expired:
+                _retire('messages', {camp: expired})
+                moved['messages'] += len(expired)
+            if len(expired) < ARCHIVE_BATCH_ROWS:
+                break
+            if pause:
+                pause()
+
+    if dm_days:
+        # Unread DMs stay hot, or get_unread_summary would stop counting them.
+        # A conversation is archived only up to its first unread row: its hot
+        # rows stay one contiguous tail, which history paging relies on.
+        cutoff = _cutoff(dm_days)
+        after, held = -2 ** 63, set()  # any rowid
+        while True:
+            with _reader() as conn:
+                rows = [dict(r) for r in conn.execute("""
+                    SELECT id, session_key, sender, recipient, message, timestamp,
+                           COALESCE((SELECT last_read_id FROM read_cursors
+                                     WHERE read_cursors.user = private_messages.recipient
+                                       AND read_cursors.partner = private_messages.sender), 0) AS read_up_to
+                    FROM private_messages WHERE id > ? ORDER BY id LIMIT ?
+                """, (after, ARCHIVE_BATCH_ROWS))]
+            expired = _expired_prefix(rows, cutoff)
+            by_session = {}
+            for r in expired:
+                key, read_up_to = r.pop('session_key'), r.pop('read_up_to')
+                if read_up_to < r['id']:
+                    held.add(key)
+                if key not in held:
+                    by_session.setdefault(key, []).append(r)
+            if by_session:
+                _retire('private_messages', by_session)
+                moved['private_messages'] += sum(len(v) for v in by_session.values())
+            if len(expired) < ARCHIVE_BATCH_ROWS:
+                break
+            after = expired[-1]['id']
+            if pause:
+                pause()
+
+
+def get_user(username: str):
+    """Single-row account lookup: Row(username, scheme, hash, role, joined) or None."""
+    with _reader() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT username, scheme, hash, role, joined FROM users WHERE username=?", (username,))
+        return cur.fetchone()
+
+def add_user(username: str, scheme: str, pw_hash: str, role: str = "survivor", joined: str = None) -> bool:
+    """Insert a new account. Returns False if the username is taken."""
+    joined = joined or datetime.now().strftime('%Y-%m-%d')
+    with _writer() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO users (username, scheme, hash, role, joined)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(username) DO NOTHING
+        """, (username, scheme, pw_hash, role, joined))
+        conn.commit()
+        return cur.rowcount == 1
+
+def set_user_password_hash(username: str, pw_hash: str, scheme: str = "argon2"):
+    """Replace the stored credential for an existing account (e.g. legacy -> Argon2)."""
+    with _writer() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE users SET scheme=?, hash=? WHERE username=?", (scheme, pw_hash, username))
+        conn.commit()
+
+def _legacy_user_row(username, rec):
+    if not isinstance(rec, dict):
+        return None
+    if rec.get('scheme') == 'argon2' and rec.get('hash'):
+        scheme, pw_hash = 'argon2', rec['hash']
+    elif rec.get('password'):
+        scheme, pw_hash = 'sha256', rec['password']
+    elif rec.get('real_password') is not None:
+        scheme, pw_hash = 'plain', rec['real_password']
+    else:
+        return None
+    return username, scheme, pw_hash, rec.get('role') or 'survivor', rec.get('joined')
+
+def import_users_json(paths=('users.json', 'nocode_users.json')) -> int:
+    """One-shot import of the old JSON account files into the users table.
+
+    Existing rows are never overwritten, so earlier paths win and re-running is
+    harmless. Returns the number of accounts added.
+    """
+    rows = []
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        rows.extend(r for r in (_legacy_user_row(u, rec) for u, rec in data.items()) if r)
+    with _writer() as conn:
+        cur = conn.cursor()
+        before = conn.total_changes
+        cur.executemany("""
+            INSERT INTO users (username, scheme, hash, role, joined)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(username) DO NOTHING
+        """, rows)
+        conn.commit()
+        return conn.total_changes - before
+
+def import_users_json_if_empty() -> int:
+    """Run import_users_json() only while the users table is still empty."""
+    with _reader() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT 1 FROM users LIMIT 1")
+        if cur.fetchone():
+            return 0
+    return import_users_json()
 
 def set_user_code_hash(username: str, code_plain: str):
     """Store Argon2 hash of the canonicalized code for the user."""
     canon = _canonicalize(code_plain)
     code_hash = ph.hash(canon)
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO user_codes (username, scheme, code_hash)
-        VALUES (?, 'argon2', ?)
-        ON CONFLICT(username) DO UPDATE SET scheme='argon2', code_hash=excluded.code_hash
-    """, (username, code_hash))
-    conn.commit()
+    with _writer() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO user_codes (username, scheme, code_hash)
+            VALUES (?, 'argon2', ?)
+            ON CONFLICT(username) DO UPDATE SET scheme='argon2', code_hash=excluded.code_hash
+        """, (username, code_hash))
+        conn.commit()
 
 def get_user_code_hash(username: str):
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT scheme, code_hash FROM user_codes WHERE username=?", (username,))
-    return cur.fetchone()  # Row or None
+    with _reader() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT scheme, code_hash FROM user_codes WHERE username=?", (username,))
+        return cur.fetchone()  # Row or None
 
 def verify_partner_code(username: str, code_entered: str) -> bool:
+    """Check a pairing code in the auth pool. Raises auth_pool.AuthBusy when saturated or unavailable."""
     rec = get_user_code_hash(username)
     if not rec:
         return False
@@ -353,52 +1137,118 @@ def verify_partner_code(username: str, code_entered: str) -> bool:
     code_hash = rec["code_hash"]
     if scheme != "argon2":
         return False
-    try:
-        ph.verify(code_hash, _canonicalize(code_entered))
-        return True
-    except Exception:
-        return False
+    return auth_pool.verify(code_hash, _canonicalize(code_entered))
 
 def ensure_trust_row(u1: str, u2: str):
     a, b, key = _pair_order(u1, u2)
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO trust_pairs (pair_key, a, b) VALUES (?,?,?)", (key, a, b))
-    conn.commit()
+    with _writer() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT OR IGNORE INTO trust_pairs (pair_key, a, b) VALUES (?,?,?)", (key, a, b))
+        conn.commit()
+
+def _trust_flags(key: str) -> int:
+    """Packed trust flags for a pair key; served from the trust cache, read through on a miss."""
+    flags = _trust.get(key)
+    if flags is None:
+        generation = _trust.generation()  # before the SELECT; see trust_cache.fill
+        with _reader() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT a_trusts_b, b_trusts_a FROM trust_pairs WHERE pair_key=?", (key,))
+            row = cur.fetchone()
+        flags = trust_cache.pack(row["a_trusts_b"], row["b_trusts_a"]) if row else 0
+        _trust.fill(key, flags, generation)
+    return flags
+
+def _status_from_flags(u1: str, a: str, flags: int) -> dict:
+    if u1 == a:
+        me, partner = flags & trust_cache.A_TRUSTS_B, flags & trust_cache.B_TRUSTS_A
+    else:
+        me, partner = flags & trust_cache.B_TRUSTS_A, flags & trust_cache.A_TRUSTS_B
+    return {"me_trusts_partner": bool(me), "partner_trusts_me": bool(partner), "mutual": bool(me and partner)}
+
+def warm_trust_cache() -> int:
+    """Preload trust_pairs into the trust cache (up to its size bound)."""
+    generation = _trust.generation()
+    with _reader() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pair_key, a_trusts_b, b_trusts_a FROM trust_pairs LIMIT ?", (_trust.max_pairs,))
+        _trust.warm(cur.fetchall(), generation)
+    return len(_trust)
+
+def forget_trust(u1: str, u2: str):
+    """Drop a pair from the trust cache (another worker changed it); re-read on next use."""
+    _trust.invalidate(_pair_order(u1, u2)[2])
 
 def is_trusted(u1: str, u2: str) -> bool:
     a, b, key = _pair_order(u1, u2)
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT a_trusts_b, b_trusts_a FROM trust_pairs WHERE pair_key=?", (key,))
-    row = cur.fetchone()
-    return bool(row and row["a_trusts_b"] and row["b_trusts_a"])
+    flags = _trust_flags(key)
+    return flags == trust_cache.A_TRUSTS_B | trust_cache.B_TRUSTS_A
 
 def get_trust_status(u1: str, u2: str) -> dict:
     a, b, key = _pair_order(u1, u2)
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT a_trusts_b, b_trusts_a FROM trust_pairs WHERE pair_key=?", (key,))
-    row = cur.fetchone()
-    if not row:
-        return {"me_trusts_partner": False, "partner_trusts_me": False, "mutual": False}
-    if u1 == a:
-        me, partner = row["a_trusts_b"], row["b_trusts_a"]
-    else:
-        me, partner = row["b_trusts_a"], row["a_trusts_b"]
-    return {"me_trusts_partner": bool(me), "partner_trusts_me": bool(partner), "mutual": bool(me and partner)}
+    return _status_from_flags(u1, a, _trust_flags(key))
+
+def get_trust_statuses(me: str, partners) -> dict:
+    """Batch get_trust_status: partner → status dict.
+
+    Cached pairs cost nothing; the rest are read in one query over idx_trust_a/idx_trust_b.
+    """
+    partners = list(dict.fromkeys(partners))
+    out = {}
+    misses = []
+    for p in partners:
+        a, b, key = _pair_order(me, p)
+        flags = _trust.get(key)
+        if flags is None:
+            misses.append(p)
+        else:
+            out[p] = _status_from_flags(me, a, flags)
+    if not misses:
+        return out
+    marks = ','.join('?' * len(misses))
+    generation = _trust.generation()
+    with _reader() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT pair_key, a, b, a_trusts_b, b_trusts_a FROM trust_pairs
+            WHERE (a = ? AND b IN ({marks})) OR (b = ? AND a IN ({marks}))
+        """, (me, *misses, me, *misses))
+        rows = {row["pair_key"]: row for row in cur.fetchall()}
+    for p in misses:
+        a, b, key = _pair_order(me, p)
+        row = rows.get(key)
+        flags = trust_cache.pack(row["a_trusts_b"], row["b_trusts_a"]) if row else 0
+        _trust.fill(key, flags, generation)
+        out[p] = _status_from_flags(me, a, flags)
+    return out
 
 def record_trust_if_code_matches(enterer: str, partner: str, code_entered: str) -> dict:
-    """Mark directional trust enterer→partner only if code matches partner's hashed code."""
+    """Mark directional trust enterer→partner only if code matches partner's hashed code.
+
+    The row is created-or-updated by one upsert and read back in the same
+    transaction (one commit). Concurrent pairings of the same two users each
+    set only their own direction, so neither can clobber the other.
+    Returns the enterer's view plus the partner's view under "partner_view".
+    """
+    a, b, key = _pair_order(enterer, partner)
     if not verify_partner_code(partner, code_entered):
-        status = get_trust_status(enterer, partner)
-        status.update({"ok": False, "error": "invalid_code"})
+        flags = _trust_flags(key)
+        status = _status_from_flags(enterer, a, flags)
+        status.update({"ok": False, "error": "invalid_code", "partner_view": _status_from_flags(partner, a, flags)})
         return status
-    ensure_trust_row(enterer, partner)
-    a, b, key = _pair_order(enterer, partner)
-    conn = get_db(); cur = conn.cursor()
-    if enterer == a:
-        cur.execute("UPDATE trust_pairs SET a_trusts_b=1 WHERE pair_key=?", (key,))
-    else:
-        cur.execute("UPDATE trust_pairs SET b_trusts_a=1 WHERE pair_key=?", (key,))
-    conn.commit()
-    status = get_trust_status(enterer, partner)
-    status.update({"ok": True})
+    column = "a_trusts_b" if enterer == a else "b_trusts_a"
+    with _writer() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            INSERT INTO trust_pairs (pair_key, a, b, {column}) VALUES (?,?,?,1)
+            ON CONFLICT(pair_key) DO UPDATE SET {column}=1
+        """, (key, a, b))
+        cur.execute("SELECT a_trusts_b, b_trusts_a FROM trust_pairs WHERE pair_key=?", (key,))
+        row = cur.fetchone()
+        conn.commit()
+    # write-through so the DM path sees the new edge immediately
+    flags = trust_cache.pack(row["a_trusts_b"], row["b_trusts_a"])
+    _trust.put(key, flags)
+    status = _status_from_flags(enterer, a, flags)
+    status.update({"ok": True, "partner_view": _status_from_flags(partner, a, flags)})
     return status
@@ -0,0 +1,448 @@
+# dbbench.py - synthetic dataset generator + micro-benchmarks for db.py
+#
+#   python dbbench.py generate --db /tmp/bench.db --users 100000 --messages 10000000
+#   python dbbench.py run --db /tmp/bench.db --json bench.json
+#
+# `generate` fills a separate database (never the live one) with users,
+# user_codes, trust_pairs, messages, private_messages, read_cursors and
+# user_sessions. Who talks and which rooms are busy follow a Zipf
+# distribution (--skew), so there are a few very hot users and camps and a
+# long cold tail, like a real deployment.
+#
+# `run` times each db.py read path (and, with --writes, the write paths)
+# against hot and cold arguments, prints p50/p95/p99 per call, and prints the
+# EXPLAIN QUERY PLAN of every statement a function issued, flagging full
+# table scans. --fail-on-scan makes it exit non-zero when one is found, so a
+# query change can be checked in CI. Post the numbers with schema/query PRs.
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import itertools
+from bisect import bisect_left
+from collections import defaultdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LIVE_DB = os.path.join(HERE, 'nexus_terminal.db')
+BATCH = 50000  # rows per executemany / transaction while generating
+
+# One placeholder Argon2 string for every generated account and pairing code;
+# the benchmark never verifies them.
+FAKE_HASH = '$argon2id$v=19$m=65536,t=3,p=4$YmVuY2hzYWx0$YmVuY2hoYXNoYmVuY2hoYXNoYmVuY2hoYXNo'
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+def user_name(i):
+    return f'U{i:07d}'
+
+
+def camp_name(i):
+    return f'camp{i:04d}'
+
+
+class Zipf:
+    """Sampler over ranks 0..n-1 with P(rank r) proportional to 1 / (r + 1) ** s."""
+
+    def __init__(self, n, s, rng):
+        self.n = n
+        self.rng = rng
+        total = 0.0
+        self.cum = []
+        for r in range(n):
+            total += 1.0 / (r + 1) ** s
+            self.cum.append(total)
+        self.total = total
+
+    def sample(self, k):
+        cum, total, rand = self.cum, self.total, self.rng.random
+        return [bisect_left(cum, rand() * total) for _ in range(k)]
+
+
+# -- generate -----------------------------------------------------------------
+
+COMMON_WORDS = ('ping', 'status', 'copy', 'that', 'moving', 'out', 'water', 'low', 'north', 'gate',
+                'radio', 'check', 'all', 'clear', 'need', 'meds', 'signal', 'lost')
+
+
+def vocabulary(size=20000):
+    """Words of the generated chat, most frequent first (deterministic, so `run` can rebuild it)."""
+    rng = random.Random(7)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = list(COMMON_WORDS)
+    while len(words) < size:
+        words.append(''.join(rng.choice(letters) for _ in range(rng.randint(3, 9))))
+    return words
+
+
+def _ts(epoch):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(epoch))
+
+
+def _batched(it, n=BATCH):
+    it = iter(it)
+    while True:
+        chunk = list(itertools.islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
+
+def generate(args):
+    path = os.path.abspath(args.db)
+    if path == LIVE_DB:
+        raise SystemExit('refusing to fill the live nexus_terminal.db; pass another --db')
+    if os.path.exists(path) and not args.append:
+        raise SystemExit(f'{path} exists; remove it or pass --append')
+
+    # Build the schema exactly as the server does
+    os.environ['NEXUS_DB_PATH'] = path
+    sys.path.insert(0, HERE)
+    import db
+    db.init_db()
+    db.close_all()
+
+    rng = random.Random(args.seed)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('PRAGMA cache_size=-262144')
+    t_start = time.time()
+    users = Zipf(args.users, args.skew, rng)
+    camps = Zipf(args.basecamps, args.skew, rng)
+    vocab = vocabulary()
+    word = Zipf(len(vocab), 1.0, rng)  # word frequencies of natural text are roughly Zipf too
+    texts = [' '.join(vocab[w] for w in word.sample(rng.randint(1, 12))) for _ in range(20000)]
+    now = time.time()
+    span = args.days * 86400.0
+
+    def step(label, started):
+        print(f'  {label:18} {time.time() - started:8.1f}s', file=sys.stderr)
+
+    t = time.time()
+    rows = ((user_name(i), 'argon2', FAKE_HASH, 'survivor', '2087-01-01') for i in range(args.users))
+    for chunk in _batched(rows):
+        conn.executemany('INSERT OR IGNORE INTO users (username, scheme, hash, role, joined) VALUES (?,?,?,?,?)', chunk)
+        conn.commit()
+    rows = ((user_name(i), 'argon2', FAKE_HASH) for i in range(args.users))
+    for chunk in _batched(rows):
+        conn.executemany('INSERT OR IGNORE INTO user_codes (username, scheme, code_hash) VALUES (?,?,?)', chunk)
+        conn.commit()
+    step('users/user_codes', t)
+
+    # Trust graph: every user pairs with a few partners; popular users collect many pairs
+    t = time.time()
+    partners = defaultdict(list)
+    pair_rows = {}
+    for u in range(args.users):
+        for p in users.sample(args.pairs_per_user):
+            if p == u:
+                continue
+            a, b = sorted((user_name(u), user_name(p)))
+            key = f'{a}||{b}'
+            if key in pair_rows:
+                continue
+            r = rng.random()
+            flags = (1, 1) if r < args.mutual else ((1, 0) if r < (1 + args.mutual) / 2 else (0, 1))
+            pair_rows[key] = (key, a, b, *flags)
+            if flags == (1, 1):
+                partners[u].append(p)
+                partners[p].append(u)
+    for chunk in _batched(pair_rows.values()):
+        conn.executemany('INSERT OR IGNORE INTO trust_pairs (pair_key, a, b, a_trusts_b, b_trusts_a) '
+                         'VALUES (?,?,?,?,?)', chunk)
+        conn.commit()
+    step(f'trust_pairs {len(pair_rows)}', t)
+
+    t = time.time()
+    n = args.messages
+    for start in range(0, n, BATCH):
+        k = min(BATCH, n - start)
+        us, cs = users.sample(k), camps.sample(k)
+        chunk = [(user_name(us[j]), camp_name(cs[j]), texts[(start + j) % len(texts)],
+                  _ts(now - span + span * (start + j) / n)) for j in range(k)]
+        conn.executemany('INSERT INTO messages (username, basecamp, message, timestamp) VALUES (?,?,?,?)', chunk)
+        conn.commit()
+    step(f'messages {n}', t)
+
+    t = time.time()
+    senders = [u for u in range(args.users) if partners[u]]
+    n = args.private if senders else 0
+    sender_pick = Zipf(len(senders), args.skew, rng) if senders else None
+    for start in range(0, n, BATCH):
+        k = min(BATCH, n - start)
+        chunk = []
+        for j, si in enumerate(sender_pick.sample(k)):
+            s = senders[si]
+            r = rng.choice(partners[s])
+            a, b = sorted((user_name(s), user_name(r)))
+            chunk.append((f'{a}||{b}', user_name(s), user_name(r), texts[(start + j) % len(texts)],
+                          _ts(now - span + span * (start + j) / n)))
+        conn.executemany('INSERT INTO private_messages (session_key, sender, recipient, message, timestamp) '
+                         'VALUES (?,?,?,?,?)', chunk)
+        conn.commit()
+    step(f'private_messages {n}', t)
+
+    # Most conversations are read up to near the end; some are far behind
+    t = time.time()
+    conn.execute("""
+        INSERT OR REPLACE INTO read_cursors (user, partner, last_read_id)
+        SELECT recipient, sender, MAX(id) - (abs(random()) % 50)
+        FROM private_messages GROUP BY recipient, sender
+        HAVING abs(random()) % 100 < ?
+    """, (int(args.read_ratio * 100),))
+    conn.commit()
+    step('read_cursors', t)
+
+    t = time.time()
+    online = {(user_name(u), camp_name(c)) for u, c in zip(users.sample(args.online), camps.sample(args.online))}
+    conn.executemany('INSERT OR IGNORE INTO user_sessions (username, basecamp) VALUES (?,?)', list(online))
+    conn.commit()
+    step(f'user_sessions {len(online)}', t)
+
+    if args.analyze:
+        t = time.time()
+        conn.execute('ANALYZE')
+        conn.commit()
+        step('analyze', t)
+    conn.close()
+    print(f'generated {path} in {time.time() - t_start:.1f}s', file=sys.stderr)
+
+
+# -- run ------------------------------------------------------------------------
+
+class Capture:
+    """Records the SQL db.py sends while `on` is set (via sqlite3 trace callbacks)."""
+
+    def __init__(self):
+        self.on = False
+        self.statements = []
+
+    def __call__(self, sql):
+        if self.on and "'main'." not in sql:  # skip FTS5's own bookkeeping statements
+            head = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+            if head in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE'):
+                self.statements.append(sql)
+
+
+def _plan(conn, sql):
+    """EXPLAIN QUERY PLAN rows as indented lines, plus the full table scans among them.
+
+    SCAN CONSTANT ROW, scans of a CTE or subquery (named by an earlier
+    CO-ROUTINE / MATERIALIZE node) and FTS5 lookups (SCAN ... VIRTUAL TABLE)
+    read no stored table, so they are not counted.
+    """
+    rows = conn.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+    depth = {0: -1}
+    lines, scans, derived = [], [], set()
+    for node, parent, _, detail in rows:
+        depth[node] = depth.get(parent, -1) + 1
+        lines.append('  ' * depth[node] + detail)
+        words = detail.split()
+        if words[0] in ('CO-ROUTINE', 'MATERIALIZE') and len(words) > 1:
+            derived.add(words[1])
+        elif (words[0] == 'SCAN' and detail != 'SCAN CONSTANT ROW' and 'VIRTUAL TABLE' not in detail
+              and words[1] not in derived and not words[1].startswith('(')):
+            scans.append(detail)
+    return lines, scans
+
+
+def _samples(conn, args, rng):
+    """Hot and cold arguments drawn from the generated data."""
+    def col(sql, *params):
+        return [r[0] for r in conn.execute(sql, params).fetchall()]
+
+    n_users = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0] or 1
+    n_camps = args.basecamps or len(col('SELECT DISTINCT basecamp FROM messages LIMIT 1000')) or 1
+    hot_users = [user_name(i) for i in range(min(10, n_users))]
+    cold_users = [user_name(rng.randrange(n_users)) for _ in range(50)]
+    hot_camps = [camp_name(i) for i in range(min(3, n_camps))]
+    cold_camps = [camp_name(rng.randrange(n_camps)) for _ in range(20)]
+    max_pm = conn.execute('SELECT COALESCE(MAX(id), 0) FROM private_messages').fetchone()[0]
+    pm_rows = [conn.execute('SELECT sender, recipient, id FROM private_messages WHERE id >= ? LIMIT 1',
+                            (rng.randint(1, max_pm),)).fetchone() for _ in range(50)] if max_pm else []
+    pm_rows = [r for r in pm_rows if r]
+    pairs = [(s, r) for s, r, _ in pm_rows] or [(hot_users[0], cold_users[0])]
+    deep = [(s, r, i) for s, r, i in pm_rows] or [(hot_users[0], cold_users[0], 1)]
+    roster = cold_users[:40]
+    vocab = vocabulary()
+    # Very common, common, mid-frequency and rare words, a phrase, a prefix and a miss
+    words = [vocab[0], vocab[5], vocab[100], vocab[2000], vocab[15000], 'north gate', vocab[300][:3] + '*',
+             'zzzunknown']
+    return {'words': words, 'hot_users': hot_users, 'cold_users': cold_users, 'hot_camps': hot_camps, 'cold_camps': cold_camps,
+            'pairs': pairs, 'deep': deep, 'roster': roster}
+
+
+def _cases(db, s, rng, writes):
+    pick = rng.choice
+
+    def cold_trust(fn):
+        def call(*a):
+            db._trust.invalidate()  # measure the SQLite path, not the in-memory cache
+            return fn(*a)
+        return call
+
+    cases = [
+        ('get_recent_messages[hot camp]', db.get_recent_messages, lambda: (pick(s['hot_camps']), 100)),
+        ('get_recent_messages[cold camp]', db.get_recent_messages, lambda: (pick(s['cold_camps']), 100)),
+        ('get_message_count[hot camp]', db.get_message_count, lambda: (pick(s['hot_camps']),)),
+        ('get_private_history[newest]', db.get_private_history, lambda: (*pick(s['pairs']), 30)),
+        ('get_private_history[before_id]', lambda u, p, b: db.get_private_history(u, p, 30, before_id=b),
+         lambda: pick(s['deep'])),
+        ('get_unread_counts[hot user]', db.get_unread_counts, lambda: (pick(s['hot_users']),)),
+        ('get_unread_counts[cold user]', db.get_unread_counts, lambda: (pick(s['cold_users']),)),
+        ('get_unread_summary[hot user]', db.get_unread_summary, lambda: (pick(s['hot_users']),)),
+        ('get_online_users[hot camp]', db.get_online_users, lambda: (pick(s['hot_camps']),)),
+        ('is_trusted[uncached]', cold_trust(db.is_trusted), lambda: pick(s['pairs'])),
+        ('is_trusted[cached]', db.is_trusted, lambda: pick(s['pairs'])),
+        ('get_trust_status[uncached]', cold_trust(db.get_trust_status), lambda: pick(s['pairs'])),
+        ('get_trust_statuses[40, uncached]', cold_trust(db.get_trust_statuses),
+         lambda: (pick(s['hot_users']), s['roster'])),
+        ('search_messages[hot camp, rank]', db.search_messages, lambda: (pick(s['hot_camps']), pick(s['words']))),
+        ('search_messages[hot camp, recent]', lambda c, q: db.search_messages(c, q, order='recent'),
+         lambda: (pick(s['hot_camps']), pick(s['words']))),
+        ('search_private[hot user]', db.search_private, lambda: (pick(s['hot_users']), pick(s['words']))),
+        ('get_user', db.get_user, lambda: (pick(s['cold_users']),)),
+        ('get_user_code_hash', db.get_user_code_hash, lambda: (pick(s['cold_users']),)),
+    ]
+    if writes:
+        cases += [
+            ('add_message', db.add_message, lambda: (pick(s['hot_users']), pick(s['hot_camps']), 'bench')),
+            ('add_private_message', db.add_private_message, lambda: (*pick(s['pairs']), 'bench')),
+            ('mark_private_read', db.mark_private_read, lambda: pick(s['pairs'])),
+        ]
+    return cases
+
+
+def run(args):
+    path = os.path.abspath(args.db)
+    if not os.path.exists(path):
+        raise SystemExit(f'{path} does not exist; run `dbbench.py generate` first')
+    if path == LIVE_DB and args.writes:
+        raise SystemExit('refusing to run --writes against the live database')
+    os.environ['NEXUS_DB_PATH'] = path
+    os.environ['NEXUS_WRITE_BATCH_MS'] = '0'  # time the insert itself, not the queue
+    sys.path.insert(0, HERE)
+    import db
+    db.init_db()  # apply the server's migrations (new indexes etc.) first
+
+    capture = Capture()
+    open_connection = db._open_connection
+
+    def traced(*a, **kw):
+        conn = open_connection(*a, **kw)
+        conn.set_trace_callback(capture)
+        return conn
+    db._open_connection = traced
+
+    rng = random.Random(args.seed)
+    plain = sqlite3.connect(path)
+    samples = _samples(plain, args, rng)
+    results = []
+    flagged = 0
+    for name, fn, argfn in _cases(db, samples, rng, args.writes):
+        if args.only and not any(o in name for o in args.only):
+            continue
+        capture.statements.clear()
+        capture.on = True
+        fn(*argfn())
+        capture.on = False
+        statements = list(dict.fromkeys(capture.statements))
+        for _ in range(args.warmup):
+            fn(*argfn())
+        times = []
+        deadline = time.perf_counter() + args.max_seconds
+        for _ in range(args.iterations):
+            call_args = argfn()
+            t0 = time.perf_counter()
+            fn(*call_args)
+            times.append(time.perf_counter() - t0)
+            if time.perf_counter() > deadline:
+                break
+        times.sort()
+        plans = []
+        for sql in statements:
+            lines, scans = _plan(plain, sql)
+            flagged += bool(scans)
+            plans.append({'sql': ' '.join(sql.split()), 'plan': lines, 'scans': scans})
+        ms = lambda v: round(v * 1000.0, 4)
+        results.append({'name': name, 'calls': len(times), 'p50_ms': ms(percentile(times, 50)),
+                        'p95_ms': ms(percentile(times, 95)), 'p99_ms': ms(percentile(times, 99)),
+                        'mean_ms': ms(sum(times) / len(times)), 'ops_per_s': round(len(times) / sum(times), 1),
+                        'queries': plans})
+
+    counts = {t: plain.execute(f'SELECT COUNT(*) FROM {t}').fetchone()[0]
+              for t in ('users', 'user_codes', 'trust_pairs', 'messages', 'private_messages',
+                        'read_cursors', 'user_sessions')}
+    report = {'db': path, 'rows': counts, 'sqlite': sqlite3.sqlite_version, 'profile': db.PRAGMA_PROFILE,
+              'results': results, 'full_scans': flagged}
+
+    print(f"rows: {', '.join(f'{k}={v}' for k, v in counts.items())}")
+    print(f"{'function':36} {'calls':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ops/s':>10}")
+    for r in results:
+        mark = '  <-- SCAN' if any(q['scans'] for q in r['queries']) else ''
+        print(f"{r['name']:36} {r['calls']:6} {r['p50_ms']:9.3f} {r['p95_ms']:9.3f} {r['p99_ms']:9.3f} "
+              f"{r['ops_per_s']:10.1f}{mark}")
+    if not args.quiet:
+        for r in results:
+            for q in r['queries']:
+                print(f"\n[{r['name']}] {q['sql']}")
+                for line in q['plan']:
+                    flag = '   <-- full scan' if line.strip() in q['scans'] else ''
+                    print('    ' + line + flag)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    db.close_all()
+    if args.fail_on_scan and flagged:
+        print(f'\n{flagged} function(s) issue full scans', file=sys.stderr)
+        sys.exit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Synthetic data + micro-benchmarks for db.py.')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+
+    g = sub.add_parser('generate', help='fill a scratch database')
+    g.add_argument('--db', required=True)
+    g.add_argument('--append', action='store_true', help='add to an existing scratch database')
+    g.add_argument('--users', type=int, default=100000)
+    g.add_argument('--basecamps', type=int, default=50)
+    g.add_argument('--messages', type=int, default=10000000)
+    g.add_argument('--private', type=int, default=2000000)
+    g.add_argument('--pairs-per-user', type=int, default=5)
+    g.add_argument('--mutual', type=float, default=0.8, help='share of trust pairs that are mutual')
+    g.add_argument('--read-ratio', type=float, default=0.7, help='share of conversations with a read cursor')
+    g.add_argument('--online', type=int, default=2000, help='user_sessions rows')
+    g.add_argument('--skew', type=float, default=1.1, help='Zipf exponent for user and camp activity')
+    g.add_argument('--days', type=float, default=365.0, help='time span of the generated history')
+    g.add_argument('--analyze', action='store_true', help='run ANALYZE afterwards (the server never does)')
+    g.add_argument('--seed', type=int, default=1)
+
+    r = sub.add_parser('run', help='time db.py functions and show their query plans')
+    r.add_argument('--db', required=True)
+    r.add_argument('--basecamps', type=int, default=0, help='camp count used by generate (default: detect)')
+    r.add_argument('--iterations', type=int, default=200)
+    r.add_argument('--warmup', type=int, default=5)
+    r.add_argument('--max-seconds', type=float, default=10.0, help='time cap per function')
+    r.add_argument('--only', nargs='*', help='run only functions whose name contains one of these')
+    r.add_argument('--writes', action='store_true', help='also time the write paths (modifies the db)')
+    r.add_argument('--json', help='write the full report here')
+    r.add_argument('--quiet', action='store_true', help='skip the query plans')
+    r.add_argument('--fail-on-scan', action='store_true', help='exit 1 if any function does a full scan')
+    r.add_argument('--seed', type=int, default=1)
+
+    args = parser.parse_args(argv)
+    generate(args) if args.cmd == 'generate' else run(args)
+
+
+if __name__ == '__main__':
+    main()
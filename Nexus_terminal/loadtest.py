@@ -0,0 +1,415 @@
+# loadtest.py - end-to-end load test against a freshly spawned server
+#
+#   python loadtest.py --clients 200 --basecamps 4 --duration 30 --out results.json
+#
+# Builds a scratch data directory (users, basecamps and mutual trust pairs),
+# starts the server on it (--server threading | asgi | workers), logs every
+# simulated user in through /login and /verify_basecamp, opens one Socket.IO
+# client each and runs a random mix of room messages, DMs, mark-read and
+# disconnect/reconnect churn. Latency is measured send -> receive inside this
+# one process, so a single clock covers both ends. The server's guess throttle
+# keys by account only (NEXUS_THROTTLE_IP=0): every client shares 127.0.0.1.
+# Busy (503) and throttled (429) logins are retried, the latter after its
+# Retry-After.
+#
+# Prints a summary to stderr and the full results as JSON to stdout (or --out),
+# so runs of different releases can be diffed.
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import asyncio
+import argparse
+import contextlib
+import tempfile
+import platform
+import subprocess
+from collections import defaultdict
+
+try:
+    import aiohttp
+    import socketio
+except ImportError:
+    raise SystemExit('loadtest needs aiohttp and python-socketio (pip install aiohttp "python-socketio[asyncio_client]")')
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'loadtest-pw'
+CAMP_CODE = 'LOADTEST-{}'
+PARTNERS = 3  # mutual-trust partners per user (ring neighbours)
+LOGIN_TIMEOUT = 120.0  # seconds a client keeps retrying a busy login
+
+# Action mix per client tick
+MIX = {'send_message': 0.60, 'send_private_message': 0.25, 'mark_private_read': 0.10, 'churn': 0.05}
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+def summarize(samples):
+    s = sorted(samples)
+    ms = lambda v: round(v * 1000.0, 3) if v is not None else None
+    return {'count': len(s), 'p50_ms': ms(percentile(s, 50)), 'p95_ms': ms(percentile(s, 95)),
+            'p99_ms': ms(percentile(s, 99)), 'max_ms': ms(s[-1] if s else None),
+            'mean_ms': ms(sum(s) / len(s) if s else None)}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# -- scratch data -------------------------------------------------------------
+
+def seed(workdir, users, camps):
+    """Create accounts, basecamps and trust pairs in `workdir` (the server's cwd)."""
+    os.environ['NEXUS_DB_PATH'] = os.path.join(workdir, 'nexus_terminal.db')
+    os.chdir(workdir)
+    sys.path.insert(0, HERE)
+    from argon2 import PasswordHasher
+    import db
+    import create_basecamp
+
+    db.init_db()
+    pw_hash = PasswordHasher().hash(PASSWORD)  # one hash, shared: seeding stays fast
+    for name in users:
+        db.add_user(name, 'argon2', pw_hash)
+    with contextlib.redirect_stdout(sys.stderr):  # keep stdout for the JSON
+        for i in range(camps):
+            create_basecamp.create(f'lt{i}', f'Load Test {i}', CAMP_CODE.format(i))
+    with db._writer() as conn:
+        for i, name in enumerate(users):
+            for j in range(1, PARTNERS + 1):
+                a, b, key = db._pair_order(name, users[(i + j) % len(users)])
+                conn.execute("INSERT OR REPLACE INTO trust_pairs (pair_key, a, b, a_trusts_b, b_trusts_a) "
+                             "VALUES (?,?,?,1,1)", (key, a, b))
+    db.close_all()
+
+
+def partners_of(users, i):
+    return [users[(i + j) % len(users)] for j in range(-PARTNERS, PARTNERS + 1) if j and len(users) > 1]
+
+
+# -- server -------------------------------------------------------------------
+
+def start_server(kind, workdir, port, workers):
+    """Spawn the server; returns (process, [ports clients should use])."""
+    env = dict(os.environ, NEXUS_HOST='127.0.0.1', NEXUS_PORT=str(port), NEXUS_DEBUG='0',
+               NEXUS_DB_PATH=os.path.join(workdir, 'nexus_terminal.db'))
+    # Every simulated client comes from 127.0.0.1, so the guess throttle's
+    # per-address key would cap the whole run at its in-flight allowance (20
+    # logins at once). Key by account only, unless the caller says otherwise.
+    env.setdefault('NEXUS_THROTTLE_IP', '0')
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    if kind == 'asgi':
+        cmd, ports = [sys.executable, os.path.join(HERE, 'asgi_app.py')], [port]
+    elif kind == 'workers':
+        # Clients go straight to the workers: behind the IP-hash proxy they'd
+        # all come from 127.0.0.1 and land on one worker.
+        ports = [port + 1 + i for i in range(workers)]
+        cmd = [sys.executable, os.path.join(HERE, 'run_workers.py'), '--workers', str(workers), '--no-proxy',
+               '--base-port', str(ports[0]), '--queue', 'sqlite:///' + os.path.join(workdir, 'nexus_bus.db')]
+    else:
+        cmd, ports = [sys.executable, os.path.join(HERE, 'app.py')], [port]
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT,
+                            start_new_session=hasattr(os, 'killpg'))
+    return proc, ports
+
+
+async def wait_ready(ports, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as http:
+        for port in ports:
+            while True:
+                try:
+                    async with http.get(f'http://127.0.0.1:{port}/') as r:
+                        if r.status == 200:
+                            break
+                except aiohttp.ClientError:
+                    pass
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f'server on port {port} did not come up')
+                await asyncio.sleep(0.2)
+
+
+def stop_server(proc):
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(proc.pid, 15)
+        else:
+            proc.terminate()
+        proc.wait(timeout=10)
+    except Exception:
+        if hasattr(os, 'killpg'):
+            try:
+                os.killpg(proc.pid, 9)
+            except ProcessLookupError:
+                pass
+
+
+# -- simulated clients ----------------------------------------------------------
+
+class Recorder:
+    def __init__(self):
+        self.latency = defaultdict(list)   # event -> [seconds]
+        self.counts = defaultdict(int)     # 'sent:<event>' / 'recv:<event>' / 'error:<kind>'
+        self.sent_at = {}                  # token -> monotonic send time
+
+    def sent(self, event, token=None):
+        self.counts['sent:' + event] += 1
+        if token is not None:
+            self.sent_at[token] = time.monotonic()
+
+    def received(self, event, token=None, started=None):
+        self.counts['recv:' + event] += 1
+        t0 = started if started is not None else self.sent_at.get(token)
+        if t0 is not None:
+            self.latency[event].append(time.monotonic() - t0)
+
+
+def _busy(response):
+    """(status, seconds to wait) for a busy (503) or throttled (429) answer, else (0, 0)."""
+    if response.status not in (429, 503):
+        return 0, 0.0
+    try:
+        return response.status, float(response.headers.get('Retry-After') or 0)
+    except ValueError:
+        return response.status, 1.0
+
+
+class SimClient:
+    def __init__(self, rec, url, username, camp, partners):
+        self.rec = rec
+        self.url = url
+        self.username = username
+        self.camp = camp
+        self.partners = partners
+        self.cookie = None
+        self.sio = None
+        self.connected = asyncio.Event()
+        self.pending_read = {}  # partner -> send time of mark_private_read
+        self.connect_started = None
+
+    async def login(self, http):
+        t0 = time.monotonic()
+        backoff = 0.05
+        self.rec.sent('login')
+        while time.monotonic() - t0 < LOGIN_TIMEOUT:
+            http.cookie_jar.clear()
+            async with http.post(self.url + '/login', json={'username': self.username, 'password': PASSWORD}) as r:
+                busy, retry_after = _busy(r)
+                if not busy and not (await r.json()).get('success'):
+                    raise RuntimeError(f'login failed for {self.username}')
+            if not busy:
+                async with http.post(self.url + '/verify_basecamp',
+                                     json={'basecamp_code': CAMP_CODE.format(self.camp)}) as r:
+                    busy, retry_after = _busy(r)
+                    if not busy and not (await r.json()).get('success'):
+                        raise RuntimeError(f'basecamp code rejected for {self.username}')
+            if busy == 429:  # guess throttle: wait as long as it says
+                self.rec.counts['error:login_throttled'] += 1
+                await asyncio.sleep(retry_after + random.uniform(0, backoff))
+                continue
+            if busy:  # auth pool full: back off like a client would
+                self.rec.counts['error:login_busy'] += 1
+                await asyncio.sleep(random.uniform(0, backoff))
+                backoff = min(backoff * 2, 2.0)
+                continue
+            self.cookie = '; '.join(f'{c.key}={c.value}' for c in http.cookie_jar)
+            self.rec.received('login', started=t0)
+            return
+        raise RuntimeError(f'login for {self.username} stayed busy')
+
+    def _handlers(self, sio):
+        @sio.on('history')
+        async def on_history(data):
+            if self.connect_started is not None:
+                self.rec.received('connect', started=self.connect_started)
+                self.connect_started = None
+            self.connected.set()
+
+        @sio.on('new_message')
+        async def on_new_message(data):
+            self.rec.received('new_message', token=(data.get('message') or '').split(' ', 1)[0])
+
+        @sio.on('new_messages')
+        async def on_new_messages(data):
+            for m in data.get('messages') or []:
+                await on_new_message(m)
+
+        @sio.on('private_message')
+        async def on_private_message(data):
+            if data.get('to') == self.username:
+                self.rec.received('private_message', token=(data.get('message') or '').split(' ', 1)[0])
+
+        @sio.on('unread_delta')
+        async def on_unread_delta(data):
+            started = self.pending_read.pop(data.get('partner'), None)
+            if started is not None and not data.get('count'):
+                self.rec.received('mark_private_read', started=started)
+
+        @sio.on('presence_delta')
+        async def on_presence_delta(data):
+            self.rec.counts['recv:presence_delta'] += 1
+
+        @sio.on('rate_limited')
+        async def on_rate_limited(data):
+            self.rec.counts['rate_limited:' + data.get('event', '?')] += 1
+
+    async def connect(self):
+        self.connected.clear()
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self._handlers(self.sio)
+        self.connect_started = time.monotonic()
+        self.rec.sent('connect')
+        await self.sio.connect(self.url, headers={'Cookie': self.cookie}, transports=['websocket'])
+        await asyncio.wait_for(self.connected.wait(), 30)
+
+    async def disconnect(self):
+        if self.sio is not None:
+            await self.sio.disconnect()
+
+    async def act(self, seq):
+        action = random.choices(list(MIX), weights=list(MIX.values()))[0]
+        token = f'lt:{self.username}:{seq}'
+        if action == 'send_message':
+            self.rec.sent('new_message', token)
+            await self.sio.emit('send_message', {'message': f'{token} ' + 'x' * random.randint(8, 120)})
+        elif action == 'send_private_message' and self.partners:
+            self.rec.sent('private_message', token)
+            await self.sio.emit('send_private_message', {'to': random.choice(self.partners),
+                                                         'message': f'{token} ' + 'y' * random.randint(8, 80)})
+        elif action == 'mark_private_read' and self.partners:
+            partner = random.choice(self.partners)
+            self.pending_read[partner] = time.monotonic()
+            self.rec.sent('mark_private_read')
+            await self.sio.emit('mark_private_read', {'with': partner})
+        elif action == 'churn':
+            self.rec.sent('churn')
+            await self.disconnect()
+            await asyncio.sleep(random.uniform(0.05, 0.5))
+            await self.connect()
+
+    async def run(self, until, rate):
+        seq = 0
+        while time.monotonic() < until:
+            await asyncio.sleep(random.expovariate(rate))
+            seq += 1
+            try:
+                await self.act(seq)
+            except Exception as exc:
+                self.rec.counts['error:' + type(exc).__name__] += 1
+                try:
+                    await self.connect()
+                except Exception:
+                    await asyncio.sleep(0.5)
+
+
+async def run_load(args, ports, users):
+    rec = Recorder()
+    clients = [SimClient(rec, f'http://127.0.0.1:{ports[i % len(ports)]}', name, i % args.basecamps,
+                         partners_of(users, i))
+               for i, name in enumerate(users)]
+
+    t_login = time.monotonic()
+    sem = asyncio.Semaphore(args.ramp_concurrency)
+
+    async def login_one(c):
+        async with sem:
+            async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True)) as http:
+                await c.login(http)
+    await asyncio.gather(*(login_one(c) for c in clients))
+    login_secs = time.monotonic() - t_login
+
+    async def connect_one(c):
+        async with sem:
+            await c.connect()
+    await asyncio.gather(*(connect_one(c) for c in clients))
+
+    start = time.monotonic()
+    await asyncio.gather(*(c.run(start + args.duration, args.rate) for c in clients))
+    elapsed = time.monotonic() - start
+    await asyncio.sleep(args.drain)  # let in-flight messages land
+    await asyncio.gather(*(c.disconnect() for c in clients), return_exceptions=True)
+    return rec, elapsed, login_secs
+
+
+def report(args, rec, elapsed, login_secs):
+    events = {}
+    for event in ('new_message', 'private_message', 'mark_private_read', 'connect', 'login'):
+        sent = rec.counts.get('sent:' + event, 0)
+        recv = rec.counts.get('recv:' + event, 0)
+        secs = login_secs if event == 'login' else elapsed
+        events[event] = {'sent': sent, 'received': recv, 'received_per_sec': round(recv / secs, 2) if secs else None,
+                         **summarize(rec.latency.get(event, []))}
+    events['new_message']['sent_per_sec'] = round(rec.counts.get('sent:new_message', 0) / elapsed, 2)
+    return {
+        'config': {k: v for k, v in vars(args).items() if k not in ('out', 'keep')},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count()},
+        'duration_s': round(elapsed, 3),
+        'events': events,
+        'presence_deltas_received': rec.counts.get('recv:presence_delta', 0),
+        'rate_limited': {k.split(':', 1)[1]: v for k, v in rec.counts.items() if k.startswith('rate_limited:')},
+        'churns': rec.counts.get('sent:churn', 0),
+        'errors': {k.split(':', 1)[1]: v for k, v in rec.counts.items() if k.startswith('error:')},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load-test Nexus Terminal against a spawned server.')
+    parser.add_argument('--server', choices=('threading', 'asgi', 'workers'), default='threading')
+    parser.add_argument('--workers', type=int, default=2, help='worker processes for --server workers')
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--basecamps', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds of steady-state load')
+    parser.add_argument('--rate', type=float, default=1.0, help='actions per second per client')
+    parser.add_argument('--drain', type=float, default=2.0, help='seconds to wait for in-flight events')
+    parser.add_argument('--ramp-concurrency', type=int, default=20, help='parallel logins/connects at start')
+    parser.add_argument('--seed', type=int, default=None, help='random seed for the action mix')
+    parser.add_argument('--out', help='write JSON results here instead of stdout')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory (server.log, db)')
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+
+    out = os.path.abspath(args.out) if args.out else None
+    workdir = tempfile.mkdtemp(prefix='nexus-loadtest-')
+    users = [f'LT{i:05d}' for i in range(args.clients)]
+    seed(workdir, users, args.basecamps)
+
+    port = free_port()
+    proc, ports = start_server(args.server, workdir, port, args.workers)
+    try:
+        asyncio.run(wait_ready(ports))
+        rec, elapsed, login_secs = asyncio.run(run_load(args, ports, users))
+    finally:
+        stop_server(proc)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print(f'scratch directory: {workdir}', file=sys.stderr)
+
+    results = report(args, rec, elapsed, login_secs)
+    for event, r in results['events'].items():
+        print(f"{event:18} sent {r['sent']:7}  recv {r['received']:7}  "
+              f"p50 {r['p50_ms']} ms  p95 {r['p95_ms']} ms  p99 {r['p99_ms']} ms", file=sys.stderr)
+    if results['errors']:
+        print(f"errors: {results['errors']}", file=sys.stderr)
+    text = json.dumps(results, indent=2)
+    if out:
+        with open(out, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
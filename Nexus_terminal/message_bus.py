@@ -0,0 +1,154 @@
+# message_bus.py - Socket.IO client managers for multi-worker mode
+#
+# With several worker processes an emit to a room has to reach the sockets the
+# other workers hold. python-socketio does that with a pub/sub client manager:
+# emits and room changes are published, and every worker replays what the
+# others sent. NEXUS_MESSAGE_QUEUE picks the backend:
+#
+#   sqlite:///path/to/bus.db   local broker, no external service (run_workers.py default)
+#   redis://host:6379/0        RedisManager (needs the redis package)
+#   amqp://...                 KombuManager (needs kombu)
+#
+# The same channel carries 'nexus' messages too: small cluster events the
+# workers use to keep their in-memory state in step (see cluster.py).
+import os
+import time
+import sqlite3
+import threading
+
+import socketio
+
+CHANNEL = 'nexus-terminal'
+
+# SQLite broker: readers poll for rows newer than the last one they saw.
+POLL_INTERVAL = float(os.environ.get('NEXUS_BUS_POLL_MS') or 10) / 1000.0
+POLL_BATCH = 500
+RETENTION = 60.0    # seconds a published row is kept around
+PRUNE_EVERY = 5.0   # seconds between prunes (per listener)
+
+
+class ClusterMixin:
+    """Adds publish()/subscribe() of 'nexus' cluster events to a PubSubManager."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._handlers = {}
+
+    def subscribe(self, kind, fn):
+        """Call fn(host_id, payload) for every `kind` event another worker publishes."""
+        self._handlers[kind] = fn
+
+    def publish(self, kind, payload):
+        self._publish({'method': 'nexus', 'kind': kind, 'data': payload, 'host_id': self.host_id})
+
+    def _listen(self):
+        # Pick our events out of the stream; everything else goes to PubSubManager
+        for message in super()._listen():
+            data = message
+            if not isinstance(data, dict):
+                try:
+                    data = self.json.loads(message)
+                except Exception:
+                    continue
+            if isinstance(data, dict) and data.get('method') == 'nexus':
+                if data.get('host_id') != self.host_id:
+                    self._dispatch(data)
+                continue
+            yield data
+
+    def _dispatch(self, data):
+        fn = self._handlers.get(data.get('kind'))
+        if fn is None:
+            return
+        try:
+            fn(data['host_id'], data.get('data'))
+        except Exception:
+            self._get_logger().exception('cluster event %r failed', data.get('kind'))
+
+
+class SQLiteBroker(socketio.PubSubManager):
+    """Pub/sub over a shared SQLite table, for running workers on one machine.
+
+    Publishing is one INSERT; each worker's listener thread polls for new rows
+    every POLL_INTERVAL and prunes rows older than RETENTION.
+    """
+
+    def __init__(self, url, channel=CHANNEL, write_only=False, logger=None, json=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self.path = url.split('://', 1)[1]
+        self._pub_lock = threading.Lock()
+        self._pub_conn = self._connect()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS bus (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created REAL NOT NULL
+            )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_bus_created ON bus(created)")
+        return conn
+
+    def _publish(self, data):
+        payload = self.json.dumps(data)
+        with self._pub_lock:
+            self._pub_conn.execute("INSERT INTO bus (channel, payload, created) VALUES (?,?,?)",
+                                   (self.channel, payload, time.time()))
+
+    def _listen(self):
+        conn = self._connect()
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM bus").fetchone()[0]
+        pruned = time.monotonic()
+        while True:
+            try:
+                rows = conn.execute("SELECT id, payload FROM bus WHERE id > ? AND channel = ? ORDER BY id LIMIT ?",
+                                    (last_id, self.channel, POLL_BATCH)).fetchall()
+            except sqlite3.OperationalError:
+                rows = []  # locked during a checkpoint; try again next tick
+            for row_id, payload in rows:
+                last_id = row_id
+                yield payload
+            if time.monotonic() - pruned > PRUNE_EVERY:
+                pruned = time.monotonic()
+                try:
+                    conn.execute("DELETE FROM bus WHERE created < ?", (time.time() - RETENTION,))
+                except sqlite3.OperationalError:
+                    pass
+            if len(rows) < POLL_BATCH:
+                self.server.sleep(POLL_INTERVAL)
+
+
+class SQLiteManager(ClusterMixin, SQLiteBroker):
+    name = 'sqlite'
+
+
+class RedisManager(ClusterMixin, socketio.RedisManager):
+    pass
+
+
+class KombuManager(ClusterMixin, socketio.KombuManager):
+    pass
+
+
+def make_client_manager(url, channel=CHANNEL):
+    """Client manager for a NEXUS_MESSAGE_QUEUE url."""
+    if url.startswith('sqlite://'):
+        return SQLiteManager(url, channel=channel)
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisManager(url, channel=channel)
+    return KombuManager(url, channel=channel)
+
+
+def start(server):
+    """Start the manager's listener now rather than on the first connect.
+
+    A worker with no sockets yet still has to follow cluster events, or its
+    caches would be stale by the time someone lands on it.
+    """
+    if not server.manager_initialized:
+        server.manager_initialized = True
+        server.manager.initialize()
@@ -0,0 +1,294 @@
+# metrics.py - in-process counters and histograms, served as Prometheus text
+#
+# Everything is opt-out: NEXUS_METRICS=0 leaves handlers, db functions and
+# emits unwrapped and /metrics answers 404, so a disabled build pays nothing.
+# When on, an observation is one bisect plus a few integer adds under a lock.
+#
+# What is measured:
+#   nexus_socket_handler_seconds{event}     every @socketio.on handler
+#   nexus_http_request_seconds{endpoint}    every Flask route
+#   nexus_db_call_seconds{fn}               every public db.* function
+#   nexus_db_write_failures_total{table}    queued rows the db writer could not store
+#   nexus_argon2_verify_seconds             time inside PasswordHasher.verify
+#   nexus_argon2_queue_wait_seconds         wait for a free auth pool worker
+#   nexus_emits_total{event}                server emits per event name
+#   nexus_emit_recipients{event}            room size (local sockets) per emit
+#
+# Each worker process has its own registry; in multi-worker mode scrape every
+# worker's port rather than the sticky proxy. /metrics answers only loopback
+# scrapers, or anyone with NEXUS_METRICS_TOKEN as a bearer token (web.py).
+import os
+import time
+import inspect
+import functools
+import threading
+from bisect import bisect_left
+
+ENABLED = os.environ.get('NEXUS_METRICS', '1') != '0'
+
+# Latency buckets in seconds (100us .. 10s) and size buckets in recipients
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_registry = []  # metrics in registration order (render order)
+_gauges = []    # (name, help, fn) sampled at scrape time
+
+
+def _label_str(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for n, v in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _fmt(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}  # label values tuple -> count
+        _registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        if not ENABLED:
+            return
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        for values, n in items:
+            lines.append(f'{self.name}{_label_str(self.labels, values)} {_fmt(n)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}  # label values tuple -> [bucket counts..., +Inf count, sum]
+        _registry.append(self)
+
+    def observe(self, value, *label_values):
+        if not ENABLED:
+            return
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(label_values)
+            if s is None:
+                s = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            s[i] += 1
+            s[-1] += value
+
+    def time(self, *label_values):
+        """Decorator that observes the wrapped function's wall time (sync or async)."""
+        def deco(fn):
+            if not ENABLED:
+                return fn
+            if inspect.iscoroutinefunction(fn):
+                @functools.wraps(fn)
+                async def async_timed(*args, **kwargs):
+                    t0 = time.perf_counter()
+                    try:
+                        return await fn(*args, **kwargs)
+                    finally:
+                        self.observe(time.perf_counter() - t0, *label_values)
+                return async_timed
+
+            @functools.wraps(fn)
+            def timed(*args, **kwargs):
+                t0 = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - t0, *label_values)
+            return timed
+        return deco
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for values, s in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), s[:-1]):
+                cumulative += n
+                le = _label_str(self.labels + ('le',), values + (_fmt(float(bound)) if bound != float('inf') else '+Inf',))
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            labels = _label_str(self.labels, values)
+            lines.append(f'{self.name}_sum{labels} {_fmt(s[-1])}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+def gauge(name, help, fn):
+    """Register a gauge sampled at scrape time; fn() returns a number or {label_value: number}.
+
+    Registering a name again replaces the earlier sampler.
+    """
+    _gauges[:] = [g for g in _gauges if g[0] != name]
+    _gauges.append((name, help, fn))
+
+
+def render() -> str:
+    lines = []
+    for m in _registry:
+        lines.extend(m.render())
+    for name, help, fn in _gauges:
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} gauge']
+        try:
+            value = fn()
+        except Exception:
+            continue
+        if isinstance(value, dict):
+            for k, v in sorted(value.items()):
+                lines.append(f'{name}{_label_str(("kind",), (k,))} {_fmt(v)}')
+        else:
+            lines.append(f'{name} {_fmt(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+SOCKET_HANDLER_SECONDS = Histogram('nexus_socket_handler_seconds', 'Socket.IO event handler latency.', ('event',))
+SOCKET_HANDLER_ERRORS = Counter('nexus_socket_handler_errors_total', 'Socket.IO handlers that raised.', ('event',))
+HTTP_REQUEST_SECONDS = Histogram('nexus_http_request_seconds', 'HTTP route latency.', ('endpoint', 'status'))
+DB_CALL_SECONDS = Histogram('nexus_db_call_seconds', 'Time spent in db.* functions.', ('fn',))
+DB_WRITE_FAILURES = Counter('nexus_db_write_failures_total', 'Queued writes that failed and were not stored.',
+                            ('table',))
+ARGON2_VERIFY_SECONDS = Histogram('nexus_argon2_verify_seconds', 'Argon2 verify time in the auth pool.')
+ARGON2_QUEUE_WAIT_SECONDS = Histogram('nexus_argon2_queue_wait_seconds', 'Wait for a free auth pool worker.')
+AUTH_REJECTED_BUSY = Counter('nexus_auth_rejected_busy_total', 'Verifies refused because the auth pool was full.')
+EMITS = Counter('nexus_emits_total', 'Server emits by event name.', ('event',))
+EMIT_RECIPIENTS = Histogram('nexus_emit_recipients', 'Local sockets in the target room at emit time.',
+                            ('event',), buckets=SIZE_BUCKETS)
+
+
+# -- instrumentation ------------------------------------------------------------
+
+def _max_positional(fn):
+    params = inspect.signature(fn).parameters.values()
+    if any(p.kind == p.VAR_POSITIONAL for p in params):
+        return None
+    return sum(p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD) for p in params)
+
+
+def _timed_handler(event, fn):
+    observe, errors = SOCKET_HANDLER_SECONDS.observe, SOCKET_HANDLER_ERRORS.inc
+    # Socket.IO probes handlers with extra arguments (connect's `auth`) and
+    # retries on TypeError; let those probes through untimed
+    max_args = _max_positional(fn)
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_handler(*args, **kwargs):
+            if max_args is not None and len(args) > max_args:
+                return await fn(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                errors(event)
+                raise
+            finally:
+                observe(time.perf_counter() - t0, event)
+        return async_handler
+
+    @functools.wraps(fn)
+    def handler(*args, **kwargs):
+        if max_args is not None and len(args) > max_args:
+            return fn(*args, **kwargs)
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            errors(event)
+            raise
+        finally:
+            observe(time.perf_counter() - t0, event)
+    return handler
+
+
+def _room_size(server, room, namespace):
+    if room is None:
+        return None
+    try:
+        return len(server.manager.rooms.get(namespace or '/', {}).get(room, ()))
+    except Exception:
+        return None
+
+
+def instrument_socketio(sio_server, on_owner=None):
+    """Time every handler registered through `.on` / `.event` from now on and count emits.
+
+    `sio_server` is the python-socketio Server/AsyncServer; `on_owner` is the
+    object whose `.on` decorator the app uses (the Flask-SocketIO instance,
+    or the AsyncServer itself). Call before the handlers are defined.
+    """
+    if not ENABLED:
+        return
+    owner = on_owner or sio_server
+    register = owner.on
+
+    def on(event, *args, **kwargs):
+        if args and callable(args[0]):  # sio.on('event', handler)
+            return register(event, _timed_handler(event, args[0]), *args[1:], **kwargs)
+        decorator = register(event, *args, **kwargs)
+        return lambda fn: decorator(_timed_handler(event, fn))
+    owner.on = on
+
+    server_emit = sio_server.emit
+
+    def _count(event, kwargs):
+        EMITS.inc(event)
+        size = _room_size(sio_server, kwargs.get('to') or kwargs.get('room'), kwargs.get('namespace'))
+        if size is not None:
+            EMIT_RECIPIENTS.observe(size, event)
+
+    if inspect.iscoroutinefunction(server_emit):
+        async def emit(event, *args, **kwargs):
+            _count(event, kwargs)
+            return await server_emit(event, *args, **kwargs)
+    else:
+        def emit(event, *args, **kwargs):
+            _count(event, kwargs)
+            return server_emit(event, *args, **kwargs)
+    sio_server.emit = emit
+
+
+def instrument_flask(app):
+    """Time every request by endpoint and status; exposes nothing itself."""
+    if not ENABLED:
+        return
+    from flask import g, request
+
+    @app.before_request
+    def _metrics_start():
+        g._metrics_t0 = time.perf_counter()
+
+    @app.after_request
+    def _metrics_stop(response):
+        t0 = g.pop('_metrics_t0', None)
+        if t0 is not None:
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - t0, request.endpoint or 'unmatched',
+                                         response.status_code)
+        return response
+
+
+def instrument_module(module, histogram=DB_CALL_SECONDS, skip=()):
+    """Wrap the module's public functions in place so `module.fn()` calls are timed."""
+    if not ENABLED:
+        return
+    for name, fn in list(vars(module).items()):
+        if (name.startswith('_') or name in skip or not inspect.isfunction(fn)
+                or fn.__module__ != module.__name__ or getattr(fn, '_metrics_wrapped', False)):
+            continue
+        wrapped = histogram.time(name)(fn)
+        wrapped._metrics_wrapped = True
+        setattr(module, name, wrapped)
@@ -0,0 +1,214 @@
+# presence.py - in-memory presence registry
+#
+# Tracks which sockets are connected, which users are in which basecamp, and
+# how many sockets each user has in a room, so a second tab closing doesn't
+# take the user offline. Online lists are served from memory; writing presence
+# to the user_sessions table is optional and goes through the db write-behind
+# queue (batched with chat inserts) instead of one commit per connect.
+#
+# In multi-worker mode (cluster.py) the registry also holds mirrors of the
+# sockets other workers own, tagged with their worker's host id, so online
+# lists and refcounts are cluster-wide. Only local sockets are persisted.
+import threading
+from datetime import datetime, timezone
+
+import db
+
+
+class _Conn:
+    """One connected socket; host is None for this worker's own sockets."""
+    __slots__ = ('sid', 'username', 'basecamp', 'host')
+
+    def __init__(self, sid, username, basecamp, host=None):
+        self.sid = sid
+        self.username = username
+        self.basecamp = basecamp
+        self.host = host
+
+
+class _Member:
+    """A user's presence in one room; refs = number of their sockets in it."""
+    __slots__ = ('username', 'connected_at', 'refs')
+
+    def __init__(self, username, connected_at):
+        self.username = username
+        self.connected_at = connected_at
+        self.refs = 0
+
+
+def _now():
+    # Same format as SQLite CURRENT_TIMESTAMP, which user_sessions used
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class PresenceRegistry:
+    def __init__(self, persist=False):
+        self.persist = persist
+        self._lock = threading.Lock()
+        self._conns = {}      # sid -> _Conn
+        self._rooms = {}      # basecamp -> {username: _Member}
+        self._user_refs = {}  # username -> sockets across all rooms
+
+    def connect(self, sid, username, basecamp, host=None) -> bool:
+        """Register a socket in `basecamp`. True if it's the user's first socket there.
+
+        `host` marks a mirror of another worker's socket (not persisted).
+        """
+        with self._lock:
+            if sid in self._conns:
+                return False  # mirrors can arrive twice (event + snapshot)
+            self._conns[sid] = _Conn(sid, username, basecamp, host)
+            self._user_refs[username] = self._user_refs.get(username, 0) + 1
+            first = self._join_locked(username, basecamp)
+        if first and self.persist and host is None:
+            db.queue_user_session(username, basecamp, True)
+        return first
+
+    def _join_locked(self, username, basecamp):
+        members = self._rooms.setdefault(basecamp, {})
+        member = members.get(username)
+        if member is None:
+            member = members[username] = _Member(username, _now())
+        member.refs += 1
+        return member.refs == 1
+
+    def _leave_locked(self, username, basecamp):
+        members = self._rooms.get(basecamp)
+        member = members.get(username) if members else None
+        if member is None:
+            return False
+        member.refs -= 1
+        if member.refs > 0:
+            return False
+        del members[username]
+        if not members:
+            del self._rooms[basecamp]
+        return True
+
+    def leave_room(self, sid):
+        """Take a socket out of its basecamp but keep it connected.
+
+        Returns (username, basecamp, last_in_room) or None if it wasn't in one.
+        """
+        with self._lock:
+            conn = self._conns.get(sid)
+            if conn is None or not conn.basecamp:
+                return None
+            basecamp = conn.basecamp
+            conn.basecamp = None
+            last = self._leave_locked(conn.username, basecamp)
+        if last and self.persist and conn.host is None:
+            db.queue_user_session(conn.username, basecamp, False)
+        return conn.username, basecamp, last
+
+    def disconnect(self, sid):
+        """Forget a socket. Returns (username, basecamp, last_in_room, last_overall) or None."""
+        with self._lock:
+            conn = self._conns.pop(sid, None)
+            if conn is None:
+                return None
+            last_in_room = False
+            if conn.basecamp:
+                last_in_room = self._leave_locked(conn.username, conn.basecamp)
+            refs = self._user_refs.get(conn.username, 1) - 1
+            if refs > 0:
+                self._user_refs[conn.username] = refs
+            else:
+                self._user_refs.pop(conn.username, None)
+        if last_in_room and self.persist and conn.host is None:
+            db.queue_user_session(conn.username, conn.basecamp, False)
+        return conn.username, conn.basecamp, last_in_room, refs <= 0
+
+    def local_conns(self):
+        """[(sid, username, basecamp)] for this worker's own sockets."""
+        with self._lock:
+            return [(c.sid, c.username, c.basecamp) for c in self._conns.values() if c.host is None]
+
+    def local_sids(self, username):
+        """This worker's own sockets of `username`."""
+        with self._lock:
+            return [c.sid for c in self._conns.values() if c.username == username and c.host is None]
+
+    def drop_host(self, host):
+        """Forget every mirrored socket of a worker that went away.
+
+        Returns the disconnect() result for each of them.
+        """
+        with self._lock:
+            sids = [sid for sid, c in self._conns.items() if c.host == host]
+        return [info for info in map(self.disconnect, sids) if info]
+
+    def get(self, sid):
+        """(username, basecamp) for a socket, or None."""
+        conn = self._conns.get(sid)
+        return (conn.username, conn.basecamp) if conn else None
+
+    def online(self, basecamp):
+        """[{username, connected_at}] for a room, oldest first."""
+        with self._lock:
+            members = list(self._rooms.get(basecamp, {}).values())
+        members.sort(key=lambda m: m.connected_at)
+        return [{'username': m.username, 'connected_at': m.connected_at} for m in members]
+
+    def stats(self) -> dict:
+        with self._lock:
+            local = sum(1 for c in self._conns.values() if c.host is None)
+            return {'sockets': len(self._conns), 'local_sockets': local,
+                    'rooms': len(self._rooms), 'users': len(self._user_refs)}
+
+    def room_size(self, basecamp) -> int:
+        return len(self._rooms.get(basecamp, ()))
+
+    def is_online(self, username) -> bool:
+        return username in self._user_refs
+
+
+class DeltaCoalescer:
+    """Batches presence changes per room into one 'joined/left' delta per window.
+
+    The first change in a room remembers who was present before it and starts
+    a timer; when the window closes the room gets a single delta comparing that
+    snapshot with the registry. Someone who joins and leaves inside one window
+    produces nothing at all.
+    """
+
+    def __init__(self, registry, window, emit_fn, defer_fn):
+        self.registry = registry
+        self.window = window
+        self._emit = emit_fn      # emit_fn(basecamp, delta)
+        self._defer = defer_fn    # defer_fn(delay, fn, *args): call fn(*args) after delay
+        self._lock = threading.Lock()
+        self._pending = {}        # basecamp -> {username: was_present}
+
+    def touch(self, basecamp, username, was_present):
+        """Note that `username`'s presence in `basecamp` is changing.
+
+        Call before applying the change; was_present is the state before it.
+        """
+        with self._lock:
+            room = self._pending.get(basecamp)
+            start = room is None
+            if start:
+                room = self._pending[basecamp] = {}
+            room.setdefault(username, was_present)
+        if start:
+            self._defer(self.window, self.flush, basecamp)
+
+    def flush(self, basecamp):
+        with self._lock:
+            room = self._pending.pop(basecamp, None)
+        if not room:
+            return
+        now = {m['username']: m for m in self.registry.online(basecamp)}
+        joined = [now[u] for u, was in room.items() if not was and u in now]
+        left = [u for u, was in room.items() if was and u not in now]
+        if joined or left:
+            self._emit(basecamp, {'joined': joined, 'left': left})
+
+
+def background_defer(spawn_fn, sleep_fn):
+    """defer_fn for thread/greenlet servers, e.g. (socketio.start_background_task, socketio.sleep)."""
+    def run(delay, fn, *args):
+        sleep_fn(delay)
+        fn(*args)
+    return lambda delay, fn, *args: spawn_fn(run, delay, fn, *args)
@@ -0,0 +1,116 @@
+# ratelimit.py - token buckets for client-initiated socket events
+#
+# Every event that costs a SQLite write, a query or a broadcast belongs to a
+# class (EVENT_CLASSES). Each class has two buckets: one per socket and one
+# per user, so a user can't get around the limit by opening more tabs. An
+# event is accepted only if both buckets have a token. Otherwise the handler
+# is skipped and the client gets 'rate_limited' with a retry_after.
+#
+# A bucket is two numbers (tokens, last refill), refilled lazily on use, so a
+# check is O(1) and memory is one small list per active socket/user. Buckets
+# live in one LRU dict capped at MAX_KEYS. A bucket evicted (or idle long
+# enough to refill) simply starts full again.
+import os
+import time
+import threading
+from collections import OrderedDict
+
+import metrics
+
+ENABLED = os.environ.get('NEXUS_RATE_LIMIT', '1') != '0'
+MAX_KEYS = int(os.environ.get('NEXUS_RATE_MAX_KEYS') or 100000)
+
+# class -> (per-socket rate/s, burst, per-user rate/s, burst).
+# Override one with NEXUS_RATE_<CLASS>="rate/burst,rate/burst".
+LIMITS = {
+    'message': (5.0, 15, 8.0, 25),    # send_message, send_private_message
+    'read': (10.0, 30, 20.0, 60),     # mark_private_read, get_unread_counts
+    'query': (5.0, 20, 10.0, 40),     # history, roster, presence, search
+    'pairing': (0.5, 5, 1.0, 10),     # submit_partner_code
+}
+
+EVENT_CLASSES = {
+    'send_message': 'message',
+    'send_private_message': 'message',
+    'mark_private_read': 'read',
+    'get_unread_counts': 'read',
+    'get_online_users': 'query',
+    'request_trust_status': 'query',
+    'request_roster_state': 'query',
+    'fetch_private_history': 'query',
+    'search_messages': 'query',
+    'search_private': 'query',
+    'submit_partner_code': 'pairing',
+}
+
+RATE_LIMITED = metrics.Counter('nexus_rate_limited_total', 'Socket events dropped by the rate limiter.',
+                               ('event', 'scope'))
+
+
+def _limits_from_env():
+    limits = dict(LIMITS)
+    for cls in LIMITS:
+        spec = os.environ.get('NEXUS_RATE_' + cls.upper())
+        if spec:
+            (sr, sb), (ur, ub) = [part.split('/') for part in spec.split(',')]
+            limits[cls] = (float(sr), int(sb), float(ur), int(ub))
+    return limits
+
+
+class Limiter:
+    def __init__(self, limits=None, max_keys=MAX_KEYS, clock=time.monotonic):
+        self.limits = limits or _limits_from_env()
+        self.max_keys = max_keys
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # (scope, key, class) -> [tokens, last refill]
+
+    def _level(self, bucket_key, rate, burst, now):
+        b = self._buckets.get(bucket_key)
+        if b is None:
+            return float(burst)
+        return min(float(burst), b[0] + (now - b[1]) * rate)
+
+    def _store(self, bucket_key, tokens, now):
+        b = self._buckets.get(bucket_key)
+        if b is None:
+            self._buckets[bucket_key] = [tokens, now]
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            b[0], b[1] = tokens, now
+            self._buckets.move_to_end(bucket_key)
+
+    def check(self, event, sid, user):
+        """None if `event` may run now (its tokens are taken), else (scope, seconds until retry)."""
+        cls = EVENT_CLASSES.get(event)
+        if cls is None:
+            return None
+        sid_rate, sid_burst, user_rate, user_burst = self.limits[cls]
+        sid_key, user_key = ('sid', sid, cls), ('user', user, cls)
+        with self._lock:
+            now = self._clock()
+            sid_tokens = self._level(sid_key, sid_rate, sid_burst, now)
+            user_tokens = self._level(user_key, user_rate, user_burst, now) if user else float(user_burst)
+            if sid_tokens >= 1 and user_tokens >= 1:
+                self._store(sid_key, sid_tokens - 1, now)
+                if user:
+                    self._store(user_key, user_tokens - 1, now)
+                return None
+        if sid_tokens < 1:
+            scope, retry = 'sid', (1 - sid_tokens) / sid_rate
+        else:
+            scope, retry = 'user', (1 - user_tokens) / user_rate
+        RATE_LIMITED.inc(event, scope)
+        return scope, retry
+
+    def forget_sid(self, sid):
+        """Drop a closed socket's buckets (its user's buckets stay)."""
+        with self._lock:
+            for cls in self.limits:
+                self._buckets.pop(('sid', sid, cls), None)
+
+
+def reply(event, scope, retry_after):
+    """Payload of the 'rate_limited' event."""
+    return {'event': event, 'scope': scope, 'retry_after': round(retry_after, 3)}
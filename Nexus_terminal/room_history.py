@@ -0,0 +1,64 @@
+# room_history.py - per-basecamp ring buffer of recent messages
+#
+# Keeps the last HISTORY_SIZE messages of every basecamp in memory so a joining
+# client gets its backlog without touching SQLite. Rooms are warmed from the
+# (basecamp, id) index at startup; a room that wasn't warmed is loaded once on
+# first use.
+import threading
+from collections import deque
+from datetime import datetime, timezone
+
+import db
+
+HISTORY_SIZE = 100
+
+_rooms = {}  # basecamp -> deque of message dicts (oldest first)
+_lock = threading.Lock()
+
+
+def _from_row(row):
+    # SQLite CURRENT_TIMESTAMP is UTC 'YYYY-MM-DD HH:MM:SS'; live messages carry local HH:MM:SS
+    ts = row.get('timestamp')
+    try:
+        ts = datetime.strptime(ts, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).astimezone().strftime('%H:%M:%S')
+    except (TypeError, ValueError):
+        pass
+    return {'id': row['id'], 'username': row['username'], 'message': row['message'], 'timestamp': ts}
+
+
+def _load(basecamp):
+    return deque((_from_row(r) for r in db.get_recent_messages(basecamp, HISTORY_SIZE)), maxlen=HISTORY_SIZE)
+
+
+def warm(basecamps):
+    """Preload the ring for each basecamp id (startup)."""
+    for basecamp in basecamps:
+        ring = _load(basecamp)
+        with _lock:
+            _rooms.setdefault(basecamp, ring)
+
+
+def append(basecamp, entry):
+    """Record a message that was just broadcast to `basecamp`."""
+    with _lock:
+        ring = _rooms.get(basecamp)
+        if ring is not None:
+            ring.append(entry)
+            return
+    # Room was never warmed: load it (db flushes first, so it includes this row)
+    ring = _load(basecamp)
+    with _lock:
+        ring = _rooms.setdefault(basecamp, ring)
+        if not ring or ring[-1]['id'] < entry['id']:
+            ring.append(entry)
+
+
+def recent(basecamp):
+    """Backlog for `basecamp`, oldest first."""
+    with _lock:
+        ring = _rooms.get(basecamp)
+        if ring is not None:
+            return list(ring)
+    ring = _load(basecamp)
+    with _lock:
+        return list(_rooms.setdefault(basecamp, ring))
@@ -0,0 +1,256 @@
+# run_workers.py - run Nexus Terminal as N worker processes behind one port
+#
+#   python run_workers.py --workers 4 --port 5000
+#
+# Each worker is a normal `python app.py` on 127.0.0.1:<base-port + i>, joined
+# to the others through the message bus (NEXUS_MESSAGE_QUEUE, by default a
+# local SQLite broker next to this file). A small TCP proxy on --port sends
+# every client IP to the same worker, which Socket.IO needs: the long-polling
+# handshake and its follow-up requests must land on the process that holds
+# the session. With --no-proxy the workers are started alone and an external
+# balancer with sticky sessions (e.g. nginx ip_hash) goes in front.
+#
+# The proxy appends X-Forwarded-For to every request it passes on and starts
+# the workers with NEXUS_TRUST_FORWARDED=1, so the guess throttle still keys
+# by client address. Its budgets are per worker (see throttle.py).
+#
+# Workers that exit are restarted. Ctrl-C / SIGTERM stops everything.
+import os
+import sys
+import time
+import zlib
+import signal
+import asyncio
+import argparse
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESTART_DELAY = 1.0  # seconds before a crashed worker is started again
+
+
+def worker_env(index, port, workers, queue_url):
+    env = dict(os.environ)
+    env['NEXUS_MESSAGE_QUEUE'] = queue_url
+    env['NEXUS_HOST'] = '127.0.0.1'
+    env['NEXUS_PORT'] = str(port)
+    env['NEXUS_WORKER_INDEX'] = str(index)
+    # Share the cores between the workers' Argon2 pools instead of N x cpu_count
+    env.setdefault('NEXUS_AUTH_WORKERS', str(max(1, (os.cpu_count() or 1) // workers)))
+    return env
+
+
+class Supervisor:
+    def __init__(self, workers, base_port, queue_url):
+        self.ports = [base_port + i for i in range(workers)]
+        self.queue_url = queue_url
+        self.procs = [None] * workers
+        self.stopping = False
+
+    def spawn(self, index):
+        env = worker_env(index, self.ports[index], len(self.ports), self.queue_url)
+        # Own process group: the worker's Argon2 pool children share its
+        # listening socket, so they have to go down with it (see _kill_group).
+        # Same cwd as ours, like `python app.py`: basecamps.json etc. are relative
+        self.procs[index] = subprocess.Popen([sys.executable, os.path.join(HERE, 'app.py')], env=env,
+                                             start_new_session=hasattr(os, 'killpg'))
+        print(f"worker {index} (pid {self.procs[index].pid}) on 127.0.0.1:{self.ports[index]}", flush=True)
+
+    def start(self):
+        for i in range(len(self.ports)):
+            self.spawn(i)
+
+    async def watch(self):
+        while not self.stopping:
+            await asyncio.sleep(RESTART_DELAY)
+            for i, proc in enumerate(self.procs):
+                if proc.poll() is not None and not self.stopping:
+                    print(f"worker {i} exited with {proc.returncode}; restarting", flush=True)
+                    _kill_group(proc, signal.SIGKILL)
+                    self.spawn(i)
+
+    def stop(self):
+        self.stopping = True
+        for proc in self.procs:
+            if proc:
+                _kill_group(proc, signal.SIGTERM)
+        deadline = time.monotonic() + 5
+        for proc in self.procs:
+            if proc:
+                try:
+                    proc.wait(timeout=max(0.1, deadline - time.monotonic()))
+                except subprocess.TimeoutExpired:
+                    pass
+                _kill_group(proc, signal.SIGKILL)
+
+
+def _kill_group(proc, sig):
+    """Signal a worker and everything it forked (a dead worker's children keep its port)."""
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(proc.pid, sig)
+        elif proc.poll() is None:
+            proc.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+async def _pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        try:
+            writer.close()
+        except Exception:
+            pass
+
+
+async def _copy_exact(reader, writer, size):
+    while size:
+        data = await reader.readexactly(min(size, 65536))
+        writer.write(data)
+        size -= len(data)
+
+
+async def _copy_chunked(reader, writer):
+    while True:
+        size_line = await reader.readuntil(b'\r\n')
+        writer.write(size_line)
+        size = int(size_line.split(b';')[0], 16)
+        if size == 0:
+            break
+        await _copy_exact(reader, writer, size + 2)  # the chunk and its CRLF
+    while True:  # trailers, up to the empty line
+        line = await reader.readuntil(b'\r\n')
+        writer.write(line)
+        if line == b'\r\n':
+            return
+
+
+async def _pipe_requests(reader, writer, client_ip):
+    """Client -> worker: _pipe, but every HTTP/1.1 request head gets our X-Forwarded-For.
+
+    One sent by the client is dropped, not appended to. After an Upgrade (the
+    websocket handshake) the connection is no longer HTTP and is piped as is.
+    """
+    forwarded = b'X-Forwarded-For: ' + client_ip.encode()
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except asyncio.IncompleteReadError:
+                break  # closed between requests; _pipe sees the EOF
+            lines = head[:-4].split(b'\r\n')
+            kept, length, chunked, upgrade = [lines[0]], 0, False, False
+            for line in lines[1:]:
+                name, _, value = line.partition(b':')
+                name = name.strip().lower()
+                if name == b'x-forwarded-for':
+                    continue
+                if name == b'content-length':
+                    length = int(value)
+                elif name == b'transfer-encoding':
+                    chunked = b'chunked' in value.lower()
+                elif name == b'upgrade':
+                    upgrade = True
+                kept.append(line)
+            kept.append(forwarded)
+            writer.write(b'\r\n'.join(kept) + b'\r\n\r\n')
+            if chunked:
+                await _copy_chunked(reader, writer)
+            else:
+                await _copy_exact(reader, writer, length)
+            await writer.drain()
+            if upgrade:
+                break
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError,
+            ConnectionError, asyncio.CancelledError):
+        # Truncated or not HTTP we can frame: drop the connection
+        writer.close()
+        return
+    await _pipe(reader, writer)
+
+
+def sticky_handler(ports):
+    """asyncio connection handler that pins each client IP to one worker port."""
+    async def handle(client_reader, client_writer):
+        ip = (client_writer.get_extra_info('peername') or ('',))[0]
+        first = zlib.crc32(ip.encode()) % len(ports)
+        for attempt in range(len(ports)):
+            # Fall through to the next worker only while the pinned one is down
+            port = ports[(first + attempt) % len(ports)]
+            try:
+                upstream_reader, upstream_writer = await asyncio.open_connection('127.0.0.1', port)
+                break
+            except OSError:
+                continue
+        else:
+            client_writer.close()
+            return
+        await asyncio.gather(_pipe_requests(client_reader, upstream_writer, ip),
+                             _pipe(upstream_reader, client_writer))
+    return handle
+
+
+async def serve(args, sup):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    server = None
+    if not args.no_proxy:
+        server = await asyncio.start_server(sticky_handler(sup.ports), args.host, args.port)
+        print(f"sticky proxy on {args.host}:{args.port} -> {len(sup.ports)} workers", flush=True)
+    watcher = asyncio.ensure_future(sup.watch())
+    try:
+        await stop.wait()
+    finally:
+        watcher.cancel()
+        if server:
+            server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run Nexus Terminal with several worker processes.')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('NEXUS_WORKERS') or os.cpu_count() or 1))
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--base-port', type=int, default=5100, help='first worker port (127.0.0.1)')
+    parser.add_argument('--queue', default=os.environ.get('NEXUS_MESSAGE_QUEUE')
+                        or 'sqlite:///' + os.path.join(HERE, 'nexus_bus.db'),
+                        help='message bus url: sqlite:///file, redis://..., amqp://...')
+    parser.add_argument('--no-proxy', action='store_true', help='start the workers only')
+    args = parser.parse_args(argv)
+
+    if os.environ.get('NEXUS_PRESENCE_PERSIST') == '1':
+        # Workers skip this in bus mode so they can't wipe each other's rows
+        sys.path.insert(0, HERE)
+        import db
+        db.init_db()
+        db.clear_user_sessions()
+
+    if not args.no_proxy:
+        # Every client reaches the workers from 127.0.0.1; the proxy tells them the
+        # real address in X-Forwarded-For (they listen on 127.0.0.1 only)
+        os.environ['NEXUS_TRUST_FORWARDED'] = '1'
+    sup = Supervisor(max(1, args.workers), args.base_port, args.queue)
+    sup.start()
+    try:
+        asyncio.run(serve(args, sup))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sup.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,10 @@ let activityTimer;
 
 // Fonction pour déconnecter et rediriger
 function logoutAndRedirect() {
+    // Ferme d'abord le socket du chat pour que le serveur retire la présence tout de suite
+    if (typeof socket !== "undefined") {
+        try { socket.disconnect(); } catch (e) {}
+    }
     fetch("/logout", { method: "POST" })
         .finally(() => {
             window.location.href = "/"; // redirection vers login
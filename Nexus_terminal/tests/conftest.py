@@ -0,0 +1,36 @@
+# Tests import the app's flat modules from Nexus_terminal/ and run against a
+# scratch database (NEXUS_DB_PATH, set before db is first imported), never
+# the tracked nexus_terminal.db.
+#
+#   python -m pytest -q Nexus_terminal/tests
+import os
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+SCRATCH = tempfile.mkdtemp(prefix='nexus-tests-')
+os.environ.setdefault('NEXUS_DB_PATH', os.path.join(SCRATCH, 'nexus_terminal.db'))
+
+
+import pytest
+
+
+@pytest.fixture
+def signed_in():
+    """signed_in(user, basecamp) -> (flask test client, socketio test client), session preset."""
+    import app
+    clients = []
+
+    def make(user, basecamp='camp-t', basecamp_name='Test Camp'):
+        http = app.app.test_client()
+        with http.session_transaction() as sess:
+            sess.update(authenticated=True, username=user, basecamp=basecamp, basecamp_name=basecamp_name)
+        sock = app.socketio.test_client(app.app, flask_test_client=http)
+        clients.append(sock)
+        return http, sock
+    yield make
+    for sock in clients:
+        if sock.is_connected():
+            sock.disconnect()
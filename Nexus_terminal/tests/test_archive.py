@@ -0,0 +1,78 @@
+import gzip
+import json
+import warnings
+
+import archive
+import db
+
+
+def test_segment_round_trip(tmp_path):
+    rows = {'camp': [{'id': 1, 'message': 'héllo'}, {'id': 2, 'message': 'two'}],
+            'other': [{'id': 3, 'message': 'three'}]}
+    members = archive.append(str(tmp_path), 'messages', rows)
+    assert [m[0] for m in members] == ['camp', 'other']
+    for scope, file, offset, length in members:
+        assert archive.read(str(tmp_path), file, offset, length) == rows[scope]
+    # Concatenated members are still one valid .gz file
+    with gzip.open(tmp_path / members[0][1], 'rt', encoding='utf-8') as f:
+        assert [json.loads(line)['id'] for line in f] == [1, 2, 3]
+
+
+def test_only_one_archiver_at_a_time(tmp_path):
+    with archive.exclusive(str(tmp_path)) as first:
+        with archive.exclusive(str(tmp_path)) as second:
+            assert first and not second
+
+
+def test_expired_rows_move_to_archive_and_stay_readable():
+    db.init_db()
+    with db._writer() as conn:
+        for i in range(30):
+            conn.execute("INSERT INTO messages (username, basecamp, message, timestamp) VALUES (?, ?, ?, ?)",
+                         ('ALICE', 'arch', f'old {i}', '2000-01-01 00:00:00'))
+        conn.commit()
+    for i in range(5):
+        db.add_message('ALICE', 'arch', f'new {i}')
+    before = db.get_recent_messages('arch', 50)
+    count = db.get_message_count('arch')
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        moved = db.archive_expired(camp_days={'arch': 1})
+    assert moved['messages'] == 30
+
+    with db._reader() as conn:
+        hot = conn.execute("SELECT COUNT(*) FROM messages WHERE basecamp = 'arch'").fetchone()[0]
+    assert hot == 5
+    assert db.get_recent_messages('arch', 50) == before
+    assert db.get_message_count('arch') == count
+    # Scrolling back past the hot rows continues in the archive
+    page = db.get_recent_messages('arch', 10, before_id=before[-5]['id'])
+    assert [m['message'] for m in page] == [f'old {i}' for i in range(20, 30)]
+
+
+def test_unread_dms_are_not_archived():
+    db.init_db()
+    old = '2000-01-01 00:00:00'
+    # Negative ids sort these before the DMs other tests leave in the shared scratch db
+    rows = [(-90, 'AR1', 'AR2'), (-89, 'AR1', 'AR2'), (-88, 'AR1', 'AR2'), (-87, 'AR2', 'AR1'),
+            (-80, 'AR3', 'AR4'), (-79, 'AR4', 'AR3')]
+    with db._writer() as conn:
+        conn.executemany("INSERT INTO private_messages (id, session_key, sender, recipient, message, timestamp) "
+                         "VALUES (?, ?, ?, ?, ?, ?)",
+                         [(i, db._dm_session_key(s, r), s, r, f'dm {i}', old) for i, s, r in rows])
+        conn.commit()
+    db.mark_private_read('AR2', 'AR1', -90)  # AR2 has read only the first of three
+    db.mark_private_read('AR1', 'AR2')
+    db.mark_private_read('AR3', 'AR4')
+    db.mark_private_read('AR4', 'AR3')
+    history = db.get_private_history('AR1', 'AR2', limit=10)
+
+    db.archive_expired(dm_days=1)
+
+    with db._reader() as conn:
+        hot = [r[0] for r in conn.execute("SELECT id FROM private_messages WHERE id < 0 ORDER BY id")]
+    # AR1/AR2 stops at its first unread DM, so its hot rows stay one tail
+    assert hot == [-89, -88, -87]
+    assert db.get_unread_counts('AR2') == {'AR1': 2}
+    assert db.get_private_history('AR1', 'AR2', limit=10) == history
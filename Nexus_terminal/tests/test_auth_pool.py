@@ -0,0 +1,66 @@
+import threading
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from argon2 import PasswordHasher
+
+import auth_pool
+from auth_pool import AuthBusy, AuthUnavailable
+
+
+class FakePool:
+    """Stands in for the ProcessPoolExecutor; hands out futures the test settles."""
+
+    def __init__(self):
+        self.futures = []
+        self.error = None  # exception every future fails with
+        self.shut_down = False
+
+    def submit(self, fn, *args):
+        f = Future()
+        f.set_running_or_notify_cancel()
+        if self.error is not None:
+            f.set_exception(self.error)
+        self.futures.append(f)
+        return f
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shut_down = True
+
+
+@pytest.fixture
+def fake_pool(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(auth_pool, '_pool', pool)
+    monkeypatch.setattr(auth_pool, '_slots', threading.BoundedSemaphore(1))
+    return pool
+
+
+def test_verify_in_pool():
+    stored = PasswordHasher(time_cost=1, memory_cost=8, parallelism=1).hash('secret')
+    try:
+        assert auth_pool.verify(stored, 'secret') is True
+        assert auth_pool.verify(stored, 'wrong') is False
+    finally:
+        auth_pool.shutdown()
+
+
+def test_broken_pool_is_unavailable_and_replaced(fake_pool):
+    fake_pool.error = BrokenProcessPool('worker died')
+    with pytest.raises(AuthUnavailable):
+        auth_pool.verify('hash', 'secret')
+    assert fake_pool.shut_down
+    assert auth_pool._pool is None  # the next verify starts a new pool
+    assert auth_pool._slots.acquire(blocking=False)  # slot given back
+
+
+def test_timeout_keeps_slot_until_worker_finishes(fake_pool, monkeypatch):
+    monkeypatch.setattr(auth_pool, 'AUTH_TIMEOUT', 0.01)
+    with pytest.raises(AuthUnavailable):
+        auth_pool.verify('hash', 'secret')
+    # The verify is still running in its worker, so the only slot stays taken
+    with pytest.raises(AuthBusy):
+        auth_pool.verify('hash', 'secret')
+    fake_pool.futures[0].set_result((False, 0.0, 0.0))
+    assert auth_pool._slots.acquire(blocking=False)
@@ -0,0 +1,65 @@
+import json
+import threading
+
+import pytest
+from argon2 import PasswordHasher
+
+import web
+import auth_pool
+import create_basecamp
+from cred_store import basecamps_store
+
+FAST = PasswordHasher(time_cost=1, memory_cost=8, parallelism=1)
+
+
+@pytest.fixture
+def camps(tmp_path, monkeypatch):
+    """basecamps.json and the lookup key file in a scratch directory."""
+    path = tmp_path / 'basecamps.json'
+    path.write_text('{}')
+    monkeypatch.setattr(basecamps_store, 'path', str(path))
+    monkeypatch.setattr(basecamps_store, '_data', None)
+    monkeypatch.setattr(create_basecamp, 'LOOKUP_KEY_FILE', tmp_path / 'basecamp_lookup.key')
+    monkeypatch.setattr(create_basecamp, '_lookup_key', None)
+    monkeypatch.delenv('NEXUS_BASECAMP_LOOKUP_KEY', raising=False)
+    monkeypatch.setattr(auth_pool, 'verify', lambda h, secret: FAST.verify(h, secret))
+    return path
+
+
+def test_concurrent_key_creation_agrees(camps):
+    keys, start = [], threading.Barrier(8)
+
+    def create():
+        start.wait()
+        keys.append(create_basecamp._create_key_file())
+    threads = [threading.Thread(target=create) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(keys) == 8 and len(set(keys)) == 1
+    assert create_basecamp.LOOKUP_KEY_FILE.read_text() == keys[0].hex()
+
+
+def test_tagged_camp_found_by_tag(camps):
+    camps.write_text(json.dumps({'c1': {'name': 'One', 'scheme': 'argon2', 'hash': FAST.hash('CODE-1'),
+                                        'lookup': create_basecamp.lookup_tag('CODE-1'),
+                                        'lookup_key': create_basecamp.lookup_key_id()}}))
+    assert web.verify_basecamp_code('CODE-1') == ('c1', 'One')
+    assert web.verify_basecamp_code('CODE-2') == (None, None)
+
+
+def test_camp_tagged_under_old_key_still_verifies_and_is_retagged(camps, monkeypatch):
+    old_tag = 'f' * 64  # made with a key that is gone
+    camps.write_text(json.dumps({'c1': {'name': 'One', 'scheme': 'argon2', 'hash': FAST.hash('CODE-1'),
+                                        'lookup': old_tag, 'lookup_key': 'lost-key'}}))
+    assert web.verify_basecamp_code('CODE-1') == ('c1', 'One')
+    info = json.loads(camps.read_text())['c1']
+    assert info['lookup'] == create_basecamp.lookup_tag('CODE-1')
+    assert create_basecamp.has_current_tag(info)
+
+    # Now a tag miss is definitive: no verify runs for a wrong code
+    calls = []
+    monkeypatch.setattr(auth_pool, 'verify', lambda h, secret: calls.append(secret) or False)
+    assert web.verify_basecamp_code('WRONG') == (None, None)
+    assert calls == []
@@ -0,0 +1,61 @@
+import broadcast
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def coalescer(window=0.05, max_batch=broadcast.MAX_BATCH):
+    clock, sent, deferred = Clock(), [], []
+    c = broadcast.MessageCoalescer(lambda room: window, lambda room, batch: sent.append((room, batch)),
+                                   lambda delay, fn, *args: deferred.append((fn, args)),
+                                   max_batch=max_batch, clock=clock)
+    return c, clock, sent, deferred
+
+
+def test_quiet_room_sends_at_once():
+    c, clock, sent, deferred = coalescer()
+    c.publish('camp', 1)
+    clock.now += 1
+    c.publish('camp', 2)
+    assert sent == [('camp', [1]), ('camp', [2])] and deferred == []
+
+
+def test_burst_is_held_and_flushed_in_order():
+    c, clock, sent, deferred = coalescer()
+    c.publish('camp', 1)  # quiet: goes out now
+    c.publish('camp', 2)
+    c.publish('camp', 3)
+    assert sent == [('camp', [1])]
+    assert len(deferred) == 1  # one timer for the held batch
+    fn, args = deferred.pop()
+    fn(*args)
+    assert sent == [('camp', [1]), ('camp', [2, 3])]
+
+
+def test_full_batch_does_not_wait():
+    c, clock, sent, deferred = coalescer(max_batch=3)
+    for i in range(4):
+        c.publish('camp', i)
+    assert sent == [('camp', [0]), ('camp', [1, 2, 3])]
+    fn, args = deferred.pop()
+    fn(*args)  # the timer finds nothing left
+    assert len(sent) == 2
+
+
+def test_zero_window_never_batches():
+    c, clock, sent, deferred = coalescer(window=0)
+    for i in range(3):
+        c.publish('camp', i)
+    assert sent == [('camp', [0]), ('camp', [1]), ('camp', [2])]
+
+
+def test_rooms_are_independent():
+    c, clock, sent, deferred = coalescer()
+    c.publish('a', 1)
+    c.publish('b', 1)
+    assert sent == [('a', [1]), ('b', [1])]
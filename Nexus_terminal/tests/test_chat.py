@@ -0,0 +1,56 @@
+import pytest
+
+import db
+import chat
+
+
+@pytest.fixture(scope='module')
+def pair():
+    db.init_db()
+    with db._writer() as conn:
+        conn.execute("INSERT OR REPLACE INTO trust_pairs (pair_key, a, b, a_trusts_b, b_trusts_a) "
+                     "VALUES ('CHLOE||CHRIS', 'CHLOE', 'CHRIS', 1, 1)")
+        conn.commit()
+    db._trust.invalidate()
+    return 'CHLOE', 'CHRIS'
+
+
+def test_search_paging_is_clamped():
+    assert chat._search_paging({'q': ' water ', 'limit': '999', 'offset': -5, 'order': 'x'}) == \
+        ('water', chat.SEARCH_PAGE_MAX, 0, None, 'rank')
+    q, limit, offset, before_id, order = chat._search_paging({'q': 'w' * 500, 'offset': 10 ** 9,
+                                                             'before_id': '42', 'order': 'recent'})
+    assert len(q) == chat.SEARCH_QUERY_MAX and offset == chat.SEARCH_MAX_OFFSET
+    assert (limit, before_id, order) == (chat.SEARCH_PAGE_SIZE, 42, 'recent')
+
+
+def test_incomplete_requests_get_no_reply():
+    assert chat.trust_status('CHLOE', None) is None
+    assert chat.room_message('CHLOE', 'chat-camp', {'message': '   '}) is None
+    assert chat.private_message('CHLOE', {'to': 'CHRIS'}) is None
+    assert chat.private_history('CHLOE', {}) is None
+    assert chat.mark_private_read('CHLOE', None) is None
+    assert chat.search_private('CHLOE', {'q': ''}) is None
+    assert chat.submit_partner_code('CHLOE', {'with': 'CHRIS'}, '10.0.0.1') is None
+
+
+def test_room_message_is_stored_and_kept_in_history(pair):
+    payload = chat.room_message('CHLOE', 'chat-camp', {'message': ' hello '})
+    assert payload['message'] == 'hello' and payload['id']
+    assert chat.welcome('CHLOE', 'chat-camp', 'Chat Camp')[1] == \
+        ('history', {'basecamp': 'chat-camp', 'messages': [payload]})
+
+
+def test_dm_needs_mutual_trust(pair):
+    event, payload = chat.private_message('CHLOE', {'to': 'STRANGER', 'message': 'hi'})
+    assert event == 'trust_required' and payload['with'] == 'STRANGER' and not payload['mutual']
+    event, payload = chat.private_message('CHLOE', {'to': 'CHRIS', 'message': 'hi'})
+    assert event == 'private_message' and payload['id']
+
+
+def test_private_history_pages_oldest_first(pair):
+    ids = [chat.private_message('CHRIS', {'to': 'CHLOE', 'message': f'page {i}'})[1]['id'] for i in range(3)]
+    page = chat.private_history('CHLOE', {'with': 'CHRIS', 'limit': 2})
+    assert [m['id'] for m in page['messages']] == ids[1:] and page['has_more']
+    older = chat.private_history('CHLOE', {'with': 'CHRIS', 'limit': 2, 'before_id': ids[1]})
+    assert ids[0] in [m['id'] for m in older['messages']]
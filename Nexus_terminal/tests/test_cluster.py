@@ -0,0 +1,154 @@
+# Two real workers (python app.py) joined by the SQLite bus, as run_workers.py
+# starts them, with python-socketio clients on each.
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+from argon2 import PasswordHasher
+
+import cluster
+import presence
+
+socketio = pytest.importorskip('socketio')
+requests = pytest.importorskip('requests')
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+FAST = PasswordHasher(time_cost=1, memory_cost=8, parallelism=1)
+
+
+# -- unit: what a worker does with the others' events ---------------------------
+
+class FakeBus:
+    host_id = 'me'
+
+    def __init__(self):
+        self.sent = []
+
+    def publish(self, kind, payload):
+        self.sent.append((kind, payload))
+
+
+def make_cluster():
+    reg = presence.PresenceRegistry()
+    touched = []
+    deltas = type('Deltas', (), {'touch': lambda self, *a, **k: touched.append(a)})()
+    return cluster.Cluster(FakeBus(), reg, deltas, None, None), reg, touched
+
+
+def test_mirrors_presence_and_drops_dead_host():
+    c, reg, touched = make_cluster()
+    c._on_presence('w2', {'op': 'connect', 'sid': 's1', 'username': 'ALICE', 'basecamp': 'camp'})
+    assert [m['username'] for m in reg.online('camp')] == ['ALICE']
+    c._drop('w2', announce=True)
+    assert reg.online('camp') == []
+    assert touched == [('camp', 'ALICE')]
+
+
+def test_hello_is_answered_with_local_sockets_only():
+    c, reg, _ = make_cluster()
+    reg.connect('local', 'ALICE', 'camp')
+    reg.connect('w2:x', 'BOB', 'camp', host='w2')
+    c._on_hello('w3', {})
+    assert c.bus.sent == [('snapshot', {'conns': [('local', 'ALICE', 'camp')]})]
+
+
+# -- integration: two workers over the SQLite bus -------------------------------
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(predicate, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+@pytest.fixture
+def workers(tmp_path):
+    users = {u: {'scheme': 'argon2', 'hash': FAST.hash('pw-' + u), 'role': 'survivor'} for u in ('ALICE', 'BOB')}
+    (tmp_path / 'users.json').write_text(json.dumps(users))
+    (tmp_path / 'basecamps.json').write_text(json.dumps(
+        {'camp': {'name': 'Camp', 'scheme': 'argon2', 'hash': FAST.hash('CAMPCODE')}}))
+    procs, ports = [], []
+    for index in range(2):
+        port = _free_port()
+        env = dict(os.environ, NEXUS_DB_PATH=str(tmp_path / 'nexus.db'),
+                   NEXUS_MESSAGE_QUEUE='sqlite:///' + str(tmp_path / 'bus.db'),
+                   NEXUS_HOST='127.0.0.1', NEXUS_PORT=str(port), NEXUS_WORKER_INDEX=str(index),
+                   NEXUS_AUTH_WORKERS='1', NEXUS_CLUSTER_HEARTBEAT='0.2', NEXUS_CLUSTER_HOST_TIMEOUT='1.5',
+                   NEXUS_RATE_LIMIT='0', NEXUS_THROTTLE='0')
+        procs.append(subprocess.Popen([sys.executable, APP], cwd=tmp_path, env=env, start_new_session=True,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        ports.append(port)
+        if index == 0:  # let the first one create the schema
+            assert _wait_for(lambda: _is_up(port)), 'worker 0 did not start'
+    assert _wait_for(lambda: _is_up(ports[1])), 'worker 1 did not start'
+    yield procs, ports
+    for proc in procs:
+        if proc.poll() is None:
+            os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+
+
+def _is_up(port):
+    try:
+        return requests.get(f'http://127.0.0.1:{port}/', timeout=0.5).ok
+    except requests.RequestException:
+        return False
+
+
+def _join(user, port):
+    base = f'http://127.0.0.1:{port}'
+    http = requests.Session()
+    assert http.post(base + '/login', json={'username': user, 'password': 'pw-' + user}).json()['success']
+    assert http.post(base + '/verify_basecamp', json={'basecamp_code': 'CAMPCODE'}).json()['success']
+    events = []
+    client = socketio.Client()
+    client.on('*', lambda event, *args: events.append((event, args[0] if args else None)))
+    client.connect(base, headers={'Cookie': '; '.join(f'{k}={v}' for k, v in http.cookies.items())},
+                   transports=['websocket'])
+    return client, events
+
+
+def _online(events):
+    """Latest roster seen: last full list plus the deltas after it."""
+    names = set()
+    for event, data in events:
+        if event == 'online_users_update':
+            names = {u['username'] for u in data['users']}
+        elif event == 'presence_delta':
+            names |= {u['username'] for u in data['joined']}
+            names -= set(data['left'])
+    return names
+
+
+def test_two_workers_share_presence_messages_and_expiry(workers):
+    procs, ports = workers
+    alice, alice_events = _join('ALICE', ports[0])
+    bob, bob_events = _join('BOB', ports[1])
+    try:
+        # Presence crosses workers
+        assert _wait_for(lambda: 'ALICE' in _online(bob_events))
+
+        # A room message sent on worker 0 reaches a socket on worker 1
+        alice.emit('send_message', {'message': 'hello from worker 0'})
+        assert _wait_for(lambda: any(e == 'new_message' and d['message'] == 'hello from worker 0'
+                                     for e, d in bob_events))
+
+        # Worker 0 dies without a word: its sockets expire after HOST_TIMEOUT
+        os.killpg(procs[0].pid, signal.SIGKILL)
+        assert _wait_for(lambda: 'ALICE' not in _online(bob_events))
+    finally:
+        bob.disconnect()
+        alice.disconnect()
@@ -0,0 +1,83 @@
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+import db
+import metrics
+
+
+@pytest.fixture(scope='module', autouse=True)
+def schema():
+    db.init_db()
+
+
+def _row(table, rowid):
+    with db._reader() as conn:
+        return conn.execute(f'SELECT * FROM {table} WHERE id = ?', (rowid,)).fetchone()
+
+
+def test_returned_ids_are_committed_rows():
+    ids = []
+    threads = [threading.Thread(target=lambda i=i: ids.append(db.add_message('ALICE', 'camp-w', f'm{i}')))
+               for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(ids)) == 20
+    assert all(_row('messages', i) is not None for i in ids)
+
+
+def test_ids_come_from_sqlite_not_a_per_process_counter():
+    first = db.add_message('ALICE', 'camp-w', 'before')
+    # Another process writing the same table takes the next id...
+    other = sqlite3.connect(db.DB_PATH)
+    with other:
+        taken = other.execute("INSERT INTO messages (username, basecamp, message) VALUES ('BOB', 'camp-w', 'x')").lastrowid
+    other.close()
+    # ...and ours neither collides with it nor gets dropped
+    second = db.add_message('ALICE', 'camp-w', 'after')
+    assert first < taken < second
+    assert _row('messages', second)['message'] == 'after'
+
+
+def test_lone_write_is_not_held_for_the_batch_window(monkeypatch):
+    monkeypatch.setattr(db, 'WRITE_BATCH_MS', 2000)
+    db.add_message('ALICE', 'camp-w', 'warm-up')  # writer thread running
+    start = time.monotonic()
+    db.add_message('ALICE', 'camp-w', 'alone')
+    assert time.monotonic() - start < 1.0
+
+
+def test_failed_row_is_reported_not_swallowed(caplog):
+    before = metrics.DB_WRITE_FAILURES._values.get(('messages',), 0)
+    with caplog.at_level(logging.ERROR, logger='db'):
+        with pytest.raises(sqlite3.IntegrityError):
+            db.add_message('ALICE', 'camp-w', None)  # message is NOT NULL
+    assert 'messages' in caplog.text
+    if metrics.ENABLED:
+        assert metrics.DB_WRITE_FAILURES._values[('messages',)] == before + 1
+
+
+def test_bad_row_does_not_take_its_batch_down():
+    sql = 'INSERT INTO messages (username, basecamp, message) VALUES (?, ?, ?)'
+    rows = [('messages', sql, ('ALICE', 'camp-w', 'fine'), Future()),
+            ('messages', sql, ('ALICE', 'camp-w', None), Future()),
+            ('messages', sql, ('ALICE', 'camp-w', 'also fine'), Future())]
+    with db._writer() as conn:
+        db._write_batch(conn, rows)
+    good, bad, also = (r[3] for r in rows)
+    assert _row('messages', good.result())['message'] == 'fine'
+    assert _row('messages', also.result())['message'] == 'also fine'
+    assert isinstance(bad.exception(), sqlite3.IntegrityError)
+
+
+def test_flush_waits_for_queued_writes():
+    db.queue_user_session('ALICE', 'camp-w', True)
+    assert db.flush(timeout=5)
+    with db._reader() as conn:
+        assert conn.execute("SELECT 1 FROM user_sessions WHERE username = 'ALICE'").fetchone()
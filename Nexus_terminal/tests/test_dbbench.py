@@ -0,0 +1,35 @@
+import sqlite3
+
+import pytest
+
+import dbbench
+
+
+@pytest.fixture
+def conn():
+    c = sqlite3.connect(':memory:')
+    c.execute('CREATE TABLE t (a, b)')
+    c.execute('CREATE INDEX t_a ON t (a)')
+    c.execute('CREATE VIRTUAL TABLE f USING fts5 (body)')
+    yield c
+    c.close()
+
+
+@pytest.mark.parametrize('sql', [
+    'SELECT 1',
+    'SELECT (SELECT COUNT(*) FROM t WHERE a = 1) + 1',
+    'SELECT * FROM t WHERE a = 1',
+    'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 3) SELECT x FROM c',
+    "SELECT rowid FROM f WHERE f MATCH 'water'",
+])
+def test_not_a_table_scan(conn, sql):
+    assert dbbench._plan(conn, sql)[1] == []
+
+
+@pytest.mark.parametrize('sql', [
+    'SELECT * FROM t',
+    'SELECT * FROM t AS tt WHERE b = 1',
+    'SELECT COUNT(*) FROM t',  # whole covering index
+])
+def test_table_scan_is_flagged(conn, sql):
+    assert len(dbbench._plan(conn, sql)[1]) == 1
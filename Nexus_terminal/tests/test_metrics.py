@@ -0,0 +1,59 @@
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    # Read at call time, so the assertions run even under NEXUS_METRICS=0
+    monkeypatch.setattr(metrics, 'ENABLED', True)
+
+
+def test_counter_and_histogram_render(enabled):
+    c = metrics.Counter('test_things_total', 'Things.', ('kind',))
+    h = metrics.Histogram('test_wait_seconds', 'Waits.', buckets=(0.1, 1.0))
+    try:
+        c.inc('a')
+        c.inc('a', amount=2)
+        h.observe(0.05)
+        h.observe(0.5)
+        h.observe(5)
+        text = metrics.render()
+    finally:
+        metrics._registry.remove(c)
+        metrics._registry.remove(h)
+    assert 'test_things_total{kind="a"} 3' in text
+    assert 'test_wait_seconds_bucket{le="0.1"} 1' in text
+    assert 'test_wait_seconds_bucket{le="1.0"} 2' in text
+    assert 'test_wait_seconds_bucket{le="+Inf"} 3' in text
+    assert 'test_wait_seconds_count 3' in text
+
+
+@pytest.fixture
+def http(enabled):
+    import app
+    return app.app.test_client()
+
+
+def test_metrics_answer_local_scraper(http):
+    resp = http.get('/metrics')
+    assert resp.status_code == 200 and b'nexus_http_request_seconds' in resp.data
+
+
+def test_metrics_hidden_from_remote_and_proxied_clients(http):
+    assert http.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.7'}).status_code == 404
+    assert http.get('/metrics', headers={'X-Forwarded-For': '203.0.113.7'}).status_code == 404
+
+
+def test_metrics_not_found_when_disabled(http, monkeypatch):
+    monkeypatch.setattr(metrics, 'ENABLED', False)
+    assert http.get('/metrics').status_code == 404
+
+
+def test_metrics_token(http, monkeypatch):
+    import web
+    monkeypatch.setattr(web, 'METRICS_TOKEN', 's3cret')
+    assert http.get('/metrics').status_code == 404
+    assert http.get('/metrics', headers={'Authorization': 'Bearer nope'}).status_code == 404
+    remote = {'REMOTE_ADDR': '203.0.113.7'}
+    assert http.get('/metrics', headers={'Authorization': 'Bearer s3cret'}, environ_base=remote).status_code == 200
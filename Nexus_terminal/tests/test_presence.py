@@ -0,0 +1,80 @@
+import presence
+
+
+def test_local_sids_skips_mirrors_and_other_users():
+    reg = presence.PresenceRegistry()
+    reg.connect('s1', 'ALICE', 'camp')
+    reg.connect('s2', 'ALICE', 'other')
+    reg.connect('s3', 'ALICE', 'camp', host='worker-b')
+    reg.connect('s4', 'BOB', 'camp')
+    assert sorted(reg.local_sids('ALICE')) == ['s1', 's2']
+
+
+def test_refcounts_keep_user_online_until_last_socket():
+    reg = presence.PresenceRegistry()
+    assert reg.connect('s1', 'ALICE', 'camp') is True
+    assert reg.connect('s2', 'ALICE', 'camp') is False
+    assert reg.disconnect('s1') == ('ALICE', 'camp', False, False)
+    assert reg.is_online('ALICE')
+    assert reg.disconnect('s2') == ('ALICE', 'camp', True, True)
+    assert not reg.is_online('ALICE') and reg.online('camp') == []
+
+
+def test_logout_closes_sockets_left_open(signed_in):
+    import app
+    http, alice = signed_in('ALICE')
+    assert app.PRESENCE.is_online('ALICE')
+    assert http.post('/logout').get_json()['success']
+    assert not alice.is_connected()
+    assert not app.PRESENCE.is_online('ALICE')
+
+
+class Deferred:
+    """defer_fn that holds calls until the test runs them."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, delay, fn, *args):
+        self.calls.append((fn, args))
+
+    def run(self):
+        calls, self.calls = self.calls, []
+        for fn, args in calls:
+            fn(*args)
+
+
+def coalescer():
+    reg, sent, defer = presence.PresenceRegistry(), [], Deferred()
+    deltas = presence.DeltaCoalescer(reg, 0.25, lambda room, delta: sent.append((room, delta)), defer)
+    return reg, deltas, sent, defer
+
+
+def test_deltas_coalesce_per_window():
+    reg, deltas, sent, defer = coalescer()
+    for sid, user in (('s1', 'ALICE'), ('s2', 'BOB')):
+        deltas.touch('camp', user, was_present=False)
+        reg.connect(sid, user, 'camp')
+    assert len(defer.calls) == 1  # one timer per room and window
+    defer.run()
+    assert [(room, [m['username'] for m in d['joined']], d['left']) for room, d in sent] == \
+        [('camp', ['ALICE', 'BOB'], [])]
+
+
+def test_join_and_leave_inside_one_window_sends_nothing():
+    reg, deltas, sent, defer = coalescer()
+    deltas.touch('camp', 'ALICE', was_present=False)
+    reg.connect('s1', 'ALICE', 'camp')
+    deltas.touch('camp', 'ALICE', was_present=True)
+    reg.disconnect('s1')
+    defer.run()
+    assert sent == []
+
+
+def test_leave_is_reported():
+    reg, deltas, sent, defer = coalescer()
+    reg.connect('s1', 'ALICE', 'camp')
+    deltas.touch('camp', 'ALICE', was_present=True)
+    reg.disconnect('s1')
+    defer.run()
+    assert sent == [('camp', {'joined': [], 'left': ['ALICE']})]
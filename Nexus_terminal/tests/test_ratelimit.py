@@ -0,0 +1,62 @@
+import ratelimit
+
+LIMITS = {cls: (1.0, 2, 2.0, 3) for cls in ratelimit.LIMITS}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def limiter(**kwargs):
+    clock = Clock()
+    return ratelimit.Limiter(limits=LIMITS, clock=clock, **kwargs), clock
+
+
+def test_burst_then_socket_limit():
+    lim, clock = limiter()
+    assert lim.check('send_message', 's1', 'ALICE') is None
+    assert lim.check('send_message', 's1', 'ALICE') is None
+    scope, retry = lim.check('send_message', 's1', 'ALICE')
+    assert scope == 'sid' and retry == 1.0
+    clock.now += 1.0
+    assert lim.check('send_message', 's1', 'ALICE') is None  # refilled one token
+
+
+def test_user_bucket_spans_sockets():
+    lim, clock = limiter()
+    assert lim.check('send_message', 's1', 'ALICE') is None
+    assert lim.check('send_message', 's2', 'ALICE') is None
+    assert lim.check('send_message', 's3', 'ALICE') is None
+    scope, retry = lim.check('send_message', 's4', 'ALICE')  # new tab, same user
+    assert scope == 'user' and retry == 0.5
+    assert lim.check('send_message', 's5', 'BOB') is None
+
+
+def test_denied_event_takes_no_tokens():
+    lim, clock = limiter()
+    for _ in range(2):
+        lim.check('send_message', 's1', 'ALICE')
+    assert lim.check('send_message', 's1', 'ALICE')
+    assert lim.check('send_message', 's2', 'ALICE') is None  # the user bucket still had one
+
+
+def test_classes_and_unknown_events():
+    lim, clock = limiter()
+    for _ in range(2):
+        lim.check('send_message', 's1', 'ALICE')
+    assert lim.check('get_unread_counts', 's1', 'ALICE') is None  # another class, own buckets
+    assert all(lim.check('connect', 's1', 'ALICE') is None for _ in range(10))  # not limited
+
+
+def test_key_bound_and_forget_sid():
+    lim, clock = limiter(max_keys=4)
+    for i in range(10):
+        lim.check('send_message', f's{i}', f'u{i}')
+    assert len(lim._buckets) <= 4
+    lim.check('send_message', 'gone', None)
+    lim.forget_sid('gone')
+    assert not any(k[1] == 'gone' for k in lim._buckets)
@@ -0,0 +1,64 @@
+import pytest
+
+import db
+
+
+def rows(*messages):
+    return [{'id': i, 'message': m} for i, m in enumerate(messages)]
+
+
+def test_query_words_limits_terms_and_prefixes():
+    assert db._query_words('water* f* filter') == [('water', True), ('f', False), ('filter', False)]
+    assert len(db._query_words(' '.join(['w'] * 20))) == db.SEARCH_MAX_TERMS
+
+
+def test_rank_prefers_frequent_and_dense_matches():
+    ranked = db._rank(rows('water in a long message about many other unrelated things today',
+                           'water water',
+                           'water here'), [('water', False)])
+    assert [r['id'] for r in ranked] == [1, 2, 0]
+
+
+def test_rank_folds_case_accents_and_prefixes():
+    ranked = db._rank(rows('nothing relevant', 'Café CAFÉ cafeteria'), [('cafe', True)])
+    assert ranked[0]['id'] == 1
+
+
+@pytest.fixture(scope='module')
+def corpus():
+    db.init_db()
+    for camp, text in (('search-a', 'boil the water before drinking'),
+                       ('search-a', 'water filter is broken'),
+                       ('search-b', 'water tower spotted')):
+        db.add_message('ALICE', camp, text)
+    with db._writer() as conn:
+        conn.execute("INSERT OR REPLACE INTO trust_pairs (pair_key, a, b, a_trusts_b, b_trusts_a) "
+                     "VALUES ('SALLY||STEVE', 'SALLY', 'STEVE', 1, 1)")
+        conn.execute("INSERT OR REPLACE INTO trust_pairs (pair_key, a, b, a_trusts_b, b_trusts_a) "
+                     "VALUES ('SALLY||STRANGER', 'SALLY', 'STRANGER', 1, 0)")
+        conn.commit()
+    db._trust.invalidate()
+    db.add_private_message('SALLY', 'STEVE', 'meet at the water tower')
+    db.add_private_message('STRANGER', 'SALLY', 'water for sale')
+
+
+def test_search_is_scoped_to_the_basecamp(corpus):
+    found = db.search_messages('search-a', 'water')
+    assert sorted(m['message'] for m in found) == ['boil the water before drinking', 'water filter is broken']
+    assert [m['message'] for m in db.search_messages('search-a', 'water filter')] == ['water filter is broken']
+
+
+def test_search_treats_operators_as_text(corpus):
+    assert db.search_messages('search-a', 'water OR "x') == []
+    assert db.search_messages('search-a', 'NEAR(water') == []
+
+
+def test_recent_order_pages_with_before_id(corpus):
+    newest, = db.search_messages('search-a', 'water', limit=1, order='recent')
+    older = db.search_messages('search-a', 'water', limit=5, order='recent', before_id=newest['id'])
+    assert [m['message'] for m in older] == ['boil the water before drinking']
+
+
+def test_private_search_only_covers_mutual_partners(corpus):
+    assert [m['message'] for m in db.search_private('SALLY', 'water')] == ['meet at the water tower']
+    assert db.search_private('SALLY', 'water', partner='STRANGER') == []
@@ -0,0 +1,179 @@
+import asyncio
+
+import throttle
+import run_workers
+
+LIMITS = {kind: (2, 60.0) for kind in throttle.LIMITS}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def guess_throttle(**kwargs):
+    clock = Clock()
+    kwargs.setdefault('limits', LIMITS)
+    return throttle.GuessThrottle(clock=clock, base_delay=1.0, max_delay=8.0, enabled=True, **kwargs), clock
+
+
+def fail(gt, *keys):
+    with gt.attempt('login', *keys) as attempt:
+        assert not attempt.retry
+        attempt.failed()
+
+
+def test_backoff_doubles_past_the_free_failures_and_caps():
+    gt, clock = guess_throttle()
+    key = ('login', 'ALICE')
+    fail(gt, key)
+    fail(gt, key)
+    with gt.attempt('login', key) as attempt:
+        assert not attempt.retry  # two free failures
+    delays = []
+    for _ in range(5):
+        fail(gt, key)
+        with gt.attempt('login', key) as attempt:
+            delays.append(attempt.retry)
+        clock.now += attempt.retry
+    assert delays == [1.0, 2.0, 4.0, 8.0, 8.0]
+
+
+def test_failures_leave_the_window():
+    gt, clock = guess_throttle()
+    key = ('camp', 'ALICE')
+    for _ in range(3):
+        fail(gt, key)
+    clock.now += 60.0
+    fail(gt, key)  # the old three are out of the window: a free failure again
+    with gt.attempt('verify_basecamp', key) as attempt:
+        assert not attempt.retry
+
+
+def test_success_clears_account_keys_not_the_address():
+    gt, clock = guess_throttle()
+    ip, user = ('ip', '10.0.0.1'), ('login', 'ALICE')
+    for _ in range(3):
+        fail(gt, ip, user)
+    clock.now += 1.0
+    with gt.attempt('login', ip, user) as attempt:
+        assert not attempt.retry
+        attempt.succeeded(user)
+    assert ('login', 'ALICE') not in gt._entries
+    assert len(gt._entries[ip].failures) == 3
+
+
+def test_in_flight_guesses_count_against_the_key():
+    gt, clock = guess_throttle()
+    key = ('login', 'ALICE')
+    first, second = gt.attempt('login', key), gt.attempt('login', key)
+    assert not first.retry and not second.retry
+    third = gt.attempt('login', key)  # both free failures are being verified already
+    assert third.retry == 1.0
+    first.failed()
+    assert gt.attempt('login', key).retry == 1.0  # one free failure left, and it is in flight
+    second.failed()
+    clock.now += 1.0
+    one = gt.attempt('login', key)
+    assert not one.retry
+    assert gt.attempt('login', key).retry == 1.0  # past the free ones: one at a time
+
+
+def test_unsettled_attempt_gives_its_place_back():
+    gt, clock = guess_throttle()
+    key = ('login', 'ALICE')
+    for _ in range(2):
+        with gt.attempt('login', key) as attempt:
+            assert not attempt.retry  # left without an outcome, e.g. AuthBusy
+    assert len(gt) == 0
+
+
+def test_refused_attempt_reserves_nothing():
+    gt, clock = guess_throttle()
+    ip, user = ('ip', '10.0.0.1'), ('login', 'ALICE')
+    for _ in range(3):
+        fail(gt, user)
+    with gt.attempt('login', ip, user) as attempt:
+        assert attempt.retry == 1.0
+    assert ip not in gt._entries
+    assert gt._entries[user].pending == 0
+
+
+def test_keys_without_a_value_and_disabled_throttle():
+    gt, clock = guess_throttle()
+    for _ in range(5):
+        fail(gt, ('ip', None))
+    assert len(gt) == 0
+    off = throttle.GuessThrottle(limits=LIMITS, enabled=False)
+    for _ in range(5):
+        fail(off, ('login', 'ALICE'))
+    assert len(off) == 0
+
+
+def test_lru_bound():
+    gt, clock = guess_throttle(max_keys=3)
+    for name in ('A', 'B', 'C', 'D'):
+        fail(gt, ('login', name))
+    assert len(gt) == 3 and ('login', 'A') not in gt._entries
+
+
+def test_limit_overrides_dont_collide_with_the_switches(monkeypatch):
+    monkeypatch.setenv('NEXUS_THROTTLE_IP', '0')  # the per-address switch, not a limit
+    monkeypatch.setenv('NEXUS_THROTTLE_LIMIT_LOGIN', '3/60')
+    limits = throttle._limits_from_env()
+    assert limits['login'] == (3, 60.0) and limits['ip'] == throttle.LIMITS['ip']
+
+
+def test_client_ip(monkeypatch):
+    environ = {'REMOTE_ADDR': '127.0.0.1', 'HTTP_X_FORWARDED_FOR': '6.6.6.6, 10.0.0.7'}
+    monkeypatch.setattr(throttle, 'BY_IP', True)
+    monkeypatch.setattr(throttle, 'TRUST_FORWARDED', False)
+    assert throttle.client_ip(environ) == '127.0.0.1'
+    monkeypatch.setattr(throttle, 'TRUST_FORWARDED', True)
+    assert throttle.client_ip(environ) == '10.0.0.7'  # the hop our proxy appended
+    monkeypatch.setattr(throttle, 'BY_IP', False)
+    assert throttle.client_ip(environ) is None
+
+
+def test_sticky_proxy_forwards_the_client_address():
+    async def run():
+        received = bytearray()
+        upgraded = asyncio.Event()
+
+        async def worker(reader, writer):
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                received.extend(data)
+                if received.endswith(b'raw frame'):
+                    upgraded.set()
+            writer.close()
+
+        upstream = await asyncio.start_server(worker, '127.0.0.1', 0)
+        port = upstream.sockets[0].getsockname()[1]
+        proxy = await asyncio.start_server(run_workers.sticky_handler([port]), '127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection('127.0.0.1', proxy.sockets[0].getsockname()[1])
+        writer.write(b'POST /login HTTP/1.1\r\nHost: x\r\nX-Forwarded-For: 6.6.6.6\r\n'
+                     b'Content-Length: 4\r\n\r\nbody'
+                     b'POST /a HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+                     b'3\r\nabc\r\n0\r\n\r\n'
+                     b'GET /socket.io/ HTTP/1.1\r\nUpgrade: websocket\r\n\r\n'
+                     b'raw frame')
+        await writer.drain()
+        await asyncio.wait_for(upgraded.wait(), 5)
+        writer.close()
+        proxy.close()
+        upstream.close()
+        return bytes(received)
+
+    received = asyncio.run(run())
+    assert received == (b'POST /login HTTP/1.1\r\nHost: x\r\nContent-Length: 4\r\n'
+                        b'X-Forwarded-For: 127.0.0.1\r\n\r\nbody'
+                        b'POST /a HTTP/1.1\r\nTransfer-Encoding: chunked\r\nX-Forwarded-For: 127.0.0.1\r\n\r\n'
+                        b'3\r\nabc\r\n0\r\n\r\n'
+                        b'GET /socket.io/ HTTP/1.1\r\nUpgrade: websocket\r\nX-Forwarded-For: 127.0.0.1\r\n\r\n'
+                        b'raw frame')
@@ -0,0 +1,64 @@
+from contextlib import contextmanager
+
+import pytest
+
+import db
+from trust_cache import A_TRUSTS_B, B_TRUSTS_A, TrustCache
+
+MUTUAL = A_TRUSTS_B | B_TRUSTS_A
+
+
+def test_lru_bound():
+    cache = TrustCache(max_pairs=2)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, 0)
+    assert cache.get('a') is None and len(cache) == 2
+
+
+def test_fill_after_put_is_dropped():
+    cache = TrustCache()
+    generation = cache.generation()  # reader starts its SELECT
+    cache.put('A||B', MUTUAL)         # pairing commits meanwhile
+    assert cache.fill('A||B', 0, generation) is False
+    assert cache.get('A||B') == MUTUAL
+
+
+def test_fill_after_invalidate_is_dropped():
+    cache = TrustCache()
+    generation = cache.generation()
+    cache.invalidate('A||B')
+    assert cache.fill('A||B', A_TRUSTS_B, generation) is False
+    assert cache.get('A||B') is None
+
+
+def test_fill_without_interference():
+    cache = TrustCache()
+    assert cache.fill('A||B', A_TRUSTS_B, cache.generation())
+    assert cache.get('A||B') == A_TRUSTS_B
+
+
+@pytest.fixture
+def pairing_commits_during_read(monkeypatch):
+    """Make every trust_pairs read finish just before a pairing's write-through lands."""
+    db.init_db()
+    real_reader = db._reader
+
+    @contextmanager
+    def reader():
+        with real_reader() as conn:
+            yield conn
+        db._trust.put('RACE1||RACE2', MUTUAL)
+    monkeypatch.setattr(db, '_reader', reader)
+    db._trust.invalidate()
+
+
+def test_read_through_does_not_overwrite_newer_flags(pairing_commits_during_read):
+    # The reader saw no row (0); the pairing's flags must survive its fill
+    assert db.is_trusted('RACE1', 'RACE2') is False
+    assert db._trust.get('RACE1||RACE2') == MUTUAL
+    assert db.is_trusted('RACE1', 'RACE2') is True
+
+
+def test_batch_read_does_not_overwrite_newer_flags(pairing_commits_during_read):
+    db.get_trust_statuses('RACE1', ['RACE2'])
+    assert db._trust.get('RACE1||RACE2') == MUTUAL
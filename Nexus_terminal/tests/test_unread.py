@@ -0,0 +1,78 @@
+import pytest
+
+import db
+import unread
+
+
+@pytest.fixture(scope='module', autouse=True)
+def schema():
+    db.init_db()
+
+
+def dms(sender, recipient, n):
+    return [db.add_private_message(sender, recipient, f'{sender} -> {recipient} {i}') for i in range(n)]
+
+
+def test_summary_counts_above_each_read_cursor():
+    a = dms('UA', 'UR', 4)
+    b = dms('UB', 'UR', 2)
+    dms('UR', 'UA', 1)  # sent by the user: never unread for them
+    assert db.get_unread_summary('UR') == {'UA': (4, a[-1]), 'UB': (2, b[-1])}
+    db.mark_private_read('UR', 'UA', a[1])
+    assert db.get_unread_summary('UR') == {'UA': (2, a[-1]), 'UB': (2, b[-1])}
+    db.mark_private_read('UR', 'UB')
+    assert db.get_unread_counts('UR') == {'UA': 2}
+
+
+def test_read_cursor_never_moves_back():
+    ids = dms('VA', 'VR', 3)
+    db.mark_private_read('VR', 'VA', ids[2])
+    db.mark_private_read('VR', 'VA', ids[0])
+    assert db.get_unread_summary('VR') == {}
+
+
+def test_read_cursor_is_clamped_to_the_newest_message():
+    ids = dms('WA', 'WR', 2)
+    db.mark_private_read('WR', 'WA', 10 ** 15)  # an id from the future
+    assert db.get_unread_summary('WR') == {}
+    later = db.add_private_message('WA', 'WR', 'still arrives')
+    assert later > ids[-1]
+    assert db.get_unread_summary('WR') == {'WA': (1, later)}
+
+
+def test_read_cursor_without_messages_stays_at_zero():
+    db.mark_private_read('XR', 'XA', 10 ** 15)
+    first = db.add_private_message('XA', 'XR', 'first ever')
+    assert db.get_unread_counts('XR') == {'XA': 1} and first
+
+
+def test_cache_follows_sends_and_reads():
+    ids = dms('YA', 'YR', 2)
+    assert unread.counts('YR') == {'YA': 2}
+    new = db.add_private_message('YA', 'YR', 'third')
+    assert unread.on_message('YR', 'YA', new) == 3
+    assert unread.on_message('YR', 'YA', new) == 3  # same id twice counts once
+    assert unread.on_message('NOT-CACHED', 'YA', new) is None
+    db.mark_private_read('YR', 'YA', ids[0])
+    assert unread.on_read('YR', 'YA', ids[0]) == 2  # partial read reseeds from SQLite
+    db.mark_private_read('YR', 'YA')
+    assert unread.on_read('YR', 'YA') == 0
+    assert unread.counts('YR') == {}
+
+
+def test_dm_counted_while_the_seed_is_in_flight_is_kept(monkeypatch):
+    first = db.add_private_message('ZA', 'ZR', 'before the seed')
+    real_summary = db.get_unread_summary
+    late = []
+
+    def summary_then_dm(user):
+        summary = real_summary(user)
+        # Committed after the seed's query but before its map is stored
+        late.append(db.add_private_message('ZA', 'ZR', 'during the seed'))
+        assert unread.on_message('ZR', 'ZA', late[0]) is None
+        assert unread.on_message('ZR', 'ZA', first) is None  # the seed saw this one
+        return summary
+
+    monkeypatch.setattr(db, 'get_unread_summary', summary_then_dm)
+    assert unread.counts('ZR') == {'ZA': 2}
+    assert not unread._seeding
@@ -0,0 +1,216 @@
+# throttle.py - failed-guess throttling in front of the Argon2 verifies
+#
+# Every wrong password, basecamp code or partner code costs a full Argon2
+# verify (64 MiB, ~100 ms of a pool worker), so guessing is also a way to eat
+# the server's CPU and memory. Callers take an attempt on their keys *before*
+# verifying and settle it with the outcome:
+#
+#   /login               ('ip', addr), ('login', username)
+#   /verify_basecamp     ('ip', addr), ('camp', username)
+#   submit_partner_code  ('ip', addr), ('pair', username), ('partner', target)
+#
+#   with GUESS_THROTTLE.attempt('login', *keys) as attempt:
+#       if attempt.retry:
+#           ...refuse, retry after attempt.retry seconds
+#       ...verify, then attempt.failed() or attempt.succeeded(account_key)
+#
+# A key records its failures in a sliding window (LIMITS: free failures per
+# window). Past the free ones, each further failure blocks the key for
+# BASE_DELAY * 2^k seconds, capped at MAX_DELAY. While blocked, attempt()
+# answers with the seconds left: a dict lookup, no hashing at all. Success
+# clears the account keys but not the address, so one good login from an
+# address doesn't reset its budget against other accounts.
+#
+# Guesses still being verified count too: a key admits only as many at once
+# as it has free failures left (at least one), so a burst sent before the
+# first failure is recorded can't all reach Argon2. An attempt left without
+# an outcome (the pool was busy, the verify raised) gives its place back.
+#
+# Keys live in one LRU dict capped at MAX_KEYS. Evicting a key forgets its
+# failures, which only ever makes the throttle more lenient.
+#
+# The state is per process. Under run_workers.py each worker has its own
+# budgets: the sticky proxy pins an address to one worker, so the 'ip' keys
+# see all of its guesses, but an account attacked from several addresses on
+# N workers gets up to N times its LIMITS.
+#
+# Behind a proxy every client has the proxy's address: set
+# NEXUS_TRUST_FORWARDED=1 if it appends X-Forwarded-For (run_workers.py's
+# sticky proxy does, and sets it for its workers), or NEXUS_THROTTLE_IP=0 to
+# key by account only.
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+
+import metrics
+
+ENABLED = os.environ.get('NEXUS_THROTTLE', '1') != '0'
+BY_IP = os.environ.get('NEXUS_THROTTLE_IP', '1') != '0'
+TRUST_FORWARDED = os.environ.get('NEXUS_TRUST_FORWARDED') == '1'
+MAX_KEYS = int(os.environ.get('NEXUS_THROTTLE_MAX_KEYS') or 100000)
+BASE_DELAY = 1.0        # seconds blocked after the first failure past the free ones
+MAX_DELAY = 15 * 60.0   # longest block
+
+# key kind -> (free failures per window, window seconds).
+# Override one with NEXUS_THROTTLE_LIMIT_<KIND>="failures/seconds".
+LIMITS = {
+    'ip': (20, 900),       # any account, from one address
+    'login': (5, 900),     # one username's password
+    'camp': (5, 900),      # basecamp codes tried by one user
+    'pair': (10, 900),     # partner codes tried by one user
+    'partner': (10, 900),  # codes tried against one partner, by anyone
+}
+
+THROTTLED = metrics.Counter('nexus_auth_throttled_total', 'Credential checks refused before verifying.',
+                            ('endpoint', 'scope'))
+
+
+def _limits_from_env():
+    limits = dict(LIMITS)
+    for kind in LIMITS:
+        spec = os.environ.get('NEXUS_THROTTLE_LIMIT_' + kind.upper())
+        if spec:
+            failures, window = spec.split('/')
+            limits[kind] = (int(failures), float(window))
+    return limits
+
+
+def client_ip(environ):
+    """Address to throttle by, or None when keying by address is off."""
+    if not BY_IP:
+        return None
+    if TRUST_FORWARDED:
+        forwarded = environ.get('HTTP_X_FORWARDED_FOR', '')
+        if forwarded:
+            # The last hop is the one our proxy appended; earlier ones are client-supplied
+            return forwarded.split(',')[-1].strip() or None
+    return environ.get('REMOTE_ADDR') or None
+
+
+class _Entry:
+    __slots__ = ('failures', 'blocked_until', 'pending')
+
+    def __init__(self, cap):
+        self.failures = deque(maxlen=cap)  # failure times in the window, oldest first
+        self.blocked_until = 0.0
+        self.pending = 0  # admitted guesses not settled yet
+
+
+class Attempt:
+    """One guess taken with GuessThrottle.attempt(); `retry` > 0 means refused.
+
+    Settle it with failed() or succeeded(). Leaving the `with` block unsettled
+    gives the reservation back without counting a failure.
+    """
+
+    def __init__(self, throttle, keys, retry):
+        self.retry = retry
+        self._throttle = throttle
+        self._keys = keys  # reserved keys, empty once settled or when refused
+
+    def failed(self):
+        self._throttle._settle(self._keys, failed=True)
+        self._keys = ()
+
+    def succeeded(self, *clear):
+        """Release the reservation and forget the failures of `clear` (the account keys)."""
+        self._throttle._settle(self._keys, clear=clear)
+        self._keys = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self._keys:
+            self._throttle._settle(self._keys)
+            self._keys = ()
+        return False
+
+
+class GuessThrottle:
+    def __init__(self, limits=None, max_keys=MAX_KEYS, base_delay=BASE_DELAY, max_delay=MAX_DELAY,
+                 clock=time.monotonic, enabled=ENABLED):
+        self.enabled = enabled  # off: every attempt is admitted and nothing is recorded
+        self.limits = limits or _limits_from_env()
+        self.max_keys = max_keys
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (kind, value) -> _Entry
+        # Failures past this many over the free ones all get MAX_DELAY anyway
+        self._extra = max(1, int(max_delay / base_delay).bit_length() + 1)
+
+    def _keys(self, keys):
+        if not self.enabled:
+            return []
+        return [k for k in keys if k[1]]  # skip keys with no value (unknown address)
+
+    def _entry_locked(self, key, now):
+        free, window = self.limits[key[0]]
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _Entry(free + self._extra)
+            if len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+        failures = entry.failures
+        while failures and now - failures[0] >= window:
+            failures.popleft()
+        return entry
+
+    def _drop_idle_locked(self, key, entry, now):
+        if not entry.pending and not entry.failures and entry.blocked_until <= now:
+            self._entries.pop(key, None)
+
+    def attempt(self, endpoint, *keys):
+        """Admit one guess against `keys` now, or refuse it with the seconds to wait."""
+        keys = self._keys(keys)
+        now = self._clock()
+        scope, retry = None, 0.0
+        with self._lock:
+            entries = [self._entry_locked(key, now) for key in keys]
+            for key, entry in zip(keys, entries):
+                wait = entry.blocked_until - now
+                if wait <= 0 and entry.pending >= max(1, self.limits[key[0]][0] - len(entry.failures)):
+                    wait = self.base_delay  # its remaining free guesses are being verified already
+                if wait > retry:
+                    scope, retry = key[0], wait
+            for key, entry in zip(keys, entries):
+                if scope is None:
+                    entry.pending += 1
+                else:
+                    self._drop_idle_locked(key, entry, now)
+        if scope is not None:
+            THROTTLED.inc(endpoint, scope)
+            return Attempt(self, (), retry)
+        return Attempt(self, keys, 0.0)
+
+    def _settle(self, keys, failed=False, clear=()):
+        now = self._clock()
+        with self._lock:
+            for key in keys:
+                if key not in self._entries:
+                    continue  # evicted meanwhile
+                entry = self._entry_locked(key, now)
+                entry.pending = max(0, entry.pending - 1)
+                if failed:
+                    entry.failures.append(now)
+                    over = len(entry.failures) - self.limits[key[0]][0]
+                    if over > 0:
+                        delay = min(self.max_delay, self.base_delay * 2 ** (over - 1))
+                        entry.blocked_until = max(entry.blocked_until, now + delay)
+                elif key in clear:
+                    entry.failures.clear()
+                    entry.blocked_until = 0.0
+                self._drop_idle_locked(key, entry, now)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def reply(retry_after):
+    """Fields a throttled response carries."""
+    return {'throttled': True, 'retry_after': max(1, round(retry_after))}
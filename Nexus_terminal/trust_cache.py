@@ -0,0 +1,83 @@
+# trust_cache.py - in-process cache of trust_pairs flags
+#
+# Keyed by the sorted pair key ("A||B"); the value packs both directional
+# flags into one small int: bit 0 = a trusts b, bit 1 = b trusts a. A pair
+# with no row is cached as 0 so repeated DM attempts between strangers don't
+# hit SQLite either. Bounded by an LRU so huge user counts can't grow it
+# without limit; evicted pairs are simply re-read on their next use.
+#
+# Two kinds of writes: put() stores flags just committed to SQLite (write-
+# through) and invalidate() drops pairs another worker changed; both bump a
+# generation counter. A read-through miss takes generation() *before* its
+# SELECT and stores the result with fill(), which is a no-op if anything was
+# put or invalidated in between. Otherwise a reader that fetched the old row
+# just before a pairing committed could overwrite the new flags with stale
+# ones (or a stale 0), hiding the pairing until the entry was evicted.
+import threading
+from collections import OrderedDict
+
+A_TRUSTS_B = 1
+B_TRUSTS_A = 2
+
+MAX_PAIRS = 200000
+
+
+def pack(a_trusts_b, b_trusts_a) -> int:
+    return (A_TRUSTS_B if a_trusts_b else 0) | (B_TRUSTS_A if b_trusts_a else 0)
+
+
+class TrustCache:
+    def __init__(self, max_pairs=MAX_PAIRS):
+        self.max_pairs = max_pairs
+        self._pairs = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0  # bumped by put() and invalidate()
+
+    def get(self, key):
+        """Packed flags for `key`, or None if not cached."""
+        with self._lock:
+            flags = self._pairs.get(key)
+            if flags is not None:
+                self._pairs.move_to_end(key)
+            return flags
+
+    def generation(self) -> int:
+        """Take before reading trust_pairs for a later fill()."""
+        return self._generation
+
+    def _store_locked(self, key, flags):
+        self._pairs[key] = flags
+        self._pairs.move_to_end(key)
+        while len(self._pairs) > self.max_pairs:
+            self._pairs.popitem(last=False)
+
+    def put(self, key, flags):
+        """Store flags that were just committed (authoritative)."""
+        with self._lock:
+            self._generation += 1
+            self._store_locked(key, flags)
+
+    def fill(self, key, flags, generation) -> bool:
+        """Store flags read at `generation`, unless a put/invalidate has happened since."""
+        with self._lock:
+            if self._generation != generation:
+                return False
+            self._store_locked(key, flags)
+            return True
+
+    def warm(self, rows, generation):
+        """Fill (pair_key, a_trusts_b, b_trusts_a) rows read at `generation` until the cache is full."""
+        for key, ab, ba in rows:
+            if len(self._pairs) >= self.max_pairs or not self.fill(key, pack(ab, ba), generation):
+                break
+
+    def invalidate(self, key=None):
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._pairs.clear()
+            else:
+                self._pairs.pop(key, None)
+
+    def __len__(self):
+        return len(self._pairs)
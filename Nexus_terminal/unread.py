@@ -0,0 +1,100 @@
+# unread.py - in-memory unread DM counters
+#
+# Per user: partner -> [unread count, id of the newest message counted].
+# A user's map is seeded from SQLite the first time it's needed (normally on
+# connect) and then kept current by send / mark-read, so the DM path never
+# re-aggregates private_messages. Users who aren't cached are left alone: the
+# DB stays authoritative and they get seeded when they next show up.
+#
+# A seed reads SQLite without holding the lock, so DMs counted while one is in
+# flight are kept aside and replayed onto the fresh map; the per-partner
+# newest id makes the replay skip those the seed already saw.
+import threading
+from collections import OrderedDict
+
+import db
+
+MAX_USERS = 10000  # LRU bound on cached users
+
+_cache = OrderedDict()  # user -> {partner: [count, last_id]}
+_seeding = {}  # user -> [seeds in flight, [(sender, msg_id) counted meanwhile]]
+_lock = threading.Lock()
+
+
+def _seeded(user):
+    """Return the user's map, seeding it from SQLite if needed. Caller holds no lock."""
+    with _lock:
+        entry = _cache.get(user)
+        if entry is not None:
+            _cache.move_to_end(user)
+            return entry
+        pending = _seeding.setdefault(user, [0, []])
+        pending[0] += 1
+    try:
+        summary = db.get_unread_summary(user)
+    finally:
+        with _lock:
+            pending[0] -= 1
+            if not pending[0] and _seeding.get(user) is pending:
+                del _seeding[user]
+    with _lock:
+        entry = _cache.get(user)
+        if entry is None:
+            entry = _cache[user] = {p: [cnt, last_id] for p, (cnt, last_id) in summary.items()}
+            for sender, msg_id in pending[1]:
+                _count(entry, sender, msg_id)
+        _cache.move_to_end(user)
+        while len(_cache) > MAX_USERS:
+            _cache.popitem(last=False)
+        return entry
+
+
+def counts(user) -> dict:
+    """Full partner -> count map for `user` (seeds the cache)."""
+    entry = _seeded(user)
+    with _lock:
+        return {p: c for p, (c, _) in entry.items() if c}
+
+
+def on_message(recipient, sender, msg_id):
+    """Count a new DM. Returns the recipient's new count for `sender`, or None if not cached."""
+    with _lock:
+        entry = _cache.get(recipient)
+        if entry is None:
+            pending = _seeding.get(recipient)
+            if pending is not None:
+                pending[1].append((sender, msg_id))  # for the seed in flight
+            return None
+        return _count(entry, sender, msg_id)
+
+
+def _count(entry, sender, msg_id):
+    slot = entry.setdefault(sender, [0, 0])
+    if msg_id is not None and msg_id <= slot[1]:
+        return slot[0]  # already counted
+    slot[0] += 1
+    if msg_id is not None:
+        slot[1] = msg_id
+    return slot[0]
+
+
+def on_read(user, partner, up_to_id=None):
+    """Apply a mark-read. Returns the remaining count for `partner`, or None if not cached."""
+    with _lock:
+        entry = _cache.get(user)
+        if entry is None:
+            return None
+        slot = entry.get(partner)
+        if slot is None:
+            return 0
+        if up_to_id is None or up_to_id >= slot[1]:
+            entry.pop(partner, None)
+            return 0
+        # Partial read: we don't know how many are left below last_id; reseed.
+        _cache.pop(user, None)
+    return counts(user).get(partner, 0)
+
+
+def forget(user):
+    with _lock:
+        _cache.pop(user, None)
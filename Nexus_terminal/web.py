@@ -0,0 +1,321 @@
+# web.py - the HTTP side both serving modes share
+#
+# The Flask app and its routes, the credential checks behind them (Argon2
+# through auth_pool, with the guess throttle in front), the message retention
+# pass and the startup work every process does (init). app.py serves this
+# with Flask-SocketIO, asgi_app.py mounts it under ASGI through a2wsgi.
+# Importing it builds the Flask app and nothing else: no Socket.IO server,
+# threads or database work until the server calls init().
+import os
+import time
+import hashlib
+import hmac
+from datetime import datetime
+
+from flask import Flask, render_template, request, jsonify, session
+from argon2 import PasswordHasher
+
+import db
+import auth_pool
+from auth_pool import AuthBusy
+import create_basecamp
+import room_history
+import metrics
+import throttle
+from cred_store import basecamps_store
+from closing_session import session_bp
+
+ph = PasswordHasher()
+
+app = Flask(__name__)
+app.config['SECRET_KEY'] = 'nexus_terminal_2087_secret_key'
+app.config['SESSION_PERMANENT'] = False
+app.config['INACTIVITY_TIMEOUT'] = 15 * 60  # 15 minutes
+
+app.register_blueprint(session_bp)
+
+# Route timings for /metrics (NEXUS_METRICS=0: none of it)
+metrics.instrument_flask(app)
+
+# Retention: camp messages older than the camp's "retention_days" (in
+# basecamps.json, else NEXUS_RETENTION_DAYS) and DMs older than
+# NEXUS_DM_RETENTION_DAYS move to the archive (db.archive_expired) every
+# RETENTION_INTERVAL seconds. Unset / 0 keeps everything in SQLite.
+RETENTION_DAYS = float(os.environ.get('NEXUS_RETENTION_DAYS') or 0)
+DM_RETENTION_DAYS = float(os.environ.get('NEXUS_DM_RETENTION_DAYS') or 0)
+RETENTION_INTERVAL = float(os.environ.get('NEXUS_RETENTION_INTERVAL') or 3600)
+
+
+def init():
+    """Startup work for a serving process; call once, before taking requests."""
+    # SQL timings for /metrics
+    metrics.instrument_module(db)
+    metrics.gauge('nexus_db_readers', 'SQLite reader pool.',
+                  lambda: {k: v for k, v in db.pool_stats().items() if k != 'profile'})
+    db.init_db()
+    # One-shot move of users.json / nocode_users.json accounts into SQLite
+    db.import_users_json_if_empty()
+    # Trust edges for DM gating live in memory
+    db.warm_trust_cache()
+    # Recent-message ring buffers, so joins never query the messages table
+    room_history.warm(load_basecamps().keys())
+
+
+def archive_expired(sleep=time.sleep):
+    """One retention pass; the caller repeats it every RETENTION_INTERVAL seconds."""
+    camp_days = {bid: info.get('retention_days') for bid, info in load_basecamps().items()}
+    if RETENTION_DAYS or DM_RETENTION_DAYS or any(camp_days.values()):
+        try:
+            db.archive_expired(camp_days, RETENTION_DAYS, DM_RETENTION_DAYS, pause=lambda: sleep(0.01))
+        except Exception:
+            app.logger.exception('archiving expired messages failed')
+
+
+# Base camp codes (expandable for multiple camps)
+# Load basecamp codes from basecamps.json. Codes (secrets) are stored as Argon2 hashes.
+# The JSON structure is: { "<id>": { "name": "<display name>", "scheme":"argon2", "hash":"<argon2 hash>",
+#                                    "lookup": "<hmac tag of the code>",
+#                                    "lookup_key": "<fingerprint of the key that made the tag>",
+#                                    "retention_days": <optional, see RETENTION_DAYS>,
+#                                    "broadcast_window_ms": <optional, see chat.BROADCAST_WINDOW_MS> }, ... }
+# Served from an in-memory cache that reloads when the file changes (cred_store).
+def load_basecamps():
+    return basecamps_store.get()
+
+def _lookup_index(basecamps):
+    return {info['lookup']: bid for bid, info in basecamps.items() if info.get('lookup')}
+
+def verify_basecamp_code(candidate_code):
+    """Return (basecamp_id, basecamp_name) if candidate_code matches a stored code, else (None, None).
+
+    Camps carrying a "lookup" tag are found by HMAC of the candidate, so at most
+    one Argon2 verify runs for them. Untagged (pre-tag) camps, and camps tagged
+    under a lookup key that is no longer the current one, are checked one by
+    one and get (re)tagged on their first successful match.
+    Raises AuthBusy if the auth pool is saturated or unavailable.
+    """
+    basecamps = load_basecamps()
+    tag = create_basecamp.lookup_tag(candidate_code)
+    bid = basecamps_store.derive('lookup_index', _lookup_index).get(tag)
+    if bid is not None:
+        info = basecamps[bid]
+        if info.get('scheme') == 'argon2' and info.get('hash') and info.get('name'):
+            if auth_pool.verify(info['hash'], candidate_code):
+                return bid, info['name']
+
+    for bid, info in basecamps.items():
+        scheme = info.get('scheme')
+        h = info.get('hash')
+        name = info.get('name')
+        if scheme == 'argon2' and h and name:
+            if create_basecamp.has_current_tag(info):
+                continue
+            if auth_pool.verify(h, candidate_code):
+                _tag_basecamp(bid, tag)
+                return bid, name
+            continue
+        # legacy: if 'code' stored plaintext (not recommended)
+        if info.get('code') and info['code'] == candidate_code:
+            return bid, name
+    return None, None
+
+def _tag_basecamp(bid, tag):
+    """Lazy migration: store the lookup tag for a camp whose code just matched."""
+    key_id = create_basecamp.lookup_key_id()
+
+    def apply(data):
+        if bid in data:
+            data[bid]['lookup'] = tag
+            data[bid]['lookup_key'] = key_id
+    try:
+        basecamps_store.update(apply)
+    except Exception:
+        # The login itself is valid even if the tag can't be written
+        pass
+
+
+def verify_user(username, password):
+    """Verify user credentials securely, supporting seamless migration.
+
+    Accounts live in the SQLite users table (imported once from users.json).
+    Preferred: scheme 'argon2'. Legacy imports carry scheme 'sha256' (hex digest)
+    or 'plain'; we verify once then upgrade the row to Argon2.
+    Raises AuthBusy if the auth pool is saturated or unavailable.
+    """
+    if not username or password is None:
+        return False
+    user = db.get_user(username)
+    if not user:
+        return False
+
+    # 1) Argon2 path
+    if user['scheme'] == 'argon2':
+        return auth_pool.verify(user['hash'], password)
+
+    # 2) Legacy SHA-256 migration path
+    if user['scheme'] == 'sha256':
+        candidate = hashlib.sha256(password.encode('utf-8')).hexdigest()
+        if candidate == user['hash']:
+            _upgrade_to_argon2(username, password)
+            return True
+        return False
+
+    # 3) Absolute fallback: (ill-advised) plaintext import, allow exactly once then migrate
+    if user['scheme'] == 'plain':
+        if password == user['hash']:
+            _upgrade_to_argon2(username, password)
+            return True
+        return False
+
+    return False
+
+
+def _upgrade_to_argon2(username, password):
+    """Replace a legacy credential with Argon2."""
+    try:
+        db.set_user_password_hash(username, ph.hash(password))
+    except Exception:
+        # Even if migration fails to write, the login itself is valid
+        pass
+
+
+# Failed-guess throttle taken before any Argon2 verify (throttle.py;
+# NEXUS_THROTTLE=0 turns it off)
+GUESS_THROTTLE = throttle.GuessThrottle()
+
+
+def _throttled_response(retry):
+    fields = throttle.reply(retry)
+    resp = jsonify({'success': False, **fields,
+                    'message': f'Too many failed attempts. Try again in {fields["retry_after"]}s.'})
+    resp.headers['Retry-After'] = str(fields['retry_after'])
+    return resp, 429
+
+
+@app.route('/')
+def index():
+    return render_template('index.html')
+
+
+@app.route('/login', methods=['POST'])
+def login():
+    data = request.get_json()
+    username = data.get('username')
+    password = data.get('password')
+
+    ip_key, user_key = ('ip', throttle.client_ip(request.environ)), ('login', username)
+    with GUESS_THROTTLE.attempt('login', ip_key, user_key) as attempt:
+        if attempt.retry:
+            return _throttled_response(attempt.retry)
+        try:
+            ok = verify_user(username, password)
+        except AuthBusy:
+            return jsonify({'success': False, 'busy': True,
+                            'message': 'Authentication service busy. Try again shortly.'}), 503
+        if ok:
+            attempt.succeeded(user_key)
+        else:
+            attempt.failed()
+
+    if ok:
+        session['username'] = username
+        session['authenticated'] = True
+        session["last_activity"] = datetime.utcnow().timestamp()
+        return jsonify({'success': True, 'message': f'Welcome back, {username}'})
+    else:
+        return jsonify({'success': False, 'message': 'Invalid credentials. Access denied.'})
+
+
+@app.route('/verify_basecamp', methods=['POST'])
+def verify_basecamp():
+    if not session.get('authenticated'):
+        return jsonify({'success': False, 'message': 'Not authenticated'}), 401
+
+    data = request.get_json() or {}
+    candidate = (data.get('basecamp_code') or '').strip()
+
+    ip_key, user_key = ('ip', throttle.client_ip(request.environ)), ('camp', session.get('username'))
+    with GUESS_THROTTLE.attempt('verify_basecamp', ip_key, user_key) as attempt:
+        if attempt.retry:
+            return _throttled_response(attempt.retry)
+        # Use the Argon2-backed JSON source
+        try:
+            basecamp_id, basecamp_name = verify_basecamp_code(candidate)
+        except AuthBusy:
+            return jsonify({'success': False, 'busy': True,
+                            'message': 'Authentication service busy. Try again shortly.'}), 503
+        if basecamp_id:
+            attempt.succeeded(user_key)
+        else:
+            attempt.failed()
+
+    if basecamp_id:
+        session['basecamp'] = basecamp_id
+        session['basecamp_name'] = basecamp_name
+        return jsonify({
+            'success': True,
+            'message': f'Access granted to {basecamp_name}',
+            'basecamp_name': basecamp_name
+        }), 200
+
+    return jsonify({'success': False, 'message': 'Invalid base camp code. Access denied.'}), 403
+
+
+@app.route('/basecamp')
+def basecamp():
+    if not session.get('authenticated') or not session.get('basecamp'):
+        return render_template('index.html')
+
+    return render_template('basecamp.html',
+                           username=session.get('username'),
+                           basecamp_name=session.get('basecamp_name'),
+                           basecamp_code=session.get('basecamp'))
+
+
+def close_user_sockets(username):
+    """Disconnect this process's sockets of `username`; each server points this at its own."""
+
+
+@app.route('/logout', methods=['POST'])
+def logout():
+    # Presence is tracked per socket. The client normally closes its socket
+    # before calling /logout; any it left open (other tabs, an inactivity
+    # logout) are closed here so the user doesn't stay listed as online.
+    username = session.get('username')
+    if username:
+        close_user_sockets(username)
+
+    # clear server-side session state
+    session.clear()
+
+    # send a response that *actually* clears the cookie in the browser
+    resp = jsonify({'success': True, 'message': 'Disconnected from network'})
+    cookie_name = app.config.get('SESSION_COOKIE_NAME', 'session')
+    resp.delete_cookie(cookie_name)
+    return resp
+
+# /metrics is for a scraper, not for clients. With NEXUS_METRICS_TOKEN set it
+# needs "Authorization: Bearer <token>"; without a token it only answers
+# loopback requests that didn't come through a proxy (no X-Forwarded-For),
+# i.e. a scraper on the same host hitting the worker's own port.
+METRICS_TOKEN = os.environ.get('NEXUS_METRICS_TOKEN')
+
+
+def _metrics_allowed():
+    if METRICS_TOKEN:
+        return hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + METRICS_TOKEN)
+    return request.remote_addr in ('127.0.0.1', '::1') and 'X-Forwarded-For' not in request.headers
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    if not metrics.ENABLED or not _metrics_allowed():
+        return 'not found\n', 404
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.route('/end_chat', methods=['POST'])
+def end_chat():
+    session.pop('basecamp', None)
+    session.pop('basecamp_name', None)
+    return jsonify({'success': True, 'message': 'Chat session terminated'})